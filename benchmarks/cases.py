@@ -0,0 +1,371 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import timeit
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 1 フレーム / 1 イベントごとに実行されるコードのマイクロベンチマーク。
+# アプリのモジュールを直接呼び出し、ネットワークへの送受信だけをメモリ上の相手に置き換える。
+# 両アプリは同名のモジュール (metrics, logger など) を持つため、アプリごとに別プロセスで実行する。
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+APP_DIRS = {
+    "microservices": REPO_ROOT / "microservices",
+    "single-app": REPO_ROOT / "single-app-infra",
+}
+FRAME_BYTES = 960  # PCM 24kHz 16bit mono の 20ms
+BATCH = 1000
+
+# (app, name) -> setup。setup は (1 回の呼び出しで実行される操作数, 計測対象の関数) を返す
+Setup = Callable[[], Tuple[int, Callable[[], None]]]
+CASES: Dict[Tuple[str, str], Setup] = {}
+
+def case(name: str, app: str) -> Callable[[Setup], Setup]:
+    def decorator(setup: Setup) -> Setup:
+        CASES[(app, name)] = setup
+        return setup
+    return decorator
+
+
+def audio_base64() -> str:
+    return base64.b64encode(os.urandom(FRAME_BYTES)).decode("ascii")
+
+def acs_audio_message() -> str:
+    return json.dumps({
+        "kind": "AudioData",
+        "audioData": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "participantRawID": "4:+810000000000",
+            "data": audio_base64(),
+            "silent": False,
+        },
+    })
+
+def incoming_call_batch(size: int) -> List[dict]:
+    return [{
+        "id": str(uuid.uuid4()),
+        "topic": "/subscriptions/bench/resourceGroups/bench/providers/Microsoft.Communication/communicationServices/bench",
+        "subject": "/caller/+810000000000/recipient/+810000000001",
+        "eventType": "Microsoft.Communication.IncomingCall",
+        "eventTime": datetime.now(timezone.utc).isoformat(),
+        "dataVersion": "1.0",
+        "metadataVersion": "1",
+        "data": {
+            "to": {"kind": "phoneNumber", "rawId": "4:+810000000001", "phoneNumber": {"value": "+810000000001"}},
+            "from": {"kind": "phoneNumber", "rawId": "4:+810000000000", "phoneNumber": {"value": "+810000000000"}},
+            "serverCallId": str(uuid.uuid4()),
+            "incomingCallContext": base64.b64encode(os.urandom(512)).decode("ascii"),
+            "correlationId": str(uuid.uuid4()),
+        },
+    } for _ in range(size)]
+
+def callback_batch(size: int) -> List[dict]:
+    call_connection_id = str(uuid.uuid4())
+    return [{
+        "id": str(uuid.uuid4()),
+        "source": f"calling/callConnections/{call_connection_id}",
+        "type": "Microsoft.Communication.ContinuousDtmfRecognitionToneReceived",
+        "specversion": "1.0",
+        "datacontenttype": "application/json",
+        "time": datetime.now(timezone.utc).isoformat(),
+        "subject": f"calling/callConnections/{call_connection_id}",
+        "data": {"callConnectionId": call_connection_id, "tone": "one", "sequenceId": index},
+    } for index in range(size)]
+
+TRANSCRIPT_DELTAS = ["お電話", "ありがとう", "ございます", "。", "Hello", ", how can", " I help you", "?"]
+ROLES = ["RoleA", "RoleB", "RoleC", "RoleD", "RoleE", None]
+
+
+class MemoryWebSocket:
+    # FastAPI の WebSocket の代わりに、用意したメッセージを返し、送信内容は捨てる
+    def __init__(self, messages: Optional[List[str]] = None) -> None:
+        self._messages = messages or []
+        self._index = 0
+        self.sent = 0
+
+    def rewind(self) -> None:
+        self._index = 0
+
+    async def receive(self) -> dict:
+        if self._index >= len(self._messages):
+            return {"type": "websocket.disconnect"}
+        message = self._messages[self._index]
+        self._index += 1
+        return {"type": "websocket.receive", "text": message}
+
+    async def send_text(self, text: str) -> None:
+        self.sent += 1
+
+
+class MemoryRealtimeClient:
+    # rtclient の代わりに、送信メッセージを捨て、用意したメッセージを受信させる
+    def __init__(self, messages: Optional[list] = None) -> None:
+        self._messages = messages or []
+        self._index = 0
+        self.closed = False
+        self.sent = 0
+        # 事前にシリアライズしたペイロードは rtclient.ws.send_str で送られる
+        self.ws = self
+
+    def rewind(self) -> None:
+        self._index = 0
+        self.closed = False
+
+    async def send(self, message) -> None:
+        self.sent += 1
+
+    async def send_str(self, payload: str) -> None:
+        self.sent += 1
+
+    async def send_audio_buffer_to_realtime_api(self, audio_data: str) -> None:
+        self.sent += 1
+
+    async def recv(self):
+        if self._index >= len(self._messages):
+            self.closed = True
+            return None
+        message = self._messages[self._index]
+        self._index += 1
+        if self._index >= len(self._messages):
+            self.closed = True
+        return message
+
+    async def rtclient_close(self) -> None:
+        pass
+
+    async def recover(self) -> None:
+        pass
+
+    async def ping(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+def run_async(coroutine_function: Callable[[], object]) -> Callable[[], None]:
+    loop = asyncio.new_event_loop()
+    def run() -> None:
+        loop.run_until_complete(coroutine_function())
+    return run
+
+
+# microservices
+@case("acs_inbound_frame", "microservices")
+def ms_acs_inbound_frame():
+    from websocket import WebSocket
+    messages = [acs_audio_message() for _ in range(BATCH)]
+    fake_websocket = MemoryWebSocket(messages)
+    ws = WebSocket(fake_websocket, "bench", MemoryRealtimeClient())
+    async def run():
+        fake_websocket.rewind()
+        await ws.transfer_acs_to_realtime_api_until_disconnect()
+    return BATCH, run_async(run)
+
+@case("acs_outbound_envelope", "microservices")
+def ms_acs_outbound_envelope():
+    from websocket import WebSocket
+    ws = WebSocket(MemoryWebSocket(), "bench", MemoryRealtimeClient())
+    audio = audio_base64()
+    async def run():
+        for _ in range(BATCH):
+            await ws.send_text_to_acs(audio)
+    return BATCH, run_async(run)
+
+@case("transcript_segmentation", "microservices")
+def ms_transcript_segmentation():
+    from realtime import Realtime
+    # 接続は不要なため __init__ を通さずに生成する
+    realtime = Realtime.__new__(Realtime)
+    realtime._transcript_buffer = ""
+    deltas = TRANSCRIPT_DELTAS * (BATCH // len(TRANSCRIPT_DELTAS))
+    def run():
+        for delta in deltas:
+            realtime._output_complete_message(delta)
+    return len(deltas), run
+
+@case("eventgrid_from_dict", "microservices")
+def ms_eventgrid_from_dict():
+    from azure.eventgrid import EventGridEvent
+    batch = incoming_call_batch(100)
+    def run():
+        for event_dict in batch:
+            EventGridEvent.from_dict(event_dict)
+    return len(batch), run
+
+@case("cloudevent_from_dict", "microservices")
+def ms_cloudevent_from_dict():
+    from azure.core.messaging import CloudEvent
+    batch = callback_batch(100)
+    def run():
+        for event_dict in batch:
+            CloudEvent.from_dict(event_dict)
+    return len(batch), run
+
+@case("callback_dispatch", "microservices")
+def ms_callback_dispatch():
+    from callback_dispatcher import CallbackDispatcher
+    dispatcher = CallbackDispatcher()
+    @dispatcher.on("Microsoft.Communication.ContinuousDtmfRecognitionToneReceived")
+    async def on_tone(event, dependencies):
+        pass
+    app_state = SimpleNamespace()
+    batch = callback_batch(BATCH)
+    async def run():
+        for event_dict in batch:
+            await dispatcher.dispatch(app_state, "bench", event_dict)
+    return len(batch), run_async(run)
+
+@case("conversation_state_create_update", "microservices")
+def ms_conversation_state():
+    from state_manager import ConversationStateManager
+    manager = ConversationStateManager()
+    call_ids = [str(uuid.uuid4()) for _ in range(BATCH)]
+    def run():
+        for call_id in call_ids:
+            manager.create(call_id)
+            manager.update(call_id, current_role = "RoleA", job_id = call_id, caller_id = "+810000000000")
+            manager.delete(call_id)
+    return len(call_ids), run
+
+@case("role_profile_lookup", "microservices")
+def ms_role_profile_lookup():
+    from role_profiles import role_profiles
+    roles = ROLES * (BATCH // len(ROLES))
+    def run():
+        for role in roles:
+            role_profiles.get(role)
+    return len(roles), run
+
+@case("response_create_message", "microservices")
+def ms_response_create_message():
+    # ロール切り替え時の response.create 送信 (キャッシュ済みペイロードの取得と送信)
+    from realtime import Realtime
+    from role_profiles import role_profiles
+    realtime = Realtime.__new__(Realtime)
+    realtime._rtclient = MemoryRealtimeClient()
+    async def run():
+        for role in ROLES:
+            await realtime._send_payload(role_profiles.get(role).response_create_payload)
+    return len(ROLES), run_async(run)
+
+
+# single-app
+@case("acs_inbound_frame", "single-app")
+def sa_acs_inbound_frame():
+    from conversation_manager import process_websocket_message_async
+    messages = [acs_audio_message() for _ in range(BATCH)]
+    conversation_state = {"gpt_client": MemoryRealtimeClient()}
+    async def run():
+        for message in messages:
+            await process_websocket_message_async("bench", message, conversation_state)
+    return len(messages), run_async(run)
+
+@case("acs_outbound_envelope", "single-app")
+def sa_acs_outbound_envelope():
+    from conversation_manager import receive_audio_for_outbound
+    conversation_state = {"websocket": MemoryWebSocket()}
+    audio = os.urandom(FRAME_BYTES)
+    async def run():
+        for _ in range(BATCH):
+            await receive_audio_for_outbound("bench", audio, conversation_state)
+    return BATCH, run_async(run)
+
+@case("realtime_receive", "single-app")
+def sa_realtime_receive():
+    # 音声と文字起こしの delta を交互に受信し、ACS への送信と文の区切り判定まで行う
+    from conversation_manager import receive_messages
+    audio = audio_base64()
+    messages = []
+    for delta in TRANSCRIPT_DELTAS * (BATCH // (2 * len(TRANSCRIPT_DELTAS))):
+        messages.append(SimpleNamespace(type = "response.audio.delta", delta = audio))
+        messages.append(SimpleNamespace(type = "response.audio_transcript.delta", delta = delta))
+    gpt_client = MemoryRealtimeClient(messages)
+    conversation_state = {"gpt_client": gpt_client, "websocket": MemoryWebSocket()}
+    async def run():
+        gpt_client.rewind()
+        await receive_messages("bench", conversation_state)
+    return len(messages), run_async(run)
+
+@case("eventgrid_from_dict", "single-app")
+def sa_eventgrid_from_dict():
+    return ms_eventgrid_from_dict()
+
+@case("cloudevent_from_dict", "single-app")
+def sa_cloudevent_from_dict():
+    return ms_cloudevent_from_dict()
+
+@case("callback_dispatch", "single-app")
+def sa_callback_dispatch():
+    from call_handler import dispatch_callback_event
+    request = SimpleNamespace(app = SimpleNamespace(state = SimpleNamespace()))
+    # ログ出力だけを行うハンドラで、振り分け自体のコストを計測する
+    batch = [dict(event, type = "Microsoft.Communication.RouterJobQueued") for event in callback_batch(BATCH)]
+    async def run():
+        for event_dict in batch:
+            await dispatch_callback_event("bench", event_dict, request)
+    return len(batch), run_async(run)
+
+@case("role_profile_lookup", "single-app")
+def sa_role_profile_lookup():
+    return ms_role_profile_lookup()
+
+@case("response_create_message", "single-app")
+def sa_response_create_message():
+    from conversation_manager import send_role_profile
+    gpt_client = MemoryRealtimeClient()
+    async def run():
+        for role in ROLES:
+            await send_role_profile(gpt_client, role)
+    return len(ROLES), run_async(run)
+
+
+def measure(setup: Setup, repeat: int, min_seconds: float) -> Dict[str, float]:
+    operations, function = setup()
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    # autorange は 0.2 秒以上になる回数を返すので、min_seconds まで回数を増やす
+    if elapsed < min_seconds:
+        number = max(1, int(number * min_seconds / max(elapsed, 1e-9)))
+    timings = timer.repeat(repeat = repeat, number = number)
+    best = min(timings) / number / operations
+    median = sorted(timings)[len(timings) // 2] / number / operations
+    return {"ns_per_op": best * 1e9, "median_ns_per_op": median * 1e9, "operations": operations * number}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description = "Run the hot-path micro-benchmarks of one app")
+    parser.add_argument("--app", choices = sorted(APP_DIRS), required = True)
+    parser.add_argument("--filter", default = "", help = "only run cases whose name contains this text")
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--min-seconds", type = float, default = 0.2)
+    # アプリのログは標準出力に出るため、結果はファイルに書く
+    parser.add_argument("--output", type = Path, required = True)
+    args = parser.parse_args(argv)
+
+    app_dir = APP_DIRS[args.app]
+    os.chdir(app_dir)
+    sys.path.insert(0, str(app_dir))
+
+    results: Dict[str, dict] = {}
+    for (app, name), setup in CASES.items():
+        if app != args.app or args.filter not in name:
+            continue
+        try:
+            results[name] = measure(setup, args.repeat, args.min_seconds)
+        except ImportError as e:
+            # 依存パッケージがない環境では該当ケースのみスキップする
+            results[name] = {"skipped": f"missing dependency: {e.name}"}
+    args.output.write_text(json.dumps(results))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
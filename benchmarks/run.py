@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+BASELINE_PATH = BENCHMARK_DIR / "baseline.json"
+APPS = ["microservices", "single-app"]
+
+
+def run_app(app: str, case_filter: str, repeat: int, min_seconds: float) -> Dict[str, dict]:
+    # 両アプリは同名のモジュールを持つため、アプリごとに別プロセスで計測する
+    env = dict(os.environ, LOG_LEVEL = "ERROR", TRACE_ENABLED = "false")
+    with tempfile.TemporaryDirectory() as directory:
+        output = Path(directory) / "results.json"
+        subprocess.run(
+            [
+                sys.executable, str(BENCHMARK_DIR / "cases.py"),
+                "--app", app,
+                "--filter", case_filter,
+                "--repeat", str(repeat),
+                "--min-seconds", str(min_seconds),
+                "--output", str(output),
+            ],
+            env = env,
+            stdout = subprocess.DEVNULL,
+            check = True,
+        )
+        return json.loads(output.read_text())
+
+
+def load_baseline(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def compare(app: str, results: Dict[str, dict], baseline: dict, threshold_percent: float) -> List[str]:
+    # threshold_percent を超えて遅くなったケースの一覧を返す
+    regressions = []
+    baseline_cases = baseline.get("results", {}).get(app, {})
+    for name, result in results.items():
+        if "skipped" in result:
+            print(f"  {name:34s} {'skipped':>12s}  {result['skipped']}")
+            continue
+        current = result["ns_per_op"]
+        before = baseline_cases.get(name, {}).get("ns_per_op")
+        if before is None:
+            print(f"  {name:34s} {current:10.1f}ns  (no baseline)")
+            continue
+        change = (current - before) / before * 100
+        marker = ""
+        if change > threshold_percent:
+            marker = "  REGRESSION"
+            regressions.append(f"{app}/{name}: {before:.1f}ns -> {current:.1f}ns ({change:+.1f}%)")
+        print(f"  {name:34s} {current:10.1f}ns  {before:10.1f}ns  {change:+7.1f}%{marker}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description = "Run the hot-path micro-benchmarks and compare them with the baseline")
+    parser.add_argument("--app", choices = APPS + ["all"], default = "all")
+    parser.add_argument("--filter", default = "", help = "only run cases whose name contains this text")
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--min-seconds", type = float, default = 0.2)
+    parser.add_argument("--threshold", type = float, default = 15.0, help = "allowed slowdown in percent")
+    parser.add_argument("--baseline", type = Path, default = BASELINE_PATH)
+    parser.add_argument("--update-baseline", action = "store_true", help = "store the results as the new baseline")
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.baseline)
+    if baseline and baseline.get("machine") != platform.machine():
+        print(f"Baseline was recorded on {baseline.get('machine')}, comparisons may not be meaningful", file = sys.stderr)
+
+    apps = APPS if args.app == "all" else [args.app]
+    all_results: Dict[str, Dict[str, dict]] = {}
+    regressions: List[str] = []
+    for app in apps:
+        print(f"== {app}")
+        results = run_app(app, args.filter, args.repeat, args.min_seconds)
+        all_results[app] = results
+        regressions.extend(compare(app, results, baseline, args.threshold))
+
+    if args.update_baseline:
+        merged = baseline.get("results", {})
+        for app, results in all_results.items():
+            cases = merged.setdefault(app, {})
+            cases.update({name: result for name, result in results.items() if "skipped" not in result})
+        args.baseline.write_text(json.dumps({
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": merged,
+        }, indent = 2, sort_keys = True) + "\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file = sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
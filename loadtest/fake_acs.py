@@ -0,0 +1,234 @@
+import base64
+import re
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+from aiohttp import web
+
+# ACS Call Automation / Job Router の REST API を最小限だけ模倣するローカルサーバー。
+# アプリの ACS_CONNECTION_STRING をこのサーバーに向けることで、Azure なしで負荷試験を行う。
+
+@dataclass
+class AnsweredCall:
+    call_connection_id: str
+    incoming_call_context: str
+    callback_uri: str
+    transport_url: str
+
+
+@dataclass
+class FakeJob:
+    id: str
+    body: dict
+    status: str = "queued"
+    assignments: Dict[str, dict] = field(default_factory = dict)
+    offer: Optional[dict] = None
+    worker_id: Optional[str] = None
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeAcsServer:
+    def __init__(
+        self,
+        on_answer: Callable[[AnsweredCall], Awaitable[None]],
+        host: str = "127.0.0.1",
+        port: int = 0
+    ) -> None:
+        self._on_answer = on_answer
+        self._host = host
+        self._port = port
+        self._runner: Optional[web.AppRunner] = None
+        self._resources: Dict[str, Dict[str, dict]] = {
+            "distributionPolicies": {},
+            "queues": {},
+            "workers": {},
+        }
+        self._jobs: Dict[str, FakeJob] = {}
+        self.requests = 0
+        self.answered = 0
+
+    @property
+    def connection_string(self) -> str:
+        access_key = base64.b64encode(b"load-test-access-key-0123456789ab").decode("ascii")
+        return f"endpoint=http://{self._host}:{self._port}/;accesskey={access_key}"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app, access_log = None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self._host, self._port)
+        await site.start()
+        self._port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        path = request.path
+        body = await request.json() if request.can_read_body else {}
+
+        if path.startswith("/calling/"):
+            return await self._handle_calling(request.method, path, body)
+        if path.startswith("/routing/"):
+            return self._handle_routing(request.method, path, body)
+        return web.json_response({}, status = 404)
+
+    # Call Automation
+    async def _handle_calling(self, method: str, path: str, body: dict) -> web.Response:
+        if path.endswith("callConnections:answer"):
+            return await self._answer(body)
+        if method == "DELETE":
+            return web.Response(status = 204)
+        if path.endswith(":transferToParticipant") or path.endswith(":transfer"):
+            return web.json_response({"operationContext": body.get("operationContext")}, status = 202)
+        return web.json_response({}, status = 200)
+
+    async def _answer(self, body: dict) -> web.Response:
+        call_connection_id = str(uuid.uuid4())
+        media_streaming = body.get("mediaStreamingOptions") or body.get("mediaStreamingConfiguration") or {}
+        answered_call = AnsweredCall(
+            call_connection_id = call_connection_id,
+            incoming_call_context = body.get("incomingCallContext", ""),
+            callback_uri = body.get("callbackUri", ""),
+            transport_url = media_streaming.get("transportUrl", ""),
+        )
+        self.answered += 1
+        await self._on_answer(answered_call)
+        return web.json_response({
+            "callConnectionId": call_connection_id,
+            "serverCallId": str(uuid.uuid4()),
+            "targets": [],
+            "callConnectionState": "connecting",
+            "callbackUri": answered_call.callback_uri,
+        })
+
+    # Job Router
+    def _handle_routing(self, method: str, path: str, body: dict) -> web.Response:
+        match = re.fullmatch(r"/routing/workers/([^/]+)/offers/([^/:]+):accept", path)
+        if match:
+            return self._accept_offer(match.group(1), match.group(2))
+        match = re.fullmatch(r"/routing/jobs/([^/]+)/assignments/([^/:]+):(complete|close)", path)
+        if match:
+            job = self._jobs.get(match.group(1))
+            if job and match.group(3) == "close":
+                job.status = "closed"
+            return web.json_response({})
+        match = re.fullmatch(r"/routing/jobs/([^/:]+):cancel", path)
+        if match:
+            job = self._jobs.get(match.group(1))
+            if job:
+                job.status = "cancelled"
+                job.offer = None
+            return web.json_response({})
+        match = re.fullmatch(r"/routing/jobs/([^/]+)", path)
+        if match:
+            return self._job(method, match.group(1), body)
+        if path == "/routing/jobs":
+            return web.json_response({"value": [self._job_json(job) for job in self._jobs.values()]})
+        match = re.fullmatch(r"/routing/(distributionPolicies|queues|workers)/([^/]+)", path)
+        if match:
+            return self._resource(method, match.group(1), match.group(2), body)
+        if path in ("/routing/workers", "/routing/queues", "/routing/distributionPolicies"):
+            kind = path.rsplit("/", 1)[1]
+            return web.json_response({"value": [self._resource_json(kind, item) for item in self._resources[kind].values()]})
+        return web.json_response({}, status = 404)
+
+    def _resource(self, method: str, kind: str, resource_id: str, body: dict) -> web.Response:
+        resources = self._resources[kind]
+        if method == "GET":
+            if resource_id not in resources:
+                return web.json_response({"error": {"code": "NotFound", "message": "not found"}}, status = 404)
+            return web.json_response(self._resource_json(kind, resources[resource_id]))
+        if method == "DELETE":
+            resources.pop(resource_id, None)
+            return web.Response(status = 204)
+        resource = resources.setdefault(resource_id, {"id": resource_id})
+        resource.update(body)
+        resource["id"] = resource_id
+        return web.json_response(self._resource_json(kind, resource), status = 200)
+
+    def _resource_json(self, kind: str, resource: dict) -> dict:
+        result = dict(resource, etag = "etag")
+        if kind == "workers":
+            offers = [
+                job.offer for job in self._jobs.values()
+                if job.offer and job.worker_id == resource["id"]
+            ]
+            result.update({
+                "state": "active",
+                "offers": offers,
+                "assignedJobs": [],
+                "loadRatio": 0,
+                "availableForOffers": resource.get("availableForOffers", True),
+            })
+        return result
+
+    def _job(self, method: str, job_id: str, body: dict) -> web.Response:
+        if method == "GET":
+            job = self._jobs.get(job_id)
+            if job is None:
+                return web.json_response({"error": {"code": "NotFound", "message": "not found"}}, status = 404)
+            return web.json_response(self._job_json(job))
+        if method == "DELETE":
+            self._jobs.pop(job_id, None)
+            return web.Response(status = 204)
+
+        job = self._jobs.get(job_id)
+        if job is None:
+            job = FakeJob(id = job_id, body = body)
+            self._jobs[job_id] = job
+            self._offer(job)
+        else:
+            job.body.update(body)
+        return web.json_response(self._job_json(job))
+
+    def _offer(self, job: FakeJob) -> None:
+        # Role ラベルが一致するワーカー (なければ任意のワーカー) にオファーを出す
+        selectors: List[dict] = job.body.get("requestedWorkerSelectors") or []
+        role = next((selector.get("value") for selector in selectors if selector.get("key") == "Role"), None)
+        workers = list(self._resources["workers"].values())
+        worker = next((w for w in workers if (w.get("labels") or {}).get("Role") == role), None)
+        if worker is None and workers:
+            worker = workers[0]
+        if worker is None:
+            return
+        job.worker_id = worker["id"]
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds = 60)
+        job.offer = {
+            "offerId": str(uuid.uuid4()),
+            "jobId": job.id,
+            "capacityCost": 1,
+            "offeredAt": _now(),
+            "expiresAt": expires_at.isoformat(),
+        }
+
+    def _accept_offer(self, worker_id: str, offer_id: str) -> web.Response:
+        job = next((job for job in self._jobs.values() if job.offer and job.offer["offerId"] == offer_id), None)
+        if job is None:
+            return web.json_response({"error": {"code": "NotFound", "message": "offer not found"}}, status = 404)
+        assignment_id = str(uuid.uuid4())
+        job.assignments[assignment_id] = {
+            "assignmentId": assignment_id,
+            "workerId": worker_id,
+            "assignedAt": _now(),
+        }
+        job.status = "assigned"
+        job.offer = None
+        return web.json_response({"assignmentId": assignment_id, "jobId": job.id, "workerId": worker_id})
+
+    def _job_json(self, job: FakeJob) -> dict:
+        return dict(job.body, id = job.id, status = job.status, assignments = job.assignments, etag = "etag")
+
+    async def __aenter__(self) -> "FakeAcsServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
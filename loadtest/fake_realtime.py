@@ -0,0 +1,117 @@
+import asyncio
+import base64
+import json
+import uuid
+from typing import Optional
+from aiohttp import web, WSMsgType
+
+# realtime API のプロトコルを話すローカルの WebSocket サーバー。
+# input_audio_buffer.append で受け取った音声をそのまま response.audio.delta として返すため、
+# シミュレーター側で ACS -> アプリ -> realtime -> アプリ -> ACS の往復レイテンシを計測できる。
+
+class FakeRealtimeServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, greeting_frames: int = 25) -> None:
+        self._host = host
+        self._port = port
+        # response.create を受け取った時に返す無音フレーム数 (20ms 単位)
+        self._greeting_frames = greeting_frames
+        self._runner: Optional[web.AppRunner] = None
+        self.connections = 0
+        self.active_connections = 0
+        self.messages_received = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://{self._host}:{self._port}"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_route("GET", "/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app, access_log = None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self._host, self._port)
+        await site.start()
+        self._port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connections += 1
+        self.active_connections += 1
+        session = RealtimeSession(ws, self._greeting_frames)
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                self.messages_received += 1
+                await session.handle(json.loads(msg.data))
+        finally:
+            session.close()
+            self.active_connections -= 1
+        return ws
+
+    async def __aenter__(self) -> "FakeRealtimeServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+
+class RealtimeSession:
+    FRAME_BYTES = 960  # PCM 24kHz 16bit mono の 20ms
+
+    def __init__(self, ws: web.WebSocketResponse, greeting_frames: int) -> None:
+        self._ws = ws
+        self._greeting_frames = greeting_frames
+        self._response_id = f"resp_{uuid.uuid4().hex}"
+        self._item_id = f"item_{uuid.uuid4().hex}"
+        self._greeting_task: Optional[asyncio.Task] = None
+
+    async def handle(self, message: dict) -> None:
+        message_type = message.get("type")
+        if message_type == "input_audio_buffer.append":
+            await self.send_audio_delta(message["audio"])
+        elif message_type == "response.create":
+            self._greeting_task = asyncio.create_task(self._send_greeting())
+
+    async def send_audio_delta(self, audio_base64: str) -> None:
+        await self._ws.send_str(json.dumps({
+            "type": "response.audio.delta",
+            "event_id": f"event_{uuid.uuid4().hex}",
+            "response_id": self._response_id,
+            "item_id": self._item_id,
+            "output_index": 0,
+            "content_index": 0,
+            "delta": audio_base64,
+        }))
+
+    async def send_transcript_delta(self, text: str) -> None:
+        await self._ws.send_str(json.dumps({
+            "type": "response.audio_transcript.delta",
+            "event_id": f"event_{uuid.uuid4().hex}",
+            "response_id": self._response_id,
+            "item_id": self._item_id,
+            "output_index": 0,
+            "content_index": 0,
+            "delta": text,
+        }))
+
+    async def _send_greeting(self) -> None:
+        # 実際のモデルと同様、実時間より速いバーストで音声を返す
+        silence = base64.b64encode(bytes(self.FRAME_BYTES)).decode("ascii")
+        try:
+            for _ in range(self._greeting_frames):
+                await self.send_audio_delta(silence)
+                await asyncio.sleep(0.005)
+            await self.send_transcript_delta("Load test greeting.")
+        except (ConnectionResetError, RuntimeError):
+            pass
+
+    def close(self) -> None:
+        if self._greeting_task:
+            self._greeting_task.cancel()
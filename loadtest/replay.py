@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from run import REPO_ROOT, APPS, LoadTest, LoadTestResult
+from simulated_call import CallScript, ScriptEvent
+
+# アプリの trace_recorder で記録したトレースを、ACS 側の入力 (Webhook とメディア) として再生する。
+# 同じトレースを 2 つのビルドに流し、レイテンシと CPU 使用量を比較する。
+
+# 比較対象の指標と、値が大きいほど悪いかどうか
+COMPARED_METRICS: List[Tuple[str, bool]] = [
+    ("relay_latency_p50_ms", True),
+    ("relay_latency_p99_ms", True),
+    ("webhook_latency_p50_ms", True),
+    ("webhook_latency_p99_ms", True),
+    ("loop_lag_p99_ms", True),
+    ("cpu_percent_per_call", True),
+    ("calls_sustained", False),
+]
+
+
+def load_trace(path: Path) -> CallScript:
+    # 応答完了 (answered) を 0 秒とした CallScript に変換する
+    entries = []
+    with gzip.open(path, "rt", encoding = "utf-8") as trace_file:
+        for line in trace_file:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    if not entries or entries[0].get("kind") != "trace":
+        raise ValueError(f"{path} is not a call trace")
+
+    answered_at = next((entry["t"] for entry in entries if entry["kind"] == "answered"), 0.0)
+    caller_id = "+810000000000"
+    events: List[ScriptEvent] = []
+    frames: List[Tuple[float, Optional[str], int]] = []
+    media_offset: Optional[float] = None
+    last_offset = 0.0
+    for entry in entries:
+        offset = max(0.0, entry["t"] - answered_at)
+        kind = entry["kind"]
+        if kind == "incoming":
+            source = entry["event"].get("data", {}).get("from", {})
+            caller_id = source.get("phoneNumber", {}).get("value") or caller_id
+        elif kind == "webhook":
+            event = entry["event"]
+            events.append(ScriptEvent(offset, event.get("type", ""), event.get("data") or {}, event.get("id")))
+        elif kind == "media_connected" and media_offset is None:
+            media_offset = offset
+        elif kind == "acs_audio":
+            frames.append((offset, entry.get("audio"), entry.get("bytes", 0)))
+        else:
+            continue
+        last_offset = max(last_offset, offset)
+
+    return CallScript(
+        events = events,
+        media_seconds = last_offset,
+        frames = frames,
+        caller_id = caller_id,
+        media_offset = media_offset or 0.0,
+    )
+
+
+def load_traces(paths: List[Path]) -> List[CallScript]:
+    files: List[Path] = []
+    for path in paths:
+        files.extend(sorted(path.glob("*.jsonl.gz")) if path.is_dir() else [path])
+    scripts = []
+    for file in files:
+        try:
+            scripts.append(load_trace(file))
+        except (OSError, ValueError, KeyError, json.JSONDecodeError) as e:
+            print(f"Skipping {file}: {e}", file = sys.stderr)
+    return scripts
+
+
+def parse_speed(value: str) -> float:
+    # "max" は待ち時間なしで全イベントを送る
+    if value == "max":
+        return float("inf")
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive")
+    return speed
+
+
+def compare(baseline: LoadTestResult, candidate: LoadTestResult, threshold_percent: float) -> List[str]:
+    # threshold_percent を超えて悪化した指標の一覧を返す
+    regressions = []
+    print(f"{'metric':28s} {'baseline':>12s} {'candidate':>12s} {'change':>9s}")
+    for name, higher_is_worse in COMPARED_METRICS:
+        before = getattr(baseline, name)
+        after = getattr(candidate, name)
+        if before is None or after is None:
+            print(f"{name:28s} {str(before):>12s} {str(after):>12s}")
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{name:28s} {before:12.3f} {after:12.3f} {change:+8.1f}%")
+        worse = change > threshold_percent if higher_is_worse else change < -threshold_percent
+        if worse:
+            regressions.append(f"{name}: {before:.3f} -> {after:.3f} ({change:+.1f}%)")
+    return regressions
+
+
+async def replay(
+    app_name: str,
+    root: Path,
+    scripts: List[CallScript],
+    calls: int,
+    speed: float,
+    batch_size: int
+) -> LoadTestResult:
+    load_test = LoadTest(
+        app_name = app_name,
+        calls = calls,
+        scripts = scripts,
+        batch_size = batch_size,
+        speed = speed,
+        root = root,
+    )
+    result = await load_test.run()
+    result.extra["speed"] = speed
+    result.extra["root"] = str(root)
+    return result
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = "Replay recorded call traces against one or two builds")
+    parser.add_argument("traces", nargs = "+", type = Path, help = "trace files or directories")
+    parser.add_argument("--app", choices = sorted(APPS), default = "microservices")
+    parser.add_argument("--baseline", type = Path, default = REPO_ROOT, help = "repository checkout of the baseline build")
+    parser.add_argument("--candidate", type = Path, default = None, help = "repository checkout of the build to compare")
+    parser.add_argument("--speed", type = parse_speed, default = 1.0, help = "replay speed factor, or 'max'")
+    parser.add_argument("--calls", type = int, default = None, help = "concurrent calls (default: one per trace)")
+    parser.add_argument("--batch-size", type = int, default = 1, help = "IncomingCall events per Event Grid POST")
+    parser.add_argument("--threshold", type = float, default = 10.0, help = "allowed regression in percent")
+    parser.add_argument("--json", type = Path, default = None, help = "write the results as JSON")
+    return parser.parse_args(argv)
+
+
+async def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    scripts = load_traces(args.traces)
+    if not scripts:
+        print("No traces to replay", file = sys.stderr)
+        return 2
+    calls = args.calls or len(scripts)
+
+    results: Dict[str, LoadTestResult] = {}
+    results["baseline"] = await replay(args.app, args.baseline, scripts, calls, args.speed, args.batch_size)
+    results["baseline"].print_report()
+    if args.candidate is None:
+        regressions = []
+    else:
+        results["candidate"] = await replay(args.app, args.candidate, scripts, calls, args.speed, args.batch_size)
+        results["candidate"].print_report()
+        regressions = compare(results["baseline"], results["candidate"], args.threshold)
+
+    if args.json:
+        args.json.write_text(json.dumps({name: result.__dict__ for name, result in results.items()}, indent = 2))
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file = sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
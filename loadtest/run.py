@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+import aiohttp
+from fake_acs import AnsweredCall, FakeAcsServer
+from fake_realtime import FakeRealtimeServer
+from simulated_call import CallScript, SimulatedCall, default_script, incoming_call_event
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+APPS = {
+    "microservices": {"dir": "microservices", "module": "app:app"},
+    "single-app": {"dir": "single-app-infra", "module": "main:app"},
+}
+
+
+def percentile(values: List[float], ratio: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    # /proc/<pid>/stat の utime + stime (Linux のみ)
+    try:
+        with open(f"/proc/{pid}/stat") as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        return (int(fields[11]) + int(fields[12])) / ticks
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class AppProcess:
+    # 負荷をかける対象のアプリを、偽の ACS / realtime に向けた環境変数で起動する
+    def __init__(
+        self,
+        app_name: str,
+        port: int,
+        acs_connection_string: str,
+        realtime_url: str,
+        root: Path = REPO_ROOT
+    ) -> None:
+        self._app = APPS[app_name]
+        self._app_name = app_name
+        self._root = root
+        self.port = port
+        self._env = dict(os.environ)
+        self._env.update({
+            "ACS_CONNECTION_STRING": acs_connection_string,
+            "AZURE_OPENAI_SERVICE_ENDPOINT": realtime_url,
+            "AZURE_OPENAI_DEPLOYMENT_NAME": "load-test",
+            "AZURE_OPENAI_SERVICE_KEY": "load-test",
+            "LOG_LEVEL": os.environ.get("LOG_LEVEL", "warning"),
+        })
+        if app_name == "microservices":
+            self._env["CALLBACK_BASEURL"] = f"http://127.0.0.1:{port}/api/callbacks"
+        else:
+            self._env["CALLBACK_URI_HOST"] = f"http://127.0.0.1:{port}"
+        self._process: Optional[subprocess.Popen] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def pid(self) -> int:
+        return self._process.pid
+
+    def start(self) -> None:
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", self._app["module"], "--port", str(self.port), "--log-level", "warning"],
+            cwd = self._root / self._app["dir"],
+            env = self._env,
+        )
+
+    async def wait_ready(self, session: aiohttp.ClientSession, timeout: float = 60.0) -> float:
+        started_at = time.monotonic()
+        while time.monotonic() - started_at < timeout:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"{self._app_name} exited with code {self._process.returncode}")
+            try:
+                async with session.get(self.base_url + "/") as response:
+                    if response.status == 200:
+                        return time.monotonic() - started_at
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+        raise TimeoutError(f"{self._app_name} did not become ready within {timeout} seconds")
+
+    def stop(self) -> None:
+        if self._process and self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout = 15)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+
+
+@dataclass
+class LoadTestResult:
+    app: str
+    calls_requested: int
+    calls_answered: int
+    calls_sustained: int
+    duration_seconds: float
+    cpu_seconds: Optional[float]
+    cpu_percent_per_call: Optional[float]
+    loop_lag_p50_ms: Optional[float]
+    loop_lag_p99_ms: Optional[float]
+    loop_lag_max_ms: Optional[float]
+    relay_latency_p50_ms: Optional[float]
+    relay_latency_p99_ms: Optional[float]
+    webhook_latency_p50_ms: Optional[float]
+    webhook_latency_p99_ms: Optional[float]
+    frames_sent: int
+    frames_received: int
+    webhook_errors: int
+    media_errors: int
+    extra: Dict[str, float] = field(default_factory = dict)
+
+    def print_report(self) -> None:
+        print(f"== load test: {self.app}")
+        for key, value in self.__dict__.items():
+            if key in ("app", "extra"):
+                continue
+            if isinstance(value, float):
+                value = f"{value:.3f}"
+            print(f"  {key:28s} {value}")
+        for key, value in self.extra.items():
+            print(f"  {key:28s} {value}")
+
+
+def _ms(value: Optional[float]) -> Optional[float]:
+    return None if value is None else value * 1000
+
+
+class LoadTest:
+    def __init__(
+        self,
+        app_name: str,
+        calls: int,
+        scripts: List[CallScript],
+        batch_size: int = 1,
+        ramp_seconds: float = 0.0,
+        speed: float = 1.0,
+        app_port: Optional[int] = None,
+        root: Path = REPO_ROOT
+    ) -> None:
+        self._app_name = app_name
+        self._calls = calls
+        # i 番目の通話は scripts[i % len(scripts)] のシナリオで動かす
+        self._call_scripts = scripts
+        self._root = root
+        self._batch_size = batch_size
+        self._ramp_seconds = ramp_seconds
+        self._speed = speed
+        self._app_port = app_port or free_port()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._simulated_calls: List[SimulatedCall] = []
+        self._call_tasks: List[asyncio.Task] = []
+        self._scripts: Dict[str, CallScript] = {}
+
+    def script_for(self, incoming_call_context: str) -> CallScript:
+        return self._scripts.get(incoming_call_context, self._call_scripts[0])
+
+    async def _on_answer(self, answered_call: AnsweredCall) -> None:
+        # 応答レスポンスを遅らせないよう、通話のシミュレーションは別タスクで開始する
+        simulated_call = SimulatedCall(answered_call, self.script_for(answered_call.incoming_call_context), self._session, self._speed)
+        self._simulated_calls.append(simulated_call)
+        self._call_tasks.append(asyncio.create_task(simulated_call.run()))
+
+    async def run(self) -> LoadTestResult:
+        timeout = aiohttp.ClientTimeout(total = None, sock_read = None)
+        connector = aiohttp.TCPConnector(limit = 0)
+        async with aiohttp.ClientSession(timeout = timeout, connector = connector) as session:
+            self._session = session
+            async with FakeRealtimeServer() as realtime, FakeAcsServer(self._on_answer) as acs:
+                app = AppProcess(self._app_name, self._app_port, acs.connection_string, realtime.url, self._root)
+                app.start()
+                try:
+                    startup_seconds = await app.wait_ready(session)
+                    return await self._run_against(app, session, acs, realtime, startup_seconds)
+                finally:
+                    app.stop()
+
+    async def _run_against(
+        self,
+        app: AppProcess,
+        session: aiohttp.ClientSession,
+        acs: FakeAcsServer,
+        realtime: FakeRealtimeServer,
+        startup_seconds: float
+    ) -> LoadTestResult:
+        lag_samples: List[float] = []
+        stop_probe = asyncio.Event()
+        probe = asyncio.create_task(self._probe_loop_lag(app, session, lag_samples, stop_probe))
+
+        cpu_started = process_cpu_seconds(app.pid)
+        started_at = time.monotonic()
+        await self._post_incoming_calls(app, session)
+
+        # 全通話の応答を待ってから、全通話のシナリオ終了を待つ
+        answer_deadline = time.monotonic() + 30 + self._calls
+        while len(self._call_tasks) < self._calls and time.monotonic() < answer_deadline:
+            await asyncio.sleep(0.1)
+        if self._call_tasks:
+            await asyncio.gather(*self._call_tasks, return_exceptions = True)
+        duration = time.monotonic() - started_at
+        cpu_finished = process_cpu_seconds(app.pid)
+
+        stop_probe.set()
+        await probe
+
+        relay_latencies = [latency for call in self._simulated_calls for latency in call.stats.relay_latencies]
+        webhook_latencies = [latency for call in self._simulated_calls for latency in call.stats.webhook_latencies]
+        cpu_seconds = None if cpu_started is None or cpu_finished is None else cpu_finished - cpu_started
+        answered = len(self._simulated_calls)
+        return LoadTestResult(
+            app = self._app_name,
+            calls_requested = self._calls,
+            calls_answered = answered,
+            calls_sustained = sum(1 for call in self._simulated_calls if self._sustained(call)),
+            duration_seconds = duration,
+            cpu_seconds = cpu_seconds,
+            cpu_percent_per_call = None if cpu_seconds is None or not answered else cpu_seconds / duration / answered * 100,
+            loop_lag_p50_ms = _ms(percentile(lag_samples, 0.5)),
+            loop_lag_p99_ms = _ms(percentile(lag_samples, 0.99)),
+            loop_lag_max_ms = _ms(max(lag_samples) if lag_samples else None),
+            relay_latency_p50_ms = _ms(percentile(relay_latencies, 0.5)),
+            relay_latency_p99_ms = _ms(percentile(relay_latencies, 0.99)),
+            webhook_latency_p50_ms = _ms(percentile(webhook_latencies, 0.5)),
+            webhook_latency_p99_ms = _ms(percentile(webhook_latencies, 0.99)),
+            frames_sent = sum(call.stats.frames_sent for call in self._simulated_calls),
+            frames_received = sum(call.stats.frames_received for call in self._simulated_calls),
+            webhook_errors = sum(call.stats.webhook_errors for call in self._simulated_calls),
+            media_errors = sum(1 for call in self._simulated_calls if call.stats.media_error),
+            extra = {
+                "startup_seconds": round(startup_seconds, 3),
+                "realtime_connections": realtime.connections,
+                "acs_requests": acs.requests,
+            },
+        )
+
+    def _sustained(self, call: SimulatedCall) -> bool:
+        # メディアが最後まで接続され、終盤まで音声が返ってきていた通話
+        stats = call.stats
+        if stats.media_error or stats.media_connected_at is None or stats.last_frame_received_at is None:
+            return False
+        script = call.script
+        media_end = stats.media_connected_at + (script.media_seconds - script.media_offset) / self._speed
+        return stats.last_frame_received_at >= media_end - 2.0
+
+    async def _post_incoming_calls(self, app: AppProcess, session: aiohttp.ClientSession) -> None:
+        batches = [
+            list(range(start, min(start + self._batch_size, self._calls)))
+            for start in range(0, self._calls, self._batch_size)
+        ]
+        interval = self._ramp_seconds / len(batches) if batches and self._ramp_seconds else 0.0
+        posts = []
+        for batch in batches:
+            events = []
+            for index in batch:
+                script = self._call_scripts[index % len(self._call_scripts)]
+                incoming_call_context = f"load-test-{index}-{uuid.uuid4()}"
+                self._scripts[incoming_call_context] = script
+                events.append(incoming_call_event(script.caller_id, incoming_call_context))
+            posts.append(asyncio.create_task(self._post_batch(app, session, events)))
+            if interval:
+                await asyncio.sleep(interval)
+        await asyncio.gather(*posts)
+
+    async def _post_batch(self, app: AppProcess, session: aiohttp.ClientSession, events: List[dict]) -> None:
+        try:
+            async with session.post(app.base_url + "/api/incomingCall", json = events) as response:
+                await response.read()
+        except aiohttp.ClientError as e:
+            print(f"IncomingCall post failed: {e}", file = sys.stderr)
+
+    async def _probe_loop_lag(
+        self,
+        app: AppProcess,
+        session: aiohttp.ClientSession,
+        samples: List[float],
+        stop: asyncio.Event
+    ) -> None:
+        # 軽量なエンドポイントの応答時間をアプリのイベントループ遅延の近似値として使う
+        while not stop.is_set():
+            sent_at = time.perf_counter()
+            try:
+                async with session.get(app.base_url + "/") as response:
+                    await response.read()
+                samples.append(time.perf_counter() - sent_at)
+            except aiohttp.ClientError:
+                pass
+            try:
+                await asyncio.wait_for(stop.wait(), timeout = 0.2)
+            except asyncio.TimeoutError:
+                pass
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = "ACS Realtime API Call Center load test")
+    parser.add_argument("--app", choices = sorted(APPS), default = "microservices")
+    parser.add_argument("--calls", type = int, default = 10, help = "number of concurrent calls")
+    parser.add_argument("--duration", type = float, default = 30.0, help = "media seconds per call")
+    parser.add_argument("--batch-size", type = int, default = 1, help = "IncomingCall events per Event Grid POST")
+    parser.add_argument("--ramp", type = float, default = 0.0, help = "seconds over which calls are started")
+    parser.add_argument("--dtmf", action = "append", default = [], metavar = "SECONDS:TONE", help = "e.g. 5:one")
+    parser.add_argument("--port", type = int, default = None, help = "port for the application under test")
+    parser.add_argument("--json", type = Path, default = None, help = "write the result as JSON")
+    return parser.parse_args(argv)
+
+
+async def main(argv: Optional[List[str]] = None) -> LoadTestResult:
+    args = parse_args(argv)
+    dtmf_tones = []
+    for spec in args.dtmf:
+        offset, tone = spec.split(":", 1)
+        dtmf_tones.append((float(offset), tone))
+    load_test = LoadTest(
+        app_name = args.app,
+        calls = args.calls,
+        scripts = [default_script(args.duration, dtmf_tones)],
+        batch_size = args.batch_size,
+        ramp_seconds = args.ramp,
+        app_port = args.port,
+    )
+    result = await load_test.run()
+    result.print_report()
+    if args.json:
+        args.json.write_text(json.dumps(result.__dict__, indent = 2))
+    return result
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,225 @@
+import asyncio
+import base64
+import json
+import struct
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+import aiohttp
+from fake_acs import AnsweredCall
+
+FRAME_BYTES = 960  # PCM 24kHz 16bit mono の 20ms
+FRAME_SECONDS = 0.02
+# 往復レイテンシ計測用に音声フレームの先頭へ埋め込むマーカー (magic, seq, 送信時刻 ns)
+MARKER = b"LTST"
+MARKER_FORMAT = "<4sIQ"
+MARKER_SIZE = struct.calcsize(MARKER_FORMAT)
+
+
+@dataclass
+class ScriptEvent:
+    # 通話開始 (応答) からの経過秒数で送るコールバックイベント
+    offset: float
+    event_type: str
+    data: dict = field(default_factory = dict)
+    # 再配信の再現用。None の場合は送信ごとに新しい ID を振る
+    event_id: Optional[str] = None
+
+
+@dataclass
+class CallScript:
+    events: List[ScriptEvent]
+    media_seconds: float
+    # (経過秒数, Base64 音声, バイト数) のリスト。音声が None のフレームは無音で送る。
+    # frames 自体が None の場合は 20ms 間隔の合成フレームを送る
+    frames: Optional[List[Tuple[float, Optional[str], int]]] = None
+    caller_id: str = "+810000000000"
+    # 応答からメディア WebSocket を接続するまでの秒数
+    media_offset: float = 0.0
+
+
+def default_script(media_seconds: float, dtmf_tones: List[Tuple[float, str]]) -> CallScript:
+    events = [ScriptEvent(0.0, "Microsoft.Communication.CallConnected")]
+    events.append(ScriptEvent(0.1, "Microsoft.Communication.MediaStreamingStarted"))
+    for offset, tone in dtmf_tones:
+        events.append(ScriptEvent(
+            offset,
+            "Microsoft.Communication.ContinuousDtmfRecognitionToneReceived",
+            {"tone": tone, "sequenceId": 1}
+        ))
+    events.append(ScriptEvent(media_seconds, "Microsoft.Communication.CallDisconnected"))
+    return CallScript(events = events, media_seconds = media_seconds)
+
+
+def incoming_call_event(caller_id: str, incoming_call_context: str) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "topic": "/subscriptions/load-test/resourceGroups/load-test/providers/Microsoft.Communication/communicationServices/load-test",
+        "subject": f"/caller/{caller_id}/recipient/+810000000001",
+        "eventType": "Microsoft.Communication.IncomingCall",
+        "eventTime": datetime.now(timezone.utc).isoformat(),
+        "dataVersion": "1.0",
+        "metadataVersion": "1",
+        "data": {
+            "to": {"kind": "phoneNumber", "rawId": "4:+810000000001", "phoneNumber": {"value": "+810000000001"}},
+            "from": {"kind": "phoneNumber", "rawId": f"4:{caller_id}", "phoneNumber": {"value": caller_id}},
+            "serverCallId": str(uuid.uuid4()),
+            "callerDisplayName": "load test",
+            "incomingCallContext": incoming_call_context,
+            "correlationId": str(uuid.uuid4()),
+        },
+    }
+
+
+@dataclass
+class CallStats:
+    frames_sent: int = 0
+    frames_received: int = 0
+    relay_latencies: List[float] = field(default_factory = list)
+    webhook_latencies: List[float] = field(default_factory = list)
+    webhook_errors: int = 0
+    media_connected_at: Optional[float] = None
+    last_frame_received_at: Optional[float] = None
+    media_error: Optional[str] = None
+    completed: bool = False
+
+
+class SimulatedCall:
+    def __init__(
+        self,
+        answered_call: AnsweredCall,
+        script: CallScript,
+        session: aiohttp.ClientSession,
+        speed: float = 1.0
+    ) -> None:
+        self._answered_call = answered_call
+        self._script = script
+        self._session = session
+        self._speed = speed
+        self.stats = CallStats()
+        self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
+
+    @property
+    def call_connection_id(self) -> str:
+        return self._answered_call.call_connection_id
+
+    @property
+    def script(self) -> CallScript:
+        return self._script
+
+    async def run(self) -> None:
+        started_at = time.monotonic()
+        webhooks = asyncio.create_task(self._send_webhooks(started_at))
+        try:
+            await self._stream_media(started_at)
+        finally:
+            await webhooks
+            self.stats.completed = True
+
+    # コールバック (CloudEvent) の送信
+    async def _send_webhooks(self, started_at: float) -> None:
+        for event in sorted(self._script.events, key = lambda e: e.offset):
+            await self._sleep_until(started_at + event.offset / self._speed)
+            await self.post_callback(event.event_type, event.data, event.event_id)
+
+    async def post_callback(self, event_type: str, data: dict, event_id: Optional[str] = None) -> None:
+        body = [{
+            "id": event_id or str(uuid.uuid4()),
+            "source": f"calling/callConnections/{self.call_connection_id}",
+            "type": event_type,
+            "specversion": "1.0",
+            "datacontenttype": "application/json",
+            "time": datetime.now(timezone.utc).isoformat(),
+            "subject": f"calling/callConnections/{self.call_connection_id}",
+            "data": dict(data, callConnectionId = self.call_connection_id),
+        }]
+        sent_at = time.perf_counter()
+        try:
+            async with self._session.post(self._answered_call.callback_uri, json = body) as response:
+                await response.read()
+                if response.status >= 400:
+                    self.stats.webhook_errors += 1
+        except aiohttp.ClientError:
+            self.stats.webhook_errors += 1
+        self.stats.webhook_latencies.append(time.perf_counter() - sent_at)
+
+    # メディア WebSocket
+    async def _stream_media(self, started_at: float) -> None:
+        url = self._answered_call.transport_url.replace("wss://", "ws://", 1)
+        await self._sleep_until(started_at + self._script.media_offset / self._speed)
+        try:
+            self._ws = await self._session.ws_connect(url, max_msg_size = 0)
+        except aiohttp.ClientError as e:
+            self.stats.media_error = f"connect: {e}"
+            return
+        self.stats.media_connected_at = time.monotonic()
+        receiver = asyncio.create_task(self._receive_media())
+        try:
+            await self._ws.send_str(json.dumps({
+                "kind": "AudioMetadata",
+                "audioMetadata": {"subscriptionId": str(uuid.uuid4()), "encoding": "PCM", "sampleRate": 24000, "channels": 1, "length": 640},
+            }))
+            if self._script.frames is not None:
+                await self._send_recorded_frames(started_at)
+            else:
+                await self._send_synthetic_frames(started_at)
+        except (aiohttp.ClientError, ConnectionResetError, RuntimeError) as e:
+            self.stats.media_error = f"send: {e}"
+        finally:
+            await self._ws.close()
+            receiver.cancel()
+            try:
+                await receiver
+            except asyncio.CancelledError:
+                pass
+
+    async def _send_synthetic_frames(self, started_at: float) -> None:
+        frame_count = int(self._script.media_seconds / FRAME_SECONDS)
+        padding = bytes(FRAME_BYTES - MARKER_SIZE)
+        for seq in range(frame_count):
+            await self._sleep_until(started_at + seq * FRAME_SECONDS / self._speed)
+            frame = struct.pack(MARKER_FORMAT, MARKER, seq, time.perf_counter_ns()) + padding
+            await self._send_frame(base64.b64encode(frame).decode("ascii"))
+
+    async def _send_recorded_frames(self, started_at: float) -> None:
+        # アプリは音声の中身を解釈しないため、先頭をマーカーで上書きして往復レイテンシを計測する
+        for seq, (offset, audio_base64, length) in enumerate(self._script.frames):
+            await self._sleep_until(started_at + offset / self._speed)
+            frame = bytearray(base64.b64decode(audio_base64) if audio_base64 else bytes(length))
+            if len(frame) >= MARKER_SIZE:
+                frame[:MARKER_SIZE] = struct.pack(MARKER_FORMAT, MARKER, seq, time.perf_counter_ns())
+            await self._send_frame(base64.b64encode(frame).decode("ascii"))
+
+    async def _send_frame(self, audio_base64: str) -> None:
+        await self._ws.send_str(json.dumps({
+            "kind": "AudioData",
+            "audioData": {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "participantRawID": f"4:{self._script.caller_id}",
+                "data": audio_base64,
+                "silent": False,
+            },
+        }))
+        self.stats.frames_sent += 1
+
+    async def _receive_media(self) -> None:
+        async for msg in self._ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            received_ns = time.perf_counter_ns()
+            payload = json.loads(msg.data)
+            if payload.get("kind") != "AudioData":
+                continue
+            self.stats.frames_received += 1
+            self.stats.last_frame_received_at = time.monotonic()
+            audio = base64.b64decode(payload["audioData"]["data"])
+            if len(audio) >= MARKER_SIZE and audio[:4] == MARKER:
+                _, _, sent_ns = struct.unpack_from(MARKER_FORMAT, audio)
+                self.stats.relay_latencies.append((received_ns - sent_ns) / 1e9)
+
+    async def _sleep_until(self, deadline: float) -> None:
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional
+import aiohttp
+from run import REPO_ROOT, APPS, AppProcess, free_port
+from fake_acs import FakeAcsServer
+from fake_realtime import FakeRealtimeServer
+
+# コールドスタートの計測。アプリを偽の ACS / realtime に向けて繰り返し起動し直し、
+# プロセスの起動から接続を受け付けるまでの時間を 2 つのビルドで比較する。
+
+
+async def _ignore_answer(answered_call) -> None:
+    pass
+
+
+async def measure(app_name: str, runs: int, root: Path) -> Dict[str, object]:
+    timeout = aiohttp.ClientTimeout(total = 5)
+    ready_seconds: List[float] = []
+    breakdown: Dict[str, float] = {}
+    async with aiohttp.ClientSession(timeout = timeout) as session:
+        async with FakeRealtimeServer() as realtime, FakeAcsServer(_ignore_answer) as acs:
+            for _ in range(runs):
+                app = AppProcess(app_name, free_port(), acs.connection_string, realtime.url, root)
+                app.start()
+                try:
+                    ready_seconds.append(await app.wait_ready(session))
+                    breakdown = await fetch_breakdown(app, session) or breakdown
+                finally:
+                    app.stop()
+    return {
+        "runs": runs,
+        "ready_median_ms": round(statistics.median(ready_seconds) * 1000, 1),
+        "ready_min_ms": round(min(ready_seconds) * 1000, 1),
+        "ready_max_ms": round(max(ready_seconds) * 1000, 1),
+        "breakdown": breakdown,
+    }
+
+
+async def fetch_breakdown(app: AppProcess, session: aiohttp.ClientSession) -> Optional[Dict[str, float]]:
+    # アプリ自身が記録した内訳 (/debug/startup がないビルドでは None)
+    try:
+        async with session.get(app.base_url + "/debug/startup") as response:
+            if response.status != 200:
+                return None
+            return await response.json()
+    except aiohttp.ClientError:
+        return None
+
+
+def print_result(label: str, result: Dict[str, object]) -> None:
+    print(
+        f"  {label:10s} ready median {result['ready_median_ms']:8.1f}ms"
+        f"  min {result['ready_min_ms']:8.1f}ms  max {result['ready_max_ms']:8.1f}ms  ({result['runs']} runs)"
+    )
+    for name, value in sorted(result["breakdown"].items()):
+        if name.endswith("_seconds"):
+            print(f"    {name:32s} {value * 1000:8.1f}ms")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = "Measure how long a cold process takes to accept connections")
+    parser.add_argument("--app", choices = sorted(APPS), default = "microservices")
+    parser.add_argument("--runs", type = int, default = 5)
+    parser.add_argument("--baseline", type = Path, default = REPO_ROOT, help = "repository checkout of the baseline build")
+    parser.add_argument("--candidate", type = Path, default = None, help = "repository checkout of the build to compare")
+    parser.add_argument("--threshold", type = float, default = 10.0, help = "allowed slowdown in percent")
+    parser.add_argument("--json", type = Path, default = None, help = "write the results as JSON")
+    return parser.parse_args(argv)
+
+
+async def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    results = {"baseline": await measure(args.app, args.runs, args.baseline.resolve())}
+    print(f"== {args.app}")
+    print_result("baseline", results["baseline"])
+    status = 0
+    if args.candidate is not None:
+        results["candidate"] = await measure(args.app, args.runs, args.candidate.resolve())
+        print_result("candidate", results["candidate"])
+        before = results["baseline"]["ready_median_ms"]
+        after = results["candidate"]["ready_median_ms"]
+        change = (after - before) / before * 100
+        print(f"  ready median {before:.1f}ms -> {after:.1f}ms ({change:+.1f}%)")
+        if change > args.threshold:
+            print(f"REGRESSION startup: {before:.1f}ms -> {after:.1f}ms ({change:+.1f}%)", file = sys.stderr)
+            status = 1
+    if args.json:
+        args.json.write_text(json.dumps(results, indent = 2))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -1,20 +1,223 @@
+from startup import startup_timer
+import asyncio
 import uvicorn
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 from state_manager import ConversationStateManager, RealtimeManager
 from job_router import JobRouter
-from router import router
+from router import router, callback_dispatcher
+from settings import settings
+from event_cache import ProcessedEventCache
+from logger import get_logger, start_logging, stop_logging
+import logger as log_config
+from metrics import ACTIVE_CALLS, registry as metrics_registry, stats_collector
+from trace_recorder import recorder as trace_recorder
+from loop_monitor import loop_monitor
+from realtime_pool import realtime_pool
+from role_profiles import role_profiles
+from summarizer import conversation_summaries
+from transcript_archive import transcript_archive
+from call_recorder import call_recorder
+from drain import drain_controller
+from admission import admission_controller
+from dtmf_collector import dtmf_collectors
+from media_plane import media_plane
+from call_watchdog import call_watchdog
+from callback_dispatcher import CallDependencies
+from caller_context import caller_contexts
+from prompt_audio import prompt_audio
+
+logger = get_logger(__name__)
+startup_timer.mark("imports")
+
+# 着信の受け付けには不要で、最初の通話までに読み込んでおくモジュール
+WARMUP_MODULES = ["realtime"]
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    startup_timer.mark("server_start")
+    start_logging()
+    # ロール定義に誤りがあれば起動時に失敗させる
+    role_profiles.load()
+    loop_monitor.start()
     app.state.conversation_state_manager = ConversationStateManager()
     app.state.realtime_manager = RealtimeManager()
-    app.state.job_router = JobRouter()
-    await app.state.job_router.init()
+    # SDK クライアントは import 時ではなくここで生成する
+    with startup_timer.phase("job_router_init"):
+        app.state.job_router = JobRouter()
+        await app.state.job_router.init()
+    app.state.incoming_call_semaphore = asyncio.Semaphore(settings.INCOMING_CALL_CONCURRENCY)
+    app.state.processed_event_cache = ProcessedEventCache(
+        max_entries = settings.PROCESSED_EVENT_CACHE_SIZE,
+        ttl_seconds = settings.PROCESSED_EVENT_TTL_SECONDS,
+        store = create_processed_event_store()
+    )
+    caller_contexts.configure(create_caller_profile_lookup())
+    trace_recorder.start()
+    transcript_archive.start()
+    call_recorder.start()
+    await conversation_summaries.start()
+    with startup_timer.phase("media_plane_start"):
+        await media_plane.start()
+    register_metrics_collectors(app)
+    drain_controller.configure(active_calls, lambda: release_calls(app))
+    admission_controller.configure(
+        active_calls,
+        job_capacity = settings.WORKER_CAPACITY // max(1, settings.CAPACITY_COST_PER_JOB),
+        pool_idle = realtime_pool.idle if settings.REALTIME_WARM_POOL_SIZE > 0 else None
+    )
+    # 止まった通話は中継のプロセスにかかわらず、ACS 通話とジョブをこのプロセスで片付ける
+    call_watchdog.configure(lambda call_id, reason: release_stalled_call(app, call_id, reason))
+    media_plane.configure(
+        lambda call_id, reason: release_stalled_call(app, call_id, reason),
+        lambda call_id, summary: app.state.conversation_state_manager.update(call_id, conversation_summary = summary)
+    )
+    call_watchdog.start()
+    loop_monitor.spawn(warm_up(), None, "warmup")
+    startup_timer.mark("lifespan")
+    startup_timer.ready()
     yield
+    # ドレイン済みでなければここでドレインする (通話はサーバー停止時に切断済みのため、すぐに片付けに進む)
+    await drain_controller.run()
+    await call_watchdog.stop()
+    await media_plane.stop()
+    await conversation_summaries.stop()
+    await realtime_pool.stop()
+    call_recorder.stop()
+    transcript_archive.stop()
+    trace_recorder.stop()
+    await loop_monitor.stop()
+    stop_logging()
+
+def active_calls() -> int:
+    # メディアワーカーを使う場合、中継中の通話はワーカー側で数えている
+    if media_plane.enabled:
+        return media_plane.active_calls()
+    return int(ACTIVE_CALLS.value)
+
+async def warm_up() -> None:
+    # 接続の受け付けと並行して realtime (rtclient) を読み込み、読み込めたら待機接続の補充を始める
+    await startup_timer.warm(WARMUP_MODULES)
+    from realtime import create_rtclient, synthesize_prompt
+    realtime_pool.start(create_rtclient)
+    # メディアワーカーを使う場合、定型文はワーカーが流す
+    if not media_plane.enabled:
+        prompt_audio.configure(synthesize_prompt)
+        await prompt_audio.warm(role_profiles.prompts())
+
+async def release_stalled_call(app: FastAPI, call_id: str, reason: str) -> None:
+    # ウォッチドッグが切断する通話。CallDisconnected を待たずにジョブを終了し、ワーカーの容量を戻す
+    trace_recorder.record(call_id, "watchdog_release", reason = reason)
+    dependencies = CallDependencies(app.state, call_id)
+    await dependencies.call_handler.hangup(dependencies.call_context)
+    conversation_state = dependencies.conversation_state
+    if conversation_state is not None and conversation_state.job_id:
+        await app.state.job_router.finish_job_by_id(conversation_state.job_id)
+        conversation_state.job_id = None
+
+async def release_calls(app: FastAPI) -> dict:
+    # 残っている realtime クライアントを並行して閉じ、通話のタスクを止め、未完了のジョブをまとめて終了してからワーカーを外す
+    realtime_closed = await app.state.realtime_manager.close_all()
+    realtime_closed += await media_plane.close_all()
+    tasks_cancelled = await loop_monitor.cancel_call_tasks()
+    job_ids = [state.job_id for state in app.state.conversation_state_manager.all() if state.job_id]
+    jobs_finished, jobs_failed = await app.state.job_router.finish_jobs(job_ids)
+    try:
+        await app.state.job_router.set_worker_available(False)
+    except Exception as e:
+        logger.error(f"Failed to mark the worker unavailable: {e}")
+    return {
+        "realtime_closed": realtime_closed,
+        "tasks_cancelled": tasks_cancelled,
+        "jobs_finished": jobs_finished,
+        "jobs_failed": jobs_failed,
+    }
+
+def register_metrics_collectors(app: FastAPI) -> None:
+    metrics_registry.add_collector(
+        stats_collector("callcenter_processed_event_cache", app.state.processed_event_cache.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_logger", log_config.stats)
+    )
+    metrics_registry.add_collector(callback_dispatcher.metrics_lines)
+    metrics_registry.add_collector(
+        stats_collector("callcenter_trace_recorder", trace_recorder.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_event_loop", loop_monitor.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_realtime_pool", realtime_pool.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_role_profiles", role_profiles.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_conversation_summary", conversation_summaries.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_transcript_archive", transcript_archive.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_call_recorder", call_recorder.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_drain", drain_controller.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_admission", admission_controller.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_dtmf", dtmf_collectors.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_media_plane", media_plane.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_startup", startup_timer.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_watchdog", call_watchdog.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_caller_context", caller_contexts.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_prompt_audio", prompt_audio.stats)
+    )
+
+def create_processed_event_store():
+    if not settings.COSMOS_CONNECTION_STRING:
+        return None
+    from db import CosmosDB, CosmosProcessedEventStore
+    cosmos_db = CosmosDB(
+        settings.COSMOS_CONNECTION_STRING,
+        settings.COSMOS_DATABASE_NAME,
+        settings.COSMOS_PROCESSED_EVENT_CONTAINER_NAME
+    )
+    return CosmosProcessedEventStore(cosmos_db)
+
+def create_caller_profile_lookup():
+    if not settings.COSMOS_CONNECTION_STRING or not settings.COSMOS_CALLER_PROFILE_CONTAINER_NAME:
+        return None
+    from db import CosmosDB, CosmosCallerProfileStore
+    cosmos_db = CosmosDB(
+        settings.COSMOS_CONNECTION_STRING,
+        settings.COSMOS_DATABASE_NAME,
+        settings.COSMOS_CALLER_PROFILE_CONTAINER_NAME
+    )
+    return CosmosCallerProfileStore(cosmos_db).get
 
 app = FastAPI(lifespan = lifespan)
 app.include_router(router)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host = "0.0.0.0", port = 8080)
+    # ACS の WebSocket が応答しなくなったら uvicorn が ping で検知して閉じる
+    uvicorn.run(
+        app,
+        host = "0.0.0.0",
+        port = 8080,
+        ws_ping_interval = settings.WEBSOCKET_PING_INTERVAL_SECONDS,
+        ws_ping_timeout = settings.WEBSOCKET_PING_TIMEOUT_SECONDS
+    )
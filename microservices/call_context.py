@@ -1,15 +1,20 @@
+import time
 import uuid
-from typing import Optional
+from typing import List, Optional
 from fastapi import Request
 from models import ConversationState
 from state_manager import ConversationStateManager
 from azure.core.messaging import CloudEvent
 
+INCOMING_CALL_EVENT = "Microsoft.Communication.IncomingCall"
+
 class CallContext:
-    def __init__(self, call_id, events, conversation_state):
+    def __init__(self, call_id, events, conversation_state, incoming_call_context = None, received_at = None):
         self.call_id: str = call_id
         self.events: CloudEvent = events
         self.conversation_state: ConversationState = conversation_state
+        self.incoming_call_context: Optional[str] = incoming_call_context
+        self.received_at: Optional[float] = received_at
 
 class CallContextFactory:
     def __init__(self, request: Request, call_id: Optional[str] = None):
@@ -35,3 +40,33 @@ class CallContextFactory:
             events = events,
             conversation_state = conversation_state
         )
+
+    async def build_incoming(self) -> List[CallContext]:
+        # Event Grid はバッチで配信するため、IncomingCall イベントごとに個別のコンテキストを作成
+        received_at = time.monotonic()
+        events = await self.request.json()
+        conversation_state_manager: ConversationStateManager = (
+            self.request.app.state.conversation_state_manager
+        )
+
+        call_contexts = []
+        for event in events:
+            if event.get("eventType") != INCOMING_CALL_EVENT:
+                continue
+            data = event.get("data", {})
+            conversation_state = conversation_state_manager.create(str(uuid.uuid4()))
+            conversation_state.caller_id = self._caller_id(data)
+            call_contexts.append(CallContext(
+                call_id = conversation_state.call_id,
+                events = [event],
+                conversation_state = conversation_state,
+                incoming_call_context = data.get("incomingCallContext"),
+                received_at = received_at
+            ))
+        return call_contexts
+
+    def _caller_id(self, data: dict) -> Optional[str]:
+        caller = data.get("from", {})
+        if caller.get("kind") == "phoneNumber":
+            return caller.get("phoneNumber", {}).get("value")
+        return caller.get("rawId")
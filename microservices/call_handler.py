@@ -1,9 +1,15 @@
 from settings import settings
 from urllib.parse import urlencode, urlparse
 from call_context import CallContext
+from metrics import INCOMING_CALL_TO_ANSWER_SECONDS
+from logger import get_logger
+from summarizer import conversation_summaries
+from media_plane import media_plane
 from azure.communication.callautomation.aio import CallAutomationClient
 from azure.communication.callautomation import (
     CallConnectionClient,
+    CallRejectReason,
+    FileSource,
     MediaStreamingOptions,
     AudioFormat,
     MediaStreamingTransportType,
@@ -12,6 +18,8 @@ from azure.communication.callautomation import (
     PhoneNumberIdentifier
 )
 
+logger = get_logger(__name__)
+
 class CallHandler:
     def __init__(self, call_id: str) -> None:
         connection_string = settings.ACS_CONNECTION_STRING
@@ -21,9 +29,6 @@ class CallHandler:
         self._automation_client: CallAutomationClient = (
             CallAutomationClient.from_connection_string(connection_string)
         )
-        self._connection_client: CallConnectionClient = (
-            CallConnectionClient.from_connection_string(connection_string, call_id)
-        )
 
     async def answer_call(self, incoming_call_context: str, call_context: CallContext) -> None:
         await self._automation_client.answer_call(
@@ -32,7 +37,40 @@ class CallHandler:
             callback_url = self._callback_url(call_context),
             media_streaming = self._media_streaming_options(call_context),
         )
+        if call_context.received_at is not None:
+            INCOMING_CALL_TO_ANSWER_SECONDS.observe_since(call_context.received_at)
     
+    async def reject_call(self, incoming_call_context: str) -> None:
+        await self._automation_client.reject_call(
+            incoming_call_context = incoming_call_context,
+            call_reject_reason = CallRejectReason.BUSY
+        )
+
+    async def redirect_call(self, incoming_call_context: str, phone_number: str) -> None:
+        await self._automation_client.redirect_call(
+            incoming_call_context = incoming_call_context,
+            target_participant = PhoneNumberIdentifier(phone_number)
+        )
+
+    async def answer_busy_call(self, incoming_call_context: str, call_context: CallContext) -> None:
+        # 話中案内だけを流すため、メディアストリーミングなしで応答する
+        await self._automation_client.answer_call(
+            incoming_call_context = incoming_call_context,
+            operation_context = "busy",
+            callback_url = self._callback_url(call_context),
+        )
+
+    async def play_busy_message(self, call_connection_id: str, audio_url: str) -> None:
+        call_connection = self.get_call_connection(call_connection_id)
+        await call_connection.play_media_to_all(
+            FileSource(url = audio_url),
+            operation_context = "busy"
+        )
+
+    async def hangup_connection(self, call_connection_id: str) -> None:
+        call_connection = self.get_call_connection(call_connection_id)
+        await call_connection.hang_up(is_for_everyone = True)
+
     def _media_streaming_options(self, call_context: CallContext) -> MediaStreamingOptions:
         options = MediaStreamingOptions(
             transport_url = self._websocket_url(call_context),
@@ -50,15 +88,14 @@ class CallHandler:
         caller_id = call_context.conversation_state.caller_id
         query_parameters = urlencode({"callerId": caller_id})
         callback_url = f"{self._callback_baseurl}/{call_id}?{query_parameters}"
-        print("Debug: caller_id:", caller_id)
-        print("Debug: call_id:", call_id)
-        print("Debug: callback_baseurl:", self._callback_baseurl)
-        print("Debug: query_parameters:", query_parameters)
-        print("Debug: callback_url:", callback_url)
+        logger.debug(f"Callback url: {callback_url}", call_id = call_id, caller_id = caller_id)
         return callback_url
 
     def _websocket_url(self, call_context: CallContext) -> str:
         call_id = call_context.call_id
+        if media_plane.enabled:
+            # 音声は割り当てたメディアワーカーに直接つながせる
+            return media_plane.websocket_url(call_id)
         parsed_url = urlparse(self._callback_baseurl)
         websocket_url = f"wss://{parsed_url.netloc}/ws/{call_id}"
         return websocket_url
@@ -68,18 +105,30 @@ class CallHandler:
             call_id = call_id
         )
 
-    def transfer_call(self, call_context: CallContext) -> None:
-        self._connection_client.transfer_call_to_participant(
+    async def transfer_call(self, call_context: CallContext) -> None:
+        # call_id はアプリが振った ID のため、CallConnected で受け取った callConnectionId で転送する
+        call_connection_id = call_context.conversation_state.call_connection_id
+        if not call_connection_id:
+            raise RuntimeError(f"No call connection to transfer for {call_context.call_id}")
+        call_connection = self.get_call_connection(call_connection_id)
+        await call_connection.transfer_call_to_participant(
             target_participant = self._phone_number_identifier(),
-            operation_context = call_context.conversation_state.conversation_summary,
+            # 要約は通話中にバックグラウンドで更新済みのため、ここでは待たずにそのまま渡す
+            operation_context = conversation_summaries.flush(call_context.conversation_state),
             operation_callback_url = self._operator_callback_baseurl
         )
     
     async def hangup(self, call_context: CallContext) -> None:
+        conversation_state = call_context.conversation_state
+        call_connection_id = conversation_state.call_connection_id if conversation_state else None
+        if not call_connection_id:
+            # 接続前か、ACS 側で切断済みの通話
+            logger.debug(f"No call connection to hang up for {call_context.call_id}")
+            return
         try:
-            await self._connection_client.hang_up(is_for_everyone = True)
+            await self.hangup_connection(call_connection_id)
         except Exception as e:
-            print(f"Error during hangup for connection {call_context.conversation_state.call_id}: {e}")
+            logger.error(f"Error during hangup for connection {call_connection_id}: {e}")
 
     def _phone_number_identifier(self) -> PhoneNumberIdentifier:
         return PhoneNumberIdentifier(
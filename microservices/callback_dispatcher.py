@@ -0,0 +1,119 @@
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Iterable, List, Optional
+from call_context import CallContext
+from call_handler import CallHandler
+from dtmf import DTMFHandler
+from job_router import JobRouter
+from models import ConversationState
+from media_plane import media_plane
+
+if TYPE_CHECKING:
+    from realtime import Realtime
+
+class CallDependencies:
+    # 通話ごとのハンドラを必要になった時点で生成してキャッシュする
+    def __init__(self, app_state, call_id: str) -> None:
+        self.call_id = call_id
+        self._app_state = app_state
+        self._call_context: Optional[CallContext] = None
+        self._call_handler: Optional[CallHandler] = None
+        self._dtmf_handler: Optional[DTMFHandler] = None
+        self._dtmf_realtime: Optional["Realtime"] = None
+
+    @property
+    def conversation_state(self) -> Optional[ConversationState]:
+        return self._app_state.conversation_state_manager.get(self.call_id)
+
+    @property
+    def call_context(self) -> CallContext:
+        if self._call_context is None:
+            self._call_context = CallContext(
+                call_id = self.call_id,
+                events = None,
+                conversation_state = self.conversation_state
+            )
+        return self._call_context
+
+    @property
+    def job_router(self) -> JobRouter:
+        return self._app_state.job_router
+
+    def discard(self) -> None:
+        # 切断された通話の会話状態と realtime クライアントを管理対象から外す
+        self._app_state.realtime_manager.delete(self.call_id)
+        self._app_state.conversation_state_manager.delete(self.call_id)
+
+    @property
+    def call_handler(self) -> CallHandler:
+        if self._call_handler is None:
+            self._call_handler = CallHandler(self.call_id)
+        return self._call_handler
+
+    @property
+    def dtmf_handler(self) -> DTMFHandler:
+        # Realtime は WebSocket 接続時に作り直されるため、変わっていればハンドラも作り直す
+        # (メディアワーカーを使う場合は、ワーカー側の Realtime に IPC で指示する代理を使う)
+        if media_plane.enabled:
+            realtime = self._dtmf_realtime or media_plane.realtime(self.call_id)
+        else:
+            realtime = self._app_state.realtime_manager.get(self.call_id)
+        if self._dtmf_handler is None or self._dtmf_realtime is not realtime:
+            self._dtmf_handler = DTMFHandler(self._app_state.job_router, self.call_id, realtime)
+            self._dtmf_realtime = realtime
+        return self._dtmf_handler
+
+
+CallbackHandler = Callable[[dict, CallDependencies], Awaitable[None]]
+
+class CallbackDispatcher:
+    def __init__(self) -> None:
+        self._handlers: Dict[str, CallbackHandler] = {}
+        self._dependencies: Dict[str, CallDependencies] = {}
+        # event type -> [件数, 合計処理時間 (秒), 最大処理時間 (秒)]
+        self._latency: Dict[str, List[float]] = {}
+
+    def on(self, event_type: str) -> Callable[[CallbackHandler], CallbackHandler]:
+        def decorator(handler: CallbackHandler) -> CallbackHandler:
+            self._handlers[event_type] = handler
+            self._latency[event_type] = [0, 0.0, 0.0]
+            return handler
+        return decorator
+
+    async def dispatch(self, app_state, call_id: str, event: dict) -> None:
+        event_type = event.get("type")
+        handler = self._handlers.get(event_type)
+        if handler is None:
+            # 未登録のイベントは依存オブジェクトを作らずに読み捨てる
+            return
+
+        dependencies = self._dependencies.get(call_id)
+        if dependencies is None:
+            dependencies = CallDependencies(app_state, call_id)
+            self._dependencies[call_id] = dependencies
+
+        started_at = time.perf_counter()
+        try:
+            await handler(event, dependencies)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            latency = self._latency[event_type]
+            latency[0] += 1
+            latency[1] += elapsed
+            if elapsed > latency[2]:
+                latency[2] = elapsed
+
+    def release(self, call_id: str) -> None:
+        self._dependencies.pop(call_id, None)
+
+    def metrics_lines(self) -> Iterable[str]:
+        for event_type, (count, total, maximum) in self._latency.items():
+            labels = f'{{event_type="{event_type}"}}'
+            yield f"callcenter_callback_handled_total{labels} {count}"
+            yield f"callcenter_callback_handling_seconds_sum{labels} {total}"
+            yield f"callcenter_callback_handling_seconds_max{labels} {maximum}"
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            event_type: {"count": count, "total_seconds": total, "max_seconds": maximum}
+            for event_type, (count, total, maximum) in self._latency.items()
+        }
@@ -1,11 +1,14 @@
-from typing import Any
+import asyncio
+from typing import Any, Optional
 from azure.cosmos import CosmosClient, CosmosDict
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from interface import CallerProfileStoreInterface, ProcessedEventStoreInterface
 
 class CosmosDB:
     def __init__(self, connection_string: str, database_name: str, container_name: str) -> None:
         _client = CosmosClient.from_connection_string(connection_string)
         self._database = _client.get_database_client(database_name)
-        self._container = _client.get_container_client(container_name)
+        self._container = self._database.get_container_client(container_name)
     
     def get_item(self, item_id: str, partition_key: str) -> CosmosDict[str, Any]:
         return self._container.read_item(item = item_id, partition_key = partition_key)
@@ -13,3 +16,40 @@ class CosmosDB:
     def upsert_item(self, item: dict) -> CosmosDict[str, Any]:
         self._container.upsert_item(item)
         return item
+
+    def delete_item(self, item_id: str, partition_key: str) -> None:
+        self._container.delete_item(item = item_id, partition_key = partition_key)
+
+
+class CosmosProcessedEventStore(ProcessedEventStoreInterface):
+    # コンテナはパーティションキー /id、TTL 有効で作成しておくこと
+    def __init__(self, cosmos_db: CosmosDB) -> None:
+        self._cosmos_db = cosmos_db
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await asyncio.to_thread(self._cosmos_db.get_item, key, key)
+            return True
+        except CosmosResourceNotFoundError:
+            return False
+
+    async def add(self, key: str, ttl_seconds: int) -> None:
+        await asyncio.to_thread(self._cosmos_db.upsert_item, {"id": key, "ttl": ttl_seconds})
+
+    async def delete(self, key: str) -> None:
+        try:
+            await asyncio.to_thread(self._cosmos_db.delete_item, key, key)
+        except CosmosResourceNotFoundError:
+            pass
+
+
+class CosmosCallerProfileStore(CallerProfileStoreInterface):
+    # コンテナはパーティションキー /id で作成し、発信者 ID (電話番号など) を id にしておくこと
+    def __init__(self, cosmos_db: CosmosDB) -> None:
+        self._cosmos_db = cosmos_db
+
+    async def get(self, caller_id: str) -> Optional[dict]:
+        try:
+            return await asyncio.to_thread(self._cosmos_db.get_item, caller_id, caller_id)
+        except CosmosResourceNotFoundError:
+            return None
@@ -1,21 +1,148 @@
+import asyncio
+import time
 import uuid
+from typing import TYPE_CHECKING, Optional
+from settings import settings
 from job_router import JobRouter
-from realtime import Realtime
 from call_context import CallContext
-from azure.communication.callautomation import DtmfTone, PhoneNumberIdentifier, CallConnectionClient
+from models import ConversationState
+from logger import get_logger
+from loop_monitor import loop_monitor
+from role_profiles import RoleProfile
+from metrics import ROLE_SWITCH_ROUTING_SECONDS, ROLE_SWITCHES_COMPLETED, ROLE_SWITCHES_ROLLED_BACK
+from azure.communication.callautomation import PhoneNumberIdentifier, CallConnectionClient
+
+if TYPE_CHECKING:
+    from realtime import Realtime
+
+logger = get_logger(__name__)
+
+class RoleSwitch:
+    # ロール切り替え 1 回分の処理。新しいロールの realtime セッションをすぐに始め、
+    # 旧ジョブの終了と新ジョブの割り当てはその裏で並行して進める。
+    # いずれかの段階が失敗したら、切り替え前のロールとジョブに戻す
+    def __init__(self, job_router: JobRouter, realtime: "Realtime", call_context: CallContext, profile: RoleProfile) -> None:
+        self._job_router = job_router
+        self._realtime = realtime
+        self._state = call_context.conversation_state
+        self._profile = profile
+        self._previous_role = self._state.current_role
+        self._previous_job_id = self._state.job_id
+        self._previous_assignment_id = self._state.job_assignment_id
+        self._previous_job_finished = self._previous_job_id is None
+        # 割り当て結果は確定するまで会話状態に書き込まない
+        self._assignment = ConversationState(call_id = self._state.call_id)
+        self._new_job_id: Optional[str] = None
+        self._committed = False
+        self._routing: Optional[asyncio.Task] = None
+
+    async def run(self) -> None:
+        call_id = self._state.call_id
+        logger.info(f"Switching role to {self._profile.name}")
+        self._state.current_role = self._profile.name
+        self._state.job_id = None
+        self._state.job_assignment_id = None
+        self._routing = loop_monitor.spawn(self._route(), call_id, "role-routing")
+        try:
+            # 発信者に聞こえるまでの時間は realtime の再設定だけで決まる
+            await self._realtime.start_realtime_conversation_loop(self._state)
+            await self._routing
+        except asyncio.CancelledError:
+            # 新しい選択に置き換えられた。後続の切り替えが引き継げるよう、同期的に状態を戻してから抜ける
+            self._hand_over()
+            raise
+        except Exception as e:
+            logger.error(f"Role switch to {self._profile.name} failed, rolling back to {self._previous_role}: {e}")
+            await self._rollback()
+            ROLE_SWITCHES_ROLLED_BACK.inc()
+            return
+        ROLE_SWITCHES_COMPLETED.inc()
+
+    async def _route(self) -> None:
+        started_at = time.monotonic()
+        call_id = self._state.call_id
+        stages = [
+            loop_monitor.spawn(self._finish_previous_job(), call_id, "role-routing"),
+            loop_monitor.spawn(self._assign_job(), call_id, "role-routing")
+        ]
+        try:
+            await asyncio.wait(stages, return_when = asyncio.FIRST_EXCEPTION)
+        finally:
+            # 一方が失敗したか切り替え自体が止められたら、もう一方も止めて終わるのを待つ
+            # (ロールバックが進行中のジョブ作成やオファー待ちと競合しないように)
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions = True)
+        for stage in stages:
+            if not stage.cancelled() and stage.exception() is not None:
+                raise stage.exception()
+        # 割り当てが済んでから会話状態に反映する
+        self._state.job_id = self._assignment.job_id
+        self._state.job_assignment_id = self._assignment.job_assignment_id
+        self._state.worker_id = self._assignment.worker_id
+        self._committed = True
+        ROLE_SWITCH_ROUTING_SECONDS.observe_since(started_at)
+
+    async def _finish_previous_job(self) -> None:
+        if self._previous_job_id:
+            await self._job_router.finish_job_by_id(self._previous_job_id)
+        self._previous_job_finished = True
+
+    async def _assign_job(self) -> None:
+        submitted_at = time.monotonic()
+        job = await self._job_router.upsert_job(str(uuid.uuid4()))
+        self._new_job_id = job.id
+        logger.info(f"Job created and upserted: {job.id}", job_id = job.id)
+        await asyncio.wait_for(
+            self._job_router.wait_job_offer(self._assignment, job.id, submitted_at),
+            timeout = settings.ROLE_SWITCH_JOB_TIMEOUT_SECONDS
+        )
+        # 別の通話のジョブを引き継がないよう、投入したジョブが割り当てられたことを確かめる
+        if self._assignment.job_id != job.id:
+            raise RuntimeError(f"No job offer accepted for job {job.id}")
+
+    def _hand_over(self) -> None:
+        if self._routing is not None:
+            self._routing.cancel()
+        if self._committed:
+            # 割り当て済みのジョブは後続の切り替えが旧ジョブとして終了する
+            return
+        if not self._previous_job_finished:
+            self._state.job_id = self._previous_job_id
+            self._state.job_assignment_id = self._previous_assignment_id
+        if self._new_job_id:
+            loop_monitor.spawn(self._finish_new_job(), self._state.call_id, "role-routing", cleanup = True)
+
+    async def _rollback(self) -> None:
+        if self._routing is not None and not self._routing.done():
+            self._routing.cancel()
+            await asyncio.gather(self._routing, return_exceptions = True)
+        self._state.current_role = self._previous_role
+        if self._previous_job_finished:
+            # 旧ジョブは終了済みのため戻せない。割り当て済みの新ジョブがあればそのまま使う
+            if not self._committed:
+                self._state.job_id = None
+                self._state.job_assignment_id = None
+                await self._finish_new_job()
+        else:
+            self._state.job_id = self._previous_job_id
+            self._state.job_assignment_id = self._previous_assignment_id
+            await self._finish_new_job()
+        try:
+            await self._realtime.start_realtime_conversation_loop(self._state)
+        except Exception as e:
+            logger.error(f"Failed to restore the realtime session for role {self._previous_role}: {e}")
+
+    async def _finish_new_job(self) -> None:
+        if self._new_job_id and self._new_job_id != self._state.job_id:
+            try:
+                await self._job_router.finish_job_by_id(self._new_job_id)
+            except Exception as e:
+                logger.error(f"Failed to finish job {self._new_job_id} created by a cancelled role switch: {e}")
+
 
 class DTMFHandler:
-    AI_ROLE_MAP = {
-        DtmfTone.ONE.value: "RoleA",
-        DtmfTone.TWO.value: "RoleB",
-        DtmfTone.THREE.value: "RoleC",
-        DtmfTone.FIVE.value: "RoleE"
-    }
-    HUMAN_ROLE_MAP = {
-        DtmfTone.FOUR.value: "RoleD"
-    }
-
-    def __init__(self, job_router: JobRouter, call_id: str, realtime: Realtime) -> None:
+    def __init__(self, job_router: JobRouter, call_id: str, realtime: "Realtime") -> None:
         self._call_id = call_id
         self._job_router = job_router
         self._realtime = realtime
@@ -27,34 +154,9 @@ class DTMFHandler:
                 target_participant = PhoneNumberIdentifier(self._call_id),
                 operation_context = self._operation_context,
             )
-            print(f"DTMF recognition started for call_id {self._call_id} with operation_context {self._operation_context}.")
+            logger.info(f"DTMF recognition started for call_id {self._call_id} with operation_context {self._operation_context}.")
         except Exception as e:
-            print(f"Error starting DTMF recognition for call_id {self._call_id}: {e}")
-
-    async def handle_tone_received(self, call_context: CallContext, tone: str) -> None:
-        conversation_state = call_context.conversation_state
-        # ロールの変更
-        self._switch_role(conversation_state, tone)
-        # 旧ジョブの完了
-        self._finish_previous_job(conversation_state)
-        # 新しいジョブを作成・キューに投入
-        self._job_router.create_and_assign_job(call_context)
-        # リアルタイム API の初期化
-        self._realtime.start_realtime_conversation_loop(conversation_state)
-
-    def _switch_role(self, call_context: CallContext, tone: str) -> None:
-        if tone in self.AI_ROLE_MAP:
-            new_role = self.AI_ROLE_MAP[tone]
-            print(f"Switching role to {new_role}")
-            call_context.conversation_state.current_role = new_role
-        else:
-            print(f"Unhandled DTMF tone: {tone}")
-    
-    def _finish_previous_job(self, call_context: CallContext) -> None:
-        previous_job_id = call_context.conversation_state.job_id
-
-        if previous_job_id:
-            self._job_router.finish_job_by_id(previous_job_id)
-        
-        call_context.conversation_state.job_id = None
-        call_context.conversation_state.job_assignment_id = None
+            logger.error(f"Error starting DTMF recognition for call_id {self._call_id}: {e}")
+
+    async def switch_role(self, call_context: CallContext, profile: RoleProfile) -> None:
+        await RoleSwitch(self._job_router, self._realtime, call_context, profile).run()
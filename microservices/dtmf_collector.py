@@ -0,0 +1,155 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional
+from settings import settings
+from logger import get_logger
+from loop_monitor import loop_monitor
+from role_profiles import RoleProfile, TONE_DIGITS, role_profiles
+
+logger = get_logger(__name__)
+
+# 通話ごとに DTMF の入力を集め、選択が確定してから 1 回だけロールを切り替える。
+# 続けて押された数字や重複したトーンで切り替えが重ならないよう、確定前の選択は置き換え、
+# 実行中の切り替えは新しい選択が確定した時点でキャンセルする
+SwitchRole = Callable[[RoleProfile], Awaitable[None]]
+
+class DtmfCollector:
+    def __init__(
+        self,
+        collectors: "DtmfCollectors",
+        call_id: str,
+        switch_role: SwitchRole,
+        current_role: Callable[[], Optional[str]]
+    ) -> None:
+        self._collectors = collectors
+        self._call_id = call_id
+        self._switch_role = switch_role
+        self._current_role = current_role
+        self.digits = ""
+        self._timer: Optional[asyncio.Task] = None
+        self._switch: Optional[asyncio.Task] = None
+        self._switch_target: Optional[str] = None
+
+    def add(self, tone: str) -> None:
+        digit = TONE_DIGITS.get(tone)
+        if digit is None:
+            logger.info(f"Unhandled DTMF tone: {tone}")
+            return
+        if digit == "#":
+            # # で入力を確定する
+            self._cancel_timer()
+            self._complete()
+            return
+        digits = self.digits + digit
+        if role_profiles.for_digits(digits) is None and not role_profiles.expects_more(digits):
+            # 続きにならない数字は新しい選択の始まりとする (1 の直後の 2 など)
+            if self.digits:
+                self._collectors.superseded += 1
+                logger.info(f"DTMF selection {self.digits} superseded by {digit}")
+            digits = digit
+        self.digits = digits
+        self._cancel_timer()
+        if role_profiles.expects_more(digits):
+            delay = self._collectors.inter_digit_timeout
+        else:
+            delay = self._collectors.selection_delay
+        if delay > 0:
+            self._timer = loop_monitor.spawn(self._complete_after(delay), self._call_id, "dtmf")
+        else:
+            self._complete()
+
+    async def _complete_after(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._timer = None
+        self._complete()
+
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _complete(self) -> None:
+        digits, self.digits = self.digits, ""
+        profile = role_profiles.for_digits(digits)
+        if profile is None:
+            if digits:
+                self._collectors.invalid += 1
+                logger.info(f"Unhandled DTMF selection: {digits}")
+            return
+        in_flight = self._switch is not None and not self._switch.done()
+        target = self._switch_target if in_flight else self._current_role()
+        if profile.name == target:
+            self._collectors.duplicates += 1
+            logger.info(f"Ignoring repeated DTMF selection of {profile.name}")
+            return
+        if in_flight:
+            self._switch.cancel()
+            self._collectors.cancelled += 1
+            logger.info(f"Cancelling the switch to {self._switch_target} in favor of {profile.name}")
+        self._collectors.applied += 1
+        self._switch_target = profile.name
+        self._switch = loop_monitor.spawn(self._run(profile), self._call_id, "role-switch")
+
+    async def _run(self, profile: RoleProfile) -> None:
+        try:
+            await self._switch_role(profile)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error switching role to {profile.name}: {e}")
+
+    def close(self) -> None:
+        self._cancel_timer()
+        if self._switch is not None and not self._switch.done():
+            self._switch.cancel()
+
+
+class DtmfCollectors:
+    def __init__(self, inter_digit_timeout: float, selection_delay: float) -> None:
+        # inter_digit_timeout は続きの数字を待つ時間、selection_delay は確定済みの選択を適用するまでの待ち時間
+        self.inter_digit_timeout = inter_digit_timeout
+        self.selection_delay = selection_delay
+        self._collectors: Dict[str, DtmfCollector] = {}
+        self.tones = 0
+        self.applied = 0
+        self.superseded = 0
+        self.cancelled = 0
+        self.duplicates = 0
+        self.invalid = 0
+
+    def add(
+        self,
+        call_id: str,
+        tone: str,
+        switch_role: SwitchRole,
+        current_role: Callable[[], Optional[str]]
+    ) -> None:
+        collector = self._collectors.get(call_id)
+        if collector is None:
+            collector = DtmfCollector(self, call_id, switch_role, current_role)
+            self._collectors[call_id] = collector
+        self.tones += 1
+        collector.add(tone)
+
+    def discard(self, call_id: str) -> None:
+        collector = self._collectors.pop(call_id, None)
+        if collector is not None:
+            collector.close()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "inter_digit_timeout_seconds": self.inter_digit_timeout,
+            "selection_delay_seconds": self.selection_delay,
+            "active_calls": len(self._collectors),
+            "tones": self.tones,
+            "applied": self.applied,
+            "superseded": self.superseded,
+            "cancelled": self.cancelled,
+            "duplicates": self.duplicates,
+            "invalid": self.invalid,
+        }
+
+
+dtmf_collectors = DtmfCollectors(
+    inter_digit_timeout = settings.DTMF_INTER_DIGIT_TIMEOUT_SECONDS,
+    selection_delay = settings.DTMF_SELECTION_DELAY_SECONDS
+)
@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from interface import ProcessedEventStoreInterface
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+class ProcessedEventCache:
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        store: Optional[ProcessedEventStoreInterface] = None
+    ) -> None:
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._store = store
+        # key -> 有効期限 (monotonic)
+        self._entries: "OrderedDict[str, float]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+        self.evictions = 0
+
+    async def check_and_mark(self, call_id: str, event_id: Optional[str]) -> bool:
+        # 処理済みなら True を返す。未処理なら処理中として記録して False を返す
+        if not event_id:
+            return False
+        key = f"{call_id}:{event_id}"
+        now = time.monotonic()
+        if self._lookup(key, now):
+            self.hits += 1
+            return True
+
+        # ローカルに記録してから共有ストアを確認し、同時に届いた重複も弾く
+        self._insert(key, now)
+        if self._store:
+            try:
+                if await self._store.exists(key):
+                    self.hits += 1
+                    self.store_hits += 1
+                    return True
+                await self._store.add(key, int(self._ttl_seconds))
+            except Exception as e:
+                logger.error(f"Error accessing processed event store for {key}: {e}")
+        self.misses += 1
+        return False
+
+    async def forget(self, call_id: str, event_id: Optional[str]) -> None:
+        # 処理に失敗したイベントは再配信時に再処理できるよう記録を消す (共有ストアからも消し、他のレプリカでも再処理させる)
+        if not event_id:
+            return
+        key = f"{call_id}:{event_id}"
+        self._entries.pop(key, None)
+        if self._store:
+            try:
+                await self._store.delete(key)
+            except Exception as e:
+                logger.error(f"Error removing {key} from processed event store: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "store_hits": self.store_hits,
+            "evictions": self.evictions,
+        }
+
+    def _lookup(self, key: str, now: float) -> bool:
+        expires_at = self._entries.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= now:
+            del self._entries[key]
+            return False
+        self._entries.move_to_end(key)
+        return True
+
+    def _insert(self, key: str, now: float) -> None:
+        self._entries[key] = now + self._ttl_seconds
+        self._entries.move_to_end(key)
+        # 期限切れの古いエントリと上限超過分を先頭から削除
+        while self._entries:
+            oldest_key, expires_at = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self._max_entries:
+                break
+            del self._entries[oldest_key]
+            self.evictions += 1
@@ -1,4 +1,4 @@
-from typing import Protocol
+from typing import Optional, Protocol
 
 class RealtimeInterface(Protocol):
     async def send_audio_buffer_to_realtime_api(self, audio_data: str) -> None:
@@ -7,8 +7,31 @@ class RealtimeInterface(Protocol):
         ...
     async def rtclient_close(self) -> None:
         ...
+    async def recover(self) -> None:
+        ...
+    async def ping(self) -> None:
+        ...
 
 class WebSocketInterface(Protocol):
     async def send_text_to_acs(self, audio_data_base64: str) -> None:
         ...
 
+class SummarizerInterface(Protocol):
+    async def summarize(self, transcript, role: Optional[str]) -> Optional[str]:
+        ...
+
+class SegmentUploaderInterface(Protocol):
+    def upload(self, segment_path: str, index_path: str) -> None:
+        ...
+
+class CallerProfileStoreInterface(Protocol):
+    async def get(self, caller_id: str) -> Optional[dict]:
+        ...
+
+class ProcessedEventStoreInterface(Protocol):
+    async def exists(self, key: str) -> bool:
+        ...
+    async def add(self, key: str, ttl_seconds: int) -> None:
+        ...
+    async def delete(self, key: str) -> None:
+        ...
@@ -1,9 +1,14 @@
+import time
 import uuid
 import asyncio
+from typing import List, Optional, Tuple
 from models import ConversationState
 from settings import settings
 from call_context import CallContext
-from azure.core.exceptions import ResourceNotFoundError
+from logger import get_logger
+from loop_monitor import loop_monitor
+from metrics import JOB_SUBMIT_TO_OFFER_ACCEPTED_SECONDS
+from azure.core.exceptions import AzureError, HttpResponseError, ResourceNotFoundError
 from azure.communication.jobrouter.aio import JobRouterClient, JobRouterAdministrationClient
 from azure.communication.jobrouter.models import (
     DistributionPolicy,
@@ -12,12 +17,22 @@ from azure.communication.jobrouter.models import (
     RouterWorkerSelector,
     LabelOperator,
     RouterJob,
+    RouterJobOffer,
     AcceptJobOfferResult,
     CloseJobOptions,
     LongestIdleMode,
     RouterChannel
 )
 
+logger = get_logger(__name__)
+
+def is_transient_error(error: Exception) -> bool:
+    # 接続の失敗、タイムアウト、競合、429、5xx はやり直す。それ以外 (認証エラーや存在しないワーカーなど) はやり直しても成功しない
+    if isinstance(error, HttpResponseError):
+        status = error.status_code
+        return status is None or status in (408, 409, 429) or status >= 500
+    return isinstance(error, (AzureError, OSError, asyncio.TimeoutError))
+
 class JobRouterBase:
     def __init__(self, connection_string: str) -> None:
         self._admin_client = JobRouterAdministrationClient.from_connection_string(connection_string)
@@ -61,10 +76,10 @@ class JobRouterBase:
         )
         return job
 
-    async def _accept_job_offer(self, worker: RouterWorker) -> AcceptJobOfferResult:
+    async def _accept_job_offer(self, worker: RouterWorker, offer: RouterJobOffer) -> AcceptJobOfferResult:
         job_offer = await self._client.accept_job_offer(
             worker_id = worker.id,
-            offer_id = worker.offers[0].offer_id
+            offer_id = offer.offer_id
         )
         return job_offer
 
@@ -112,11 +127,11 @@ class JobRouter(JobRouterBase):
         try:
             # 分配ポリシーがすでに存在するか確認
             existing_policy = await self._admin_client.get_distribution_policy(distribution_policy_id = self._distribution_policy_id)
-            print(f"Distribution policy '{self._distribution_policy_id}' already exists. Skipping creation.")
+            logger.info(f"Distribution policy '{self._distribution_policy_id}' already exists. Skipping creation.")
             return existing_policy
         except ResourceNotFoundError:
             # 存在しなければ作成
-            print(f"Distribution policy '{self._distribution_policy_id}' not found. Creating...")
+            logger.info(f"Distribution policy '{self._distribution_policy_id}' not found. Creating...")
             policy = self._create_distribution_policy()
             return await self._upsert_distribution_policy(policy)
     
@@ -132,11 +147,11 @@ class JobRouter(JobRouterBase):
         try:
             # キューがすでに存在するか確認
             existing_queue = await self._admin_client.get_queue(queue_id = self._queue_id)
-            print(f"Queue '{self._queue_id}' already exists. Skipping creation.")
+            logger.info(f"Queue '{self._queue_id}' already exists. Skipping creation.")
             return existing_queue
         except ResourceNotFoundError:
             # 存在しなければ作成
-            print(f"Queue '{self._queue_id}' not found. Creating...")
+            logger.info(f"Queue '{self._queue_id}' not found. Creating...")
             queue = self._create_queue()
             return await self._upsert_queue(queue = queue)
         
@@ -152,9 +167,9 @@ class JobRouter(JobRouterBase):
         try:
             # 既存ワーカーがいるか確認
             await self._client.get_worker(worker_id = self._worker_id)
-            print(f"Worker '{self._worker_id}' already exists. Re-applying labels/channels.")
+            logger.info(f"Worker '{self._worker_id}' already exists. Re-applying labels/channels.")
         except ResourceNotFoundError:
-            print(f"Worker '{self._worker_id}' not found. Creating new one.")
+            logger.info(f"Worker '{self._worker_id}' not found. Creating new one.")
             
         # ワーカーの作成
         fresh = self._create_worker()                   
@@ -203,47 +218,103 @@ class JobRouter(JobRouterBase):
         ]
         return worker_selectors
 
-    async def wait_job_offer(self, conversation_state: ConversationState) -> ConversationState:
+    async def wait_job_offer(
+        self,
+        conversation_state: ConversationState,
+        job_id: str,
+        submitted_at: Optional[float] = None
+    ) -> ConversationState:
         while True:
             try:
-                # ワーカーの状態をポーリングしてオファーを受け入れる
+                # ワーカーの状態をポーリングしてオファーを受け入れる。同じワーカーを複数の通話がポーリングするため、
+                # 自分が投入したジョブのオファーだけを受け入れる
                 await asyncio.sleep(1)
                 worker = await self._client.get_worker(worker_id = self._worker_id)
-                print(f"Debug: Worker {worker.id} offers: {worker.offers}")
-                print("Debug: self._worker_id", self._worker_id)
-                print("Debug: conversation_state", conversation_state)
-                if worker and worker.offers:
-                    job_offer = await self._accept_job_offer(worker = worker)
-                    print(f"Job offer accepted: {job_offer}")
+                logger.debug(
+                    f"Worker {worker.id} offers: {worker.offers}",
+                    category = "job_offer.poll",
+                    call_id = conversation_state.call_id,
+                    job_id = job_id
+                )
+                offers = worker.offers if worker and worker.offers else []
+                offer = next((offer for offer in offers if offer.job_id == job_id), None)
+                if offer is not None:
+                    job_offer = await self._accept_job_offer(worker = worker, offer = offer)
+                    logger.info(f"Job offer accepted: {job_offer}", job_id = job_offer.job_id)
                     conversation_state.job_assignment_id = job_offer.assignment_id
                     conversation_state.worker_id = worker.id
                     conversation_state.job_id = job_offer.job_id
-                    print(f"Worker {worker.id} is assigned job {job_offer.job_id} with assignment ID {job_offer.assignment_id}")
+                    if submitted_at is not None:
+                        JOB_SUBMIT_TO_OFFER_ACCEPTED_SECONDS.observe_since(submitted_at)
+                    logger.info(f"Worker {worker.id} is assigned job {job_offer.job_id} with assignment ID {job_offer.assignment_id}")
                     break
             except Exception as e:
-                print(f"Error accepting job offer: {e}")
-                break
+                if not is_transient_error(e):
+                    raise
+                # 一時的な失敗 (取得やオファーの受け入れ) は次のポーリングでやり直す
+                logger.warning(f"Error accepting job offer for job {job_id}, retrying: {e}", category = "job_offer.error")
         return conversation_state
 
     async def finish_job(self, job: RouterJob) -> None:
         await self._complete_job(job = job)
         await self._close_job(job = job)
         await self._delete_job(job = job)
-        print(f"Job {job.id} completed, closed and deleted.")
+        logger.info(f"Job {job.id} completed, closed and deleted.")
 
     async def finish_job_by_id(self, job_id: str) -> None:
         try:
             job = await self._client.get_job(job_id = job_id)
             await self.finish_job(job = job)
         except ResourceNotFoundError:
-            print(f"Job {job_id} not found.")
+            logger.info(f"Job {job_id} not found.")
+
+    async def cancel_job_by_id(self, job_id: str) -> None:
+        # オファーを受け入れる前のジョブは割り当てがなく finish_job では終了できないため、取り消してから削除する
+        try:
+            await self._client.cancel_job(job_id = job_id)
+            await self._client.delete_job(job_id = job_id)
+            logger.info(f"Job {job_id} cancelled and deleted.")
+        except ResourceNotFoundError:
+            logger.info(f"Job {job_id} not found.")
+
+    async def finish_jobs(self, job_ids: List[str], concurrency: int = 10) -> Tuple[int, int]:
+        # ドレイン時に未完了のジョブをまとめて終了する。(終了した数, 失敗した数) を返す
+        semaphore = asyncio.Semaphore(concurrency)
+        async def finish(job_id: str) -> None:
+            async with semaphore:
+                await self.finish_job_by_id(job_id)
+        results = await asyncio.gather(*(finish(job_id) for job_id in job_ids), return_exceptions = True)
+        failed = [result for result in results if isinstance(result, Exception)]
+        for error in failed:
+            logger.error(f"Error finishing job during drain: {error}")
+        return len(job_ids) - len(failed), len(failed)
+
+    async def set_worker_available(self, available: bool) -> None:
+        await self._client.upsert_worker(
+            worker_id = self._worker_id,
+            available_for_offers = available
+        )
+        logger.info(f"Worker {self._worker_id} available_for_offers set to {available}")
 
     async def create_and_assign_job(self, call_context: CallContext) -> None:
+        # オファーを待つ時間には上限を設ける。割り当てられなかったジョブは取り消してから例外を送出する
+        submitted_at = time.monotonic()
+        job = await self.upsert_job(str(uuid.uuid4()))
+        logger.info(f"Job created and upserted: {job.id}", job_id = job.id)
         try:
-            job = await self.upsert_job(str(uuid.uuid4()))
-            print(f"Job created and upserted: {job.id}")
-            print("Debug: job", job)
-            await self.wait_job_offer(call_context.conversation_state)
-            print(f"Debug: Job offer accepted: {call_context.conversation_state.job_assignment_id}")
+            await asyncio.wait_for(
+                self.wait_job_offer(call_context.conversation_state, job.id, submitted_at),
+                timeout = settings.JOB_OFFER_TIMEOUT_SECONDS
+            )
+        except asyncio.CancelledError:
+            loop_monitor.spawn(self.cancel_job_by_id(job.id), call_context.call_id, "job-cancel", cleanup = True)
+            raise
         except Exception as e:
-            print(f"Error creating and assigning job: {e}")
+            try:
+                await self.cancel_job_by_id(job.id)
+            except Exception as cancel_error:
+                logger.error(f"Failed to cancel job {job.id}: {cancel_error}")
+            if isinstance(e, asyncio.TimeoutError):
+                raise RuntimeError(f"No job offer accepted for job {job.id} within {settings.JOB_OFFER_TIMEOUT_SECONDS}s") from e
+            raise
+        logger.debug(f"Job offer accepted: {call_context.conversation_state.job_assignment_id}")
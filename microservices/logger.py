@@ -0,0 +1,207 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+from settings import settings
+
+# 通話単位のコンテキスト。asyncio のタスクは生成時のコンテキストを引き継ぐ
+call_id_var: ContextVar[Optional[str]] = ContextVar("call_id", default = None)
+job_id_var: ContextVar[Optional[str]] = ContextVar("job_id", default = None)
+
+def bind_call(call_id: Optional[str], job_id: Optional[str] = None) -> None:
+    call_id_var.set(call_id)
+    if job_id is not None:
+        job_id_var.set(job_id)
+
+def bind_job(job_id: Optional[str]) -> None:
+    job_id_var.set(job_id)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        call_id = getattr(record, "call_id", None)
+        if call_id:
+            entry["call_id"] = call_id
+        job_id = getattr(record, "job_id", None)
+        if job_id:
+            entry["job_id"] = job_id
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii = False, default = str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # キューが溢れた場合はイベントループを止めずにレコードを捨てる
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # JSON 化は出力スレッドで行い、ここでは引数の展開だけにとどめる
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimiter:
+    # カテゴリごとのトークンバケット
+    def __init__(self, rate_per_second: float, burst: int) -> None:
+        self._rate_per_second = rate_per_second
+        self._burst = burst
+        self._buckets: Dict[str, list] = {}
+        self.suppressed: Dict[str, int] = {}
+
+    def configure(self, rate_per_second: float, burst: int) -> None:
+        self._rate_per_second = rate_per_second
+        self._burst = burst
+        self._buckets.clear()
+
+    def allow(self, category: str) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.get(category)
+        if bucket is None:
+            bucket = [float(self._burst), now]
+            self._buckets[category] = bucket
+        tokens = min(self._burst, bucket[0] + (now - bucket[1]) * self._rate_per_second)
+        bucket[1] = now
+        if tokens < 1.0:
+            bucket[0] = tokens
+            self.suppressed[category] = self.suppressed.get(category, 0) + 1
+            return False
+        bucket[0] = tokens - 1.0
+        return True
+
+    def pop_suppressed(self, category: str) -> int:
+        return self.suppressed.pop(category, 0)
+
+
+class StructuredLogger:
+    def __init__(self, logger: logging.Logger, rate_limiter: RateLimiter) -> None:
+        self._logger = logger
+        self._rate_limiter = rate_limiter
+
+    def log(self, level: int, msg: str, **fields: Any) -> None:
+        self._log(level, msg, fields)
+
+    def debug(self, msg: str, **fields: Any) -> None:
+        self._log(logging.DEBUG, msg, fields)
+
+    def info(self, msg: str, **fields: Any) -> None:
+        self._log(logging.INFO, msg, fields)
+
+    def warning(self, msg: str, **fields: Any) -> None:
+        self._log(logging.WARNING, msg, fields)
+
+    def error(self, msg: str, **fields: Any) -> None:
+        self._log(logging.ERROR, msg, fields)
+
+    def exception(self, msg: str, **fields: Any) -> None:
+        fields["exc_info"] = True
+        self._log(logging.ERROR, msg, fields)
+
+    def is_enabled_for(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def _log(self, level: int, msg: str, fields: Dict[str, Any]) -> None:
+        # ホットパスではレベル判定だけで戻れるようにする
+        if not self._logger.isEnabledFor(level):
+            return
+        # category: レート制限の単位 / sample: 出力する確率 (0.0 - 1.0)
+        category = fields.pop("category", None)
+        sample = fields.pop("sample", None)
+        if sample is not None and random.random() >= sample:
+            return
+        if category is not None:
+            if not self._rate_limiter.allow(category):
+                return
+            suppressed = self._rate_limiter.pop_suppressed(category)
+            if suppressed:
+                fields["suppressed"] = suppressed
+            fields["category"] = category
+        exc_info = fields.pop("exc_info", None)
+        self._logger.log(
+            level,
+            msg,
+            exc_info = exc_info,
+            extra = {
+                "call_id": fields.pop("call_id", None) or call_id_var.get(),
+                "job_id": fields.pop("job_id", None) or job_id_var.get(),
+                "fields": fields,
+            }
+        )
+
+
+_ROOT_LOGGER_NAME = "callcenter"
+_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize = settings.LOG_QUEUE_SIZE)
+_queue_handler = DroppingQueueHandler(_queue)
+_rate_limiter = RateLimiter(settings.LOG_RATE_LIMIT_PER_SECOND, settings.LOG_RATE_LIMIT_BURST)
+_listener: Optional[logging.handlers.QueueListener] = None
+_listener_lock = threading.Lock()
+
+def _root_logger() -> logging.Logger:
+    root = logging.getLogger(_ROOT_LOGGER_NAME)
+    if not root.handlers:
+        root.addHandler(_queue_handler)
+        root.setLevel(settings.LOG_LEVEL.upper())
+        root.propagate = False
+    return root
+
+def start_logging() -> None:
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            stream_handler = logging.StreamHandler(sys.stdout)
+            stream_handler.setFormatter(JsonFormatter())
+            _listener = logging.handlers.QueueListener(_queue, stream_handler)
+            _listener.start()
+
+def stop_logging() -> None:
+    # キューに残ったレコードを出力してからスレッドを止める
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+def get_logger(name: str) -> StructuredLogger:
+    _root_logger()
+    start_logging()
+    return StructuredLogger(logging.getLogger(f"{_ROOT_LOGGER_NAME}.{name}"), _rate_limiter)
+
+def set_level(level: str) -> None:
+    _root_logger().setLevel(level.upper())
+
+def get_level() -> str:
+    return logging.getLevelName(_root_logger().level)
+
+def configure_rate_limit(rate_per_second: float, burst: int) -> None:
+    _rate_limiter.configure(rate_per_second, burst)
+
+def stats() -> Dict[str, Any]:
+    return {
+        "level": get_level(),
+        "queued": _queue.qsize(),
+        "dropped": _queue_handler.dropped,
+        "suppressed": dict(_rate_limiter.suppressed),
+    }
@@ -0,0 +1,36 @@
+import asyncio
+import json
+import os
+from typing import Any, Dict, Optional
+
+# コントロールプレーンとメディアワーカー間の IPC。unix ソケット上で 1 行 1 メッセージの JSON を送り合う。
+# 要求は {"id", "op", ...}、応答は {"id", "ok", ...}、ワーカーからの通知は {"event", "call_id", ...}
+OP_PREPARE = "prepare"
+OP_START = "start"
+OP_STATE = "state"
+OP_CLOSE = "close"
+OP_PING = "ping"
+
+EVENT_MEDIA_CONNECTED = "media_connected"
+EVENT_MEDIA_CLOSED = "media_closed"
+# ワーカーのウォッチドッグが切断する通話。コントロールプレーンが ACS 通話とジョブを片付ける
+EVENT_MEDIA_STALLED = "media_stalled"
+# 要約はワーカーで更新されるため、転送に使えるようコントロールプレーンの会話状態に反映する
+EVENT_SUMMARY = "summary"
+
+# 会話状態を載せるため、asyncio の既定 (64KiB) より大きい行を許す
+STREAM_LIMIT = 1024 * 1024
+
+def socket_path(directory: str, index: int) -> str:
+    return os.path.join(directory, f"media-{index}.sock")
+
+async def send_message(writer: asyncio.StreamWriter, message: Dict[str, Any]) -> None:
+    writer.write(json.dumps(message).encode() + b"\n")
+    await writer.drain()
+
+async def read_message(reader: asyncio.StreamReader) -> Optional[Dict[str, Any]]:
+    # 接続が閉じられたら None を返す
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
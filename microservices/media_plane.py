@@ -0,0 +1,343 @@
+import asyncio
+import itertools
+import os
+import sys
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from urllib.parse import urlparse
+from settings import settings
+from models import ConversationState
+from logger import get_logger
+from loop_monitor import loop_monitor
+from trace_recorder import recorder as trace_recorder
+from admission import admission_controller
+from media_ipc import (
+    EVENT_MEDIA_CLOSED,
+    EVENT_MEDIA_CONNECTED,
+    EVENT_MEDIA_STALLED,
+    EVENT_SUMMARY,
+    OP_CLOSE,
+    OP_PREPARE,
+    OP_START,
+    OP_STATE,
+    STREAM_LIMIT,
+    read_message,
+    send_message,
+    socket_path
+)
+
+logger = get_logger(__name__)
+
+# 音声の中継を webhook とは別のプロセスに分ける。コントロールプレーン (このプロセス) は着信と
+# コールバックを処理し、通話ごとにメディアワーカーを 1 つ選んで、ACS の WebSocket をそのワーカーに
+# 直接つながせる。ロールの切り替えや切断はワーカーの unix ソケット経由で指示する
+MEDIA_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "media_worker.py")
+# ワーカーの起動を待つ最大時間
+CONNECT_TIMEOUT_SECONDS = 30.0
+# realtime セッションの開始は接続を待つため、他の指示より長く待つ
+START_TIMEOUT_SECONDS = 30.0
+
+class MediaWorker:
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        # 割り当て済みでメディアがまだ接続していない通話と、中継中の通話
+        self.prepared: Set[str] = set()
+        self.active: Set[str] = set()
+        self.restarts = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None and self.writer is not None
+
+    def load(self) -> int:
+        return len(self.prepared) + len(self.active)
+
+
+class MediaPlane:
+    def __init__(
+        self,
+        workers: int,
+        base_port: int,
+        websocket_baseurl: str,
+        callback_baseurl: str,
+        ipc_directory: str,
+        ipc_timeout: float = 5.0,
+        restart_delay: float = 1.0
+    ) -> None:
+        self._workers = [MediaWorker(index) for index in range(max(0, workers))]
+        self._base_port = base_port
+        self._websocket_baseurl = websocket_baseurl or f"wss://{urlparse(callback_baseurl).netloc}/media/{{worker}}"
+        self._ipc_directory = ipc_directory
+        self._ipc_timeout = ipc_timeout
+        self._restart_delay = restart_delay
+        # call_id -> 担当ワーカー
+        self._assignments: Dict[str, MediaWorker] = {}
+        self._request_ids = itertools.count(1)
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+        self._on_stalled: Optional[Callable[[str, str], Awaitable[None]]] = None
+        self._on_summary: Optional[Callable[[str, str], None]] = None
+        self.requests = 0
+        self.request_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._workers)
+
+    def configure(
+        self,
+        on_stalled: Callable[[str, str], Awaitable[None]],
+        on_summary: Callable[[str, str], None]
+    ) -> None:
+        # on_stalled はワーカーのウォッチドッグが切断する通話 (call_id, 理由) を片付ける処理
+        # on_summary はワーカーで更新された要約 (call_id, 要約) を会話状態に反映する処理
+        self._on_stalled = on_stalled
+        self._on_summary = on_summary
+
+    async def start(self) -> None:
+        if not self.enabled or self._tasks:
+            return
+        os.makedirs(self._ipc_directory, exist_ok = True)
+        self._stopping = False
+        await asyncio.gather(*(self._launch(worker) for worker in self._workers))
+        for worker in self._workers:
+            self._tasks.append(loop_monitor.spawn(self._supervise(worker), None, "media-plane"))
+        logger.info(f"Started {len(self._workers)} media workers")
+
+    async def stop(self) -> None:
+        if not self._tasks:
+            return
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions = True)
+        self._tasks = []
+        await asyncio.gather(*(self._terminate(worker) for worker in self._workers))
+
+    async def _launch(self, worker: MediaWorker) -> None:
+        path = socket_path(self._ipc_directory, worker.index)
+        if os.path.exists(path):
+            os.remove(path)
+        # 文字起こしとトレースはワーカーごとに分けて書く (セグメント番号やファイル名の衝突を避ける)
+        env = dict(os.environ)
+        env["TRANSCRIPT_ARCHIVE_DIRECTORY"] = os.path.join(settings.TRANSCRIPT_ARCHIVE_DIRECTORY, f"media-{worker.index}")
+        env["TRACE_DIRECTORY"] = os.path.join(settings.TRACE_DIRECTORY, f"media-{worker.index}")
+        worker.process = await asyncio.create_subprocess_exec(
+            sys.executable, MEDIA_WORKER_SCRIPT, "--index", str(worker.index),
+            env = env
+        )
+        reader, worker.writer = await self._connect(worker, path)
+        loop_monitor.spawn(self._read_loop(worker, reader), None, "media-ipc")
+
+    async def _connect(self, worker: MediaWorker, path: str):
+        deadline = asyncio.get_running_loop().time() + CONNECT_TIMEOUT_SECONDS
+        while True:
+            try:
+                return await asyncio.open_unix_connection(path, limit = STREAM_LIMIT)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if worker.process.returncode is not None:
+                    raise RuntimeError(f"Media worker {worker.index} exited with {worker.process.returncode} during startup")
+                if asyncio.get_running_loop().time() > deadline:
+                    raise RuntimeError(f"Media worker {worker.index} did not open {path} in time")
+                await asyncio.sleep(0.1)
+
+    async def _supervise(self, worker: MediaWorker) -> None:
+        # 落ちたワーカーは起動し直す。中継中だった通話は ACS 側で WebSocket が切れるため引き継がない
+        while True:
+            returncode = await worker.process.wait()
+            if self._stopping:
+                return
+            lost = worker.load()
+            logger.error(f"Media worker {worker.index} exited with {returncode}, dropping {lost} calls and restarting")
+            self._forget(worker)
+            worker.restarts += 1
+            await asyncio.sleep(self._restart_delay)
+            try:
+                await self._launch(worker)
+            except Exception as e:
+                logger.error(f"Failed to restart media worker {worker.index}: {e}")
+
+    def _forget(self, worker: MediaWorker) -> None:
+        for call_id in worker.prepared | worker.active:
+            self._assignments.pop(call_id, None)
+            admission_controller.release(call_id)
+        worker.prepared.clear()
+        worker.active.clear()
+
+    async def _terminate(self, worker: MediaWorker) -> None:
+        if worker.writer is not None:
+            worker.writer.close()
+        if worker.process is None or worker.process.returncode is not None:
+            return
+        worker.process.terminate()
+        try:
+            await asyncio.wait_for(worker.process.wait(), timeout = self._ipc_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Media worker {worker.index} did not exit, killing it")
+            worker.process.kill()
+            await worker.process.wait()
+
+    async def _read_loop(self, worker: MediaWorker, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                if "id" in message:
+                    future = worker.pending.pop(message["id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+                else:
+                    self._on_event(worker, message)
+        except Exception as e:
+            logger.error(f"Lost the IPC connection to media worker {worker.index}: {e}")
+        finally:
+            worker.writer = None
+            for future in worker.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Media worker {worker.index} disconnected"))
+            worker.pending.clear()
+
+    def _on_event(self, worker: MediaWorker, message: Dict[str, Any]) -> None:
+        call_id = message.get("call_id")
+        event = message.get("event")
+        if event == EVENT_MEDIA_CONNECTED:
+            # 以降は中継中の通話として数える
+            worker.prepared.discard(call_id)
+            worker.active.add(call_id)
+            admission_controller.release(call_id)
+            trace_recorder.record(call_id, "media_connected", worker = worker.index)
+        elif event == EVENT_MEDIA_CLOSED:
+            worker.active.discard(call_id)
+            self._assignments.pop(call_id, None)
+            trace_recorder.media_closed(call_id)
+        elif event == EVENT_MEDIA_STALLED:
+            if self._on_stalled is not None:
+                loop_monitor.spawn(self._on_stalled(call_id, message.get("reason")), call_id, "media-plane", cleanup = True)
+        elif event == EVENT_SUMMARY:
+            if self._on_summary is not None:
+                self._on_summary(call_id, message.get("summary"))
+        else:
+            logger.warning(f"Unknown media worker event: {event}")
+
+    async def _request(self, worker: MediaWorker, op: str, timeout: Optional[float] = None, **fields: Any) -> Dict[str, Any]:
+        if not worker.alive:
+            raise ConnectionError(f"Media worker {worker.index} is not running")
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        worker.pending[request_id] = future
+        self.requests += 1
+        try:
+            await send_message(worker.writer, {"id": request_id, "op": op, **fields})
+            response = await asyncio.wait_for(future, timeout = timeout or self._ipc_timeout)
+        except Exception:
+            self.request_errors += 1
+            raise
+        finally:
+            worker.pending.pop(request_id, None)
+        if not response.get("ok"):
+            self.request_errors += 1
+            raise RuntimeError(f"Media worker {worker.index} failed {op}: {response.get('error')}")
+        return response
+
+    async def request(self, call_id: str, op: str, timeout: Optional[float] = None, **fields: Any) -> Dict[str, Any]:
+        worker = self._assignments.get(call_id)
+        if worker is None:
+            raise RuntimeError(f"No media worker is assigned to call_id {call_id}")
+        return await self._request(worker, op, timeout, call_id = call_id, **fields)
+
+    async def prepare(self, conversation_state: ConversationState) -> None:
+        # 応答前に、最も空いているワーカーへ通話を割り当てて会話状態を渡しておく
+        workers = [worker for worker in self._workers if worker.alive]
+        if not workers:
+            raise RuntimeError("No media worker is running")
+        worker = min(workers, key = lambda worker: worker.load())
+        call_id = conversation_state.call_id
+        self._assignments[call_id] = worker
+        worker.prepared.add(call_id)
+        try:
+            await self._request(worker, OP_PREPARE, call_id = call_id, state = conversation_state.model_dump())
+        except Exception:
+            self.discard(call_id)
+            raise
+
+    async def sync(self, conversation_state: ConversationState) -> None:
+        # コールバックで更新した会話状態 (接続時刻など) をワーカーに反映する
+        await self.request(conversation_state.call_id, OP_STATE, state = conversation_state.model_dump())
+
+    def websocket_url(self, call_id: str) -> str:
+        worker = self._assignments[call_id]
+        base_url = self._websocket_baseurl.format(worker = worker.index, port = self._base_port + worker.index)
+        return f"{base_url}/ws/{call_id}"
+
+    def realtime(self, call_id: str) -> Optional["RemoteRealtime"]:
+        if call_id not in self._assignments:
+            return None
+        return RemoteRealtime(self, call_id)
+
+    def discard(self, call_id: str) -> None:
+        # 切断された通話の割り当てを外し、ワーカーに残っている状態を片付けさせる
+        worker = self._assignments.pop(call_id, None)
+        if worker is None:
+            return
+        worker.prepared.discard(call_id)
+        if worker.alive:
+            loop_monitor.spawn(self._close(worker, call_id), None, "media-ipc")
+
+    async def _close(self, worker: MediaWorker, call_id: str) -> None:
+        try:
+            await self._request(worker, OP_CLOSE, call_id = call_id)
+        except Exception as e:
+            logger.warning(f"Failed to close call_id {call_id} on media worker {worker.index}: {e}")
+
+    async def close_all(self) -> int:
+        # ドレインの期限を過ぎて残っている通話をワーカー側で切断する
+        calls = [(worker, call_id) for worker in self._workers for call_id in worker.active if worker.alive]
+        await asyncio.gather(*(self._close(worker, call_id) for worker, call_id in calls))
+        return len(calls)
+
+    def active_calls(self) -> int:
+        return sum(len(worker.active) for worker in self._workers)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "workers": len(self._workers),
+            "alive": sum(1 for worker in self._workers if worker.alive),
+            "prepared_calls": sum(len(worker.prepared) for worker in self._workers),
+            "active_calls": self.active_calls(),
+            "restarts": sum(worker.restarts for worker in self._workers),
+            "requests": self.requests,
+            "request_errors": self.request_errors,
+        }
+
+
+class RemoteRealtime:
+    # 別プロセスのメディアワーカーにある Realtime の代理。ロール切り替えと切断だけを IPC で指示する
+    # (音声はワーカー内で完結するため send_audio_buffer_to_realtime_api は持たない)
+    def __init__(self, media_plane: MediaPlane, call_id: str) -> None:
+        self._media_plane = media_plane
+        self._call_id = call_id
+
+    async def start_realtime_conversation_loop(self, conversation_state: ConversationState) -> None:
+        await self._media_plane.request(
+            self._call_id,
+            OP_START,
+            timeout = START_TIMEOUT_SECONDS,
+            state = conversation_state.model_dump()
+        )
+
+    async def rtclient_close(self) -> None:
+        await self._media_plane.request(self._call_id, OP_CLOSE)
+
+
+media_plane = MediaPlane(
+    workers = settings.MEDIA_WORKERS,
+    base_port = settings.MEDIA_WORKER_BASE_PORT,
+    websocket_baseurl = settings.MEDIA_WEBSOCKET_BASEURL,
+    callback_baseurl = settings.CALLBACK_BASEURL,
+    ipc_directory = settings.MEDIA_IPC_DIRECTORY,
+    ipc_timeout = settings.MEDIA_IPC_TIMEOUT_SECONDS,
+    restart_delay = settings.MEDIA_WORKER_RESTART_DELAY_SECONDS
+)
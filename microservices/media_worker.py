@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import os
+import uvicorn
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+from fastapi import FastAPI
+from fastapi import WebSocket as FastAPIWebSocket
+from fastapi.responses import JSONResponse, PlainTextResponse
+from settings import settings
+from state_manager import ConversationStateManager, RealtimeManager
+from websocket import WebSocket as ACSWebSocket
+from logger import get_logger, bind_call, start_logging, stop_logging
+import logger as log_config
+from metrics import registry as metrics_registry, stats_collector
+from trace_recorder import recorder as trace_recorder
+from loop_monitor import loop_monitor
+from realtime import create_rtclient, synthesize_prompt
+from realtime_pool import realtime_pool
+from role_profiles import role_profiles
+from summarizer import conversation_summaries
+from transcript_archive import transcript_archive
+from call_recorder import call_recorder
+from call_watchdog import call_watchdog
+from prompt_audio import prompt_audio
+from media_ipc import (
+    EVENT_MEDIA_CLOSED,
+    EVENT_MEDIA_CONNECTED,
+    EVENT_MEDIA_STALLED,
+    EVENT_SUMMARY,
+    OP_CLOSE,
+    OP_PING,
+    OP_PREPARE,
+    OP_START,
+    OP_STATE,
+    STREAM_LIMIT,
+    read_message,
+    send_message,
+    socket_path
+)
+
+logger = get_logger(__name__)
+
+# メディアワーカー。ACS のメディア WebSocket と realtime クライアントだけを持ち、
+# コントロールプレーン (app.py) からの指示を unix ソケットで受ける。
+# 起動: python media_worker.py --index 0 (通常は app.py が MEDIA_WORKERS の数だけ起動する)
+class MediaWorkerServer:
+    def __init__(
+        self,
+        index: int,
+        conversation_state_manager: ConversationStateManager,
+        realtime_manager: RealtimeManager
+    ) -> None:
+        self._index = index
+        self._conversation_state_manager = conversation_state_manager
+        self._realtime_manager = realtime_manager
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._write_lock = asyncio.Lock()
+        # call_id -> 中継中の ACS WebSocket
+        self._relays: Dict[str, ACSWebSocket] = {}
+        self.requests = 0
+        self.request_errors = 0
+
+    async def start(self, path: str) -> None:
+        if os.path.exists(path):
+            os.remove(path)
+        self._server = await asyncio.start_unix_server(self._handle_connection, path = path, limit = STREAM_LIMIT)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # コントロールプレーンからの接続は 1 本だけ。再起動後につなぎ直された場合は新しい接続に切り替える
+        self._writer = writer
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                # realtime の接続を待つ指示で他の指示を止めないよう、1 件ずつタスクで処理する
+                loop_monitor.spawn(self._respond(message), message.get("call_id"), "media-ipc")
+        except Exception as e:
+            logger.error(f"IPC connection from the control plane failed: {e}")
+        finally:
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
+
+    async def _respond(self, message: Dict[str, Any]) -> None:
+        self.requests += 1
+        try:
+            result = await self._dispatch(message)
+            response = {"id": message.get("id"), "ok": True, **result}
+        except Exception as e:
+            self.request_errors += 1
+            logger.error(f"Failed to handle {message.get('op')} for call_id {message.get('call_id')}: {e}")
+            response = {"id": message.get("id"), "ok": False, "error": str(e)}
+        await self._send(response)
+
+    async def _dispatch(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        op = message.get("op")
+        call_id = message.get("call_id")
+        if op == OP_PING:
+            return {"calls": len(self._relays)}
+        if op == OP_PREPARE:
+            self._conversation_state_manager.create(call_id)
+            self._conversation_state_manager.update(call_id, **message["state"])
+            trace_recorder.begin(call_id, app = "microservices-media", worker = self._index)
+            return {}
+        if op == OP_STATE:
+            self._conversation_state_manager.update(call_id, **message["state"])
+            return {}
+        if op == OP_START:
+            # ロールの切り替え。メディアがまだ接続していなければ、接続時に新しいロールで始まる
+            self._conversation_state_manager.update(call_id, **message["state"])
+            conversation_state = self._conversation_state_manager.get(call_id)
+            realtime = self._realtime_manager.get(call_id)
+            if conversation_state is not None and realtime is not None and call_id in self._relays:
+                await realtime.start_realtime_conversation_loop(conversation_state)
+            return {}
+        if op == OP_CLOSE:
+            ws = self._relays.get(call_id)
+            if ws is not None and ws.relay_task is not None:
+                # 中継を止めると realtime クライアントも閉じられ、media_closed を通知する
+                ws.relay_task.cancel()
+            else:
+                self._conversation_state_manager.delete(call_id)
+                trace_recorder.end(call_id)
+            return {}
+        raise ValueError(f"Unknown op: {op}")
+
+    async def _send(self, message: Dict[str, Any]) -> None:
+        writer = self._writer
+        if writer is None:
+            return
+        try:
+            async with self._write_lock:
+                await send_message(writer, message)
+        except Exception as e:
+            logger.warning(f"Failed to send {message.get('event') or 'a response'} to the control plane: {e}")
+
+    def attach(self, call_id: str, ws: ACSWebSocket) -> None:
+        self._relays[call_id] = ws
+        loop_monitor.spawn(self._send({"event": EVENT_MEDIA_CONNECTED, "call_id": call_id}), call_id, "media-ipc")
+        ws.relay_task.add_done_callback(lambda _: self._detach(call_id, ws))
+
+    async def stalled(self, call_id: str, reason: str) -> None:
+        # ウォッチドッグが中継を止める前に、ACS 通話とジョブの片付けをコントロールプレーンに任せる
+        await self._send({"event": EVENT_MEDIA_STALLED, "call_id": call_id, "reason": reason})
+
+    def summary(self, call_id: str, summary: str) -> None:
+        # 転送はコントロールプレーンが行うため、更新した要約を都度渡しておく
+        loop_monitor.spawn(self._send({"event": EVENT_SUMMARY, "call_id": call_id, "summary": summary}), call_id, "media-ipc")
+
+    def _detach(self, call_id: str, ws: ACSWebSocket) -> None:
+        if self._relays.get(call_id) is ws:
+            del self._relays[call_id]
+            self._conversation_state_manager.delete(call_id)
+            self._realtime_manager.delete(call_id)
+        loop_monitor.spawn(self._send({"event": EVENT_MEDIA_CLOSED, "call_id": call_id}), None, "media-ipc")
+        # 中継が終わった通話のタスク (ウォッチドッグの ping など) を残さない
+        loop_monitor.spawn(loop_monitor.cancel_call(call_id), None, "media-ipc")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "index": self._index,
+            "connected": int(self._writer is not None),
+            "calls": len(self._relays),
+            "requests": self.requests,
+            "request_errors": self.request_errors,
+        }
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_logging()
+    role_profiles.load()
+    loop_monitor.start()
+    app.state.conversation_state_manager = ConversationStateManager()
+    app.state.realtime_manager = RealtimeManager()
+    app.state.media_worker = MediaWorkerServer(
+        app.state.worker_index,
+        app.state.conversation_state_manager,
+        app.state.realtime_manager
+    )
+    trace_recorder.start()
+    transcript_archive.start()
+    call_recorder.start()
+    realtime_pool.start(create_rtclient)
+    prompt_audio.configure(synthesize_prompt)
+    loop_monitor.spawn(prompt_audio.warm(role_profiles.prompts()), None, "prompt-audio")
+    conversation_summaries.configure(app.state.media_worker.summary)
+    await conversation_summaries.start()
+    call_watchdog.configure(app.state.media_worker.stalled)
+    call_watchdog.start()
+    register_metrics_collectors(app)
+    # コントロールプレーンはソケットが作られるのを待って接続するため、準備がすべて済んでから開く
+    await app.state.media_worker.start(socket_path(settings.MEDIA_IPC_DIRECTORY, app.state.worker_index))
+    yield
+    await app.state.media_worker.stop()
+    await call_watchdog.stop()
+    await app.state.realtime_manager.close_all()
+    await conversation_summaries.stop()
+    await realtime_pool.stop()
+    call_recorder.stop()
+    transcript_archive.stop()
+    trace_recorder.stop()
+    await loop_monitor.stop()
+    stop_logging()
+
+def register_metrics_collectors(app: FastAPI) -> None:
+    metrics_registry.add_collector(
+        stats_collector("callcenter_media_worker", app.state.media_worker.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_logger", log_config.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_trace_recorder", trace_recorder.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_event_loop", loop_monitor.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_realtime_pool", realtime_pool.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_conversation_summary", conversation_summaries.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_transcript_archive", transcript_archive.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_call_recorder", call_recorder.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_watchdog", call_watchdog.stats)
+    )
+    metrics_registry.add_collector(
+        stats_collector("callcenter_prompt_audio", prompt_audio.stats)
+    )
+
+app = FastAPI(lifespan = lifespan)
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type = "text/plain; version=0.0.4")
+
+@app.get("/debug/loop")
+async def get_loop_status(limit: int = 10):
+    return JSONResponse(content = loop_monitor.snapshot(limit))
+
+# worker はパスの書き換えなしにイングレスから振り分けられるようにするためのもの
+@app.websocket("/media/{worker}/ws/{call_id}")
+async def websocket_endpoint(websocket: FastAPIWebSocket, worker: int, call_id: str):
+    bind_call(call_id)
+    logger.info("WebSocket connection established")
+    trace_recorder.record(call_id, "media_connected")
+    conversation_state = websocket.app.state.conversation_state_manager.get(call_id)
+    if conversation_state is None:
+        logger.warning(f"No conversation state prepared on media worker {websocket.app.state.worker_index}")
+        await websocket.close()
+        return
+    call_recorder.begin(call_id)
+    ws = ACSWebSocket(websocket, call_id, None)
+    realtime = websocket.app.state.realtime_manager.create(call_id, ws)
+    ws._realtime = realtime
+    await ws.websocket_handler(conversation_state)
+    websocket.app.state.media_worker.attach(call_id, ws)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", type = int, default = 0)
+    args = parser.parse_args()
+    app.state.worker_index = args.index
+    uvicorn.run(
+        app,
+        host = "0.0.0.0",
+        port = settings.MEDIA_WORKER_BASE_PORT + args.index,
+        ws_ping_interval = settings.WEBSOCKET_PING_INTERVAL_SECONDS,
+        ws_ping_timeout = settings.WEBSOCKET_PING_TIMEOUT_SECONDS
+    )
@@ -4,9 +4,18 @@ from typing import Optional
 class ConversationState(BaseModel):
     call_id: str
     caller_id: Optional[str] = None
+    # ACS の callConnectionId (CallConnected で設定)。call_id はアプリが振った ID のため切断には使えない
+    call_connection_id: Optional[str] = None
     current_role: Optional[str] = None
     job_id: Optional[str] = None
     job_assignment_id: Optional[str] = None
     queue_id: Optional[str] = None
     worker_id: Optional[str] = None
     conversation_summary: Optional[str] = None
+    # ロールの指示に追記する発信者の情報 (caller_contexts から取得)
+    caller_context: Optional[str] = None
+    # 受付制御で話中案内を流して切断する通話
+    busy: bool = False
+    # レイテンシ計測用の monotonic タイムスタンプ
+    connected_at: Optional[float] = None
+    role_switch_requested_at: Optional[float] = None
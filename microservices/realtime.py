@@ -1,32 +1,114 @@
 import asyncio
+import base64
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple
 from settings import settings
 from models import ConversationState
-from realtime_instruct import get_instructions
+from role_profiles import RoleProfile, role_profiles
 from azure.core.credentials import AzureKeyCredential
 from interface import RealtimeInterface, WebSocketInterface
+from logger import get_logger
+from trace_recorder import recorder as trace_recorder
+from loop_monitor import loop_monitor
+from realtime_pool import realtime_pool
+from summarizer import conversation_summaries
+from transcript_archive import transcript_archive
+from call_watchdog import call_watchdog
+from caller_context import caller_contexts
+from prompt_audio import PromptAudio, prompt_audio
+from speech_detector import create_speech_detector
+from metrics import (
+    base64_decoded_length,
+    CALL_CONNECTED_TO_FIRST_AUDIO_SECONDS,
+    DTMF_TO_ROLE_AUDIO_SECONDS,
+    REALTIME_CONNECT_SECONDS,
+    REALTIME_DISCONNECTS,
+    REALTIME_RECONNECTS_SUCCEEDED,
+    REALTIME_RECONNECTS_FAILED,
+    REALTIME_RECOVERY_SECONDS,
+    REALTIME_SPEECH_OPENS
+)
 from rtclient import (
     ResponseCreateMessage,
     RTLowLevelClient,
-    ResponseCreateParams,
-    InputAudioBufferAppendMessage
+    InputAudioBufferAppendMessage,
+    ItemCreateMessage,
+    UserMessageItem,
+    AssistantMessageItem,
+    InputTextContentPart,
+    OutputTextContentPart
 )
 
+logger = get_logger(__name__)
+
+# PCM 24kHz 16bit mono
+AUDIO_BYTES_PER_SECOND = 48000
+
+def create_rtclient() -> RTLowLevelClient:
+    return RTLowLevelClient(
+        url = settings.AZURE_OPENAI_SERVICE_ENDPOINT,
+        azure_deployment = settings.AZURE_OPENAI_DEPLOYMENT_NAME,
+        key_credential = AzureKeyCredential(settings.AZURE_OPENAI_SERVICE_KEY),
+    )
+
+async def synthesize_prompt(profile: RoleProfile) -> bytes:
+    # 定型文を一度だけモデルに読ませて PCM を得る (prompt_audio がキャッシュする)
+    rtclient = create_rtclient()
+    await rtclient.connect()
+    try:
+        await rtclient.ws.send_str(profile.prompt_synthesis_payload)
+        chunks = []
+        while True:
+            message = await rtclient.recv()
+            if message is None:
+                raise ConnectionError("Realtime session closed before the prompt was synthesized")
+            if message.type == "response.audio.delta":
+                chunks.append(base64.b64decode(message.delta))
+            elif message.type == "response.done":
+                return b"".join(chunks)
+            elif message.type == "error":
+                raise RuntimeError(f"Realtime API error while synthesizing a prompt: {message}")
+    finally:
+        await rtclient.close()
+
 class Realtime(RealtimeInterface):
     def __init__(self, webSocket: WebSocketInterface) -> None:
-        self._aoai_service_endpoint = settings.AZURE_OPENAI_SERVICE_ENDPOINT
-        self._aoai_deployment_name = settings.AZURE_OPENAI_DEPLOYMENT_NAME
-        self._aoai_service_key = settings.AZURE_OPENAI_SERVICE_KEY
         self._rtclient = self._init_rtclient()
         self._transcript_buffer = ""
         self._send_text_to_acs = webSocket.send_text_to_acs
         self._transfer_task: asyncio.Task | None = None
+        self._conversation_state: ConversationState | None = None
+        self._awaiting_first_audio = False
+        # 再接続時に再送する直近の受信音声 (通し番号, Base64 音声, バイト数)
+        self._inbound_audio: Deque[Tuple[int, str, int]] = deque()
+        self._inbound_audio_bytes = 0
+        self._inbound_audio_seq = 0
+        self._max_inbound_audio_bytes = int(settings.REALTIME_REPLAY_SECONDS * AUDIO_BYTES_PER_SECOND)
+        # 再接続時に復元する直近の会話 (role, text)
+        self._recent_items: Deque[Tuple[str, str]] = deque(maxlen = settings.REALTIME_RESTORE_ITEMS)
+        self._reconnecting = False
+        self._closing = False
+        # 定型文をキャッシュした音声で流している間は realtime に接続しない
+        self._prompt_task: asyncio.Task | None = None
+        self._local_prompt = False
+        # 定型文の間に発話を検知したら開く realtime セッション (REALTIME_LAZY_CONNECT が False ならすぐに開く)
+        self._speech = create_speech_detector()
+        self._open_task: asyncio.Task | None = None
 
     def _init_rtclient(self) -> RTLowLevelClient:
-        rtclient = RTLowLevelClient(
-            url = self._aoai_service_endpoint,
-            azure_deployment = self._aoai_deployment_name,
-            key_credential = AzureKeyCredential(self._aoai_service_key),
-        )
+        return create_rtclient()
+
+    async def _connect(self) -> RTLowLevelClient:
+        # 待機中の接続があれば使い、なければ新規に接続する
+        rtclient = await realtime_pool.acquire()
+        if rtclient is None:
+            rtclient = self._init_rtclient()
+            try:
+                await rtclient.connect()
+            except asyncio.CancelledError:
+                await self._close_quietly(rtclient)
+                raise
         return rtclient
     
     async def start_realtime_conversation_loop(self, conversation_state: ConversationState) -> None:
@@ -37,53 +119,302 @@ class Realtime(RealtimeInterface):
                 await self._transfer_task
             except asyncio.CancelledError:
                 pass
-            # クライアント側もクローズしてから再初期化
+            # クライアント側もクローズしてから再接続
             await self._rtclient.close()
-            self._rtclient = self._init_rtclient()
+            self._transfer_task = None
+        self._stop_prompt()
+        self._cancel_open()
+        self._closing = False
+        # ロールが変わると会話も新しく始まるため、復元用の会話履歴は引き継がない
+        self._recent_items.clear()
         current_role = conversation_state.current_role
-        instructions = get_instructions(current_role)
-        await self._rtclient.connect()
-        await self._send_instructions(instructions)
-        # 新しい転送タスクを作成
-        self._transfer_task = asyncio.create_task(
-            self.transfer_realtime_api_to_acs_until_disconnect(conversation_state.call_id)
-        )
+        profile = role_profiles.get(current_role)
+        self._conversation_state = conversation_state
+        if conversation_state.caller_context is None:
+            conversation_state.caller_context = caller_contexts.get(conversation_state.caller_id)
+        prompt = prompt_audio.get(profile)
+        if prompt is not None:
+            self._play_prompt(conversation_state.call_id, current_role, prompt)
+            if not settings.REALTIME_LAZY_CONNECT:
+                self._start_open(conversation_state.call_id)
+            return
+        connect_started_at = time.monotonic()
+        rtclient = await self._connect()
+        try:
+            self._rtclient = rtclient
+            self._local_prompt = False
+            REALTIME_CONNECT_SECONDS.observe_since(connect_started_at)
+            trace_recorder.record(conversation_state.call_id, "realtime_connected", role = current_role)
+            self._awaiting_first_audio = True
+            await self._send_payload(profile.response_create_payload_for(conversation_state.caller_context))
+            trace_recorder.record(conversation_state.call_id, "realtime_out", type = "response.create")
+            activity = call_watchdog.get(conversation_state.call_id)
+            if activity is not None:
+                activity.realtime_at = activity.response_started_at = time.monotonic()
+            # 新しい転送タスクを作成
+            self._transfer_task = loop_monitor.spawn(
+                self.transfer_realtime_api_to_acs_until_disconnect(conversation_state.call_id),
+                conversation_state.call_id,
+                "relay-out"
+            )
+        except asyncio.CancelledError:
+            # 後続の切り替えに置き換えられた。転送タスクがないため、ここで開いた接続を閉じる
+            await self._close_quietly(rtclient)
+            raise
     
     async def transfer_realtime_api_to_acs_until_disconnect(self, call_id: str) -> None:
         try:
             while True:
-                message = await self._rtclient.recv()
+                try:
+                    message = await self._rtclient.recv()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Realtime receive failed for call_id {call_id}: {e}", category = "realtime.recv_failed")
+                    message = None
                 if message is None:
-                   print(f"No message received, closing loop for call_id: {call_id}")
-                   break
+                    # 通話中に切断された場合は再接続して会話を続ける
+                    if self._closing or not await self._reconnect(call_id):
+                        logger.info(f"No message received, closing loop for call_id: {call_id}")
+                        break
+                    continue
 
+                # ウォッチドッグは応答の生成中に受信が止まった接続を検知する
+                activity = call_watchdog.get(call_id)
+                if activity is not None:
+                    activity.realtime_at = time.monotonic()
+                    if message.type == "response.created":
+                        activity.response_started_at = activity.realtime_at
+                    elif message.type == "response.done":
+                        activity.response_started_at = None
+
+                if message.type == "response.audio.delta" and self._prompt_task is not None:
+                    # モデルが発話に応答し始めたら定型文を止める
+                    self._stop_prompt()
                 if message.type == "response.audio.delta":
                     audio_data_base64 = message.delta
+                    trace_recorder.record(call_id, "realtime_in", type = message.type, bytes = base64_decoded_length(audio_data_base64))
+                    if self._awaiting_first_audio:
+                        self._observe_first_audio()
                     await self._send_text_to_acs(audio_data_base64)
                 elif message.type == "response.audio_transcript.delta":
                     transcript_delta = message.delta
+                    trace_recorder.record(call_id, "realtime_in", type = message.type)
                     self._output_complete_message(transcript_delta)
                 elif message.type == "input.audio_transcript":
                     user_transcript = message.text
-                    print(f"User transcript: {user_transcript}")
+                    logger.info(f"User transcript: {user_transcript}")
+                    self._recent_items.append(("user", user_transcript))
+                    conversation_summaries.add_turn(self._conversation_state, "user", user_transcript)
+                    transcript_archive.append(call_id, "user", user_transcript, role = self._current_role())
                 else:
-                    print(f"Unknown message type: {message.type}")
+                    trace_recorder.record(call_id, "realtime_in", type = message.type)
+                    logger.debug(f"Unknown message type: {message.type}", category = "realtime.unknown_message")
         except Exception as e:
-            print(f"Exception in transfer_realtime_api_to_acs_until_disconnect: {e}")
+            logger.error(f"Exception in transfer_realtime_api_to_acs_until_disconnect: {e}")
         finally:
             await self._rtclient.close()
-            print(f"Connection closed for call_id: {call_id}")
+            logger.info(f"Connection closed for call_id: {call_id}")
+
+    def _play_prompt(self, call_id: str, current_role: Optional[str], prompt: PromptAudio) -> None:
+        # モデルに読ませる代わりに、キャッシュした音声を ACS への送信経路で流す
+        self._local_prompt = True
+        self._speech.reset()
+        self._awaiting_first_audio = True
+        activity = call_watchdog.get(call_id)
+        if activity is not None:
+            activity.response_started_at = None
+        trace_recorder.record(call_id, "prompt_audio", role = current_role, seconds = round(prompt.seconds, 3))
+        self._prompt_task = loop_monitor.spawn(prompt_audio.play(prompt, self._send_prompt_frame), call_id, "prompt")
+
+    async def _send_prompt_frame(self, audio_data_base64: str) -> None:
+        if self._awaiting_first_audio:
+            self._observe_first_audio()
+        await self._send_text_to_acs(audio_data_base64)
+
+    def _stop_prompt(self) -> None:
+        if self._prompt_task is not None:
+            self._prompt_task.cancel()
+            self._prompt_task = None
+
+    def _start_open(self, call_id: str) -> None:
+        # 接続が済むまでの音声は再接続時と同じくバッファに貯め、検知前の音声と合わせて接続後に送る
+        self._local_prompt = False
+        self._reconnecting = True
+        self._inbound_audio.clear()
+        self._inbound_audio_bytes = 0
+        for audio_data in self._speech.drain():
+            self._buffer_inbound_audio(audio_data)
+        self._open_task = loop_monitor.spawn(self._open_session(call_id), call_id, "realtime-open")
+
+    async def _open_session(self, call_id: str) -> None:
+        # 定型文の後に続く会話のセッション。指示は session.update で渡し、定型文はモデルに読ませない
+        rtclient: RTLowLevelClient | None = None
+        try:
+            connect_started_at = time.monotonic()
+            rtclient = await self._connect()
+            self._rtclient = rtclient
+            REALTIME_CONNECT_SECONDS.observe_since(connect_started_at)
+            trace_recorder.record(call_id, "realtime_connected", role = self._current_role())
+            await self._restore_session()
+            replayed = await self._replay_inbound_audio()
+            logger.info(f"Realtime session opened during a prompt for call_id {call_id} ({replayed} frames replayed)")
+            self._open_task = None
+            self._reconnecting = False
+            self._transfer_task = loop_monitor.spawn(
+                self.transfer_realtime_api_to_acs_until_disconnect(call_id), call_id, "relay-out"
+            )
+        except asyncio.CancelledError:
+            # ロールが切り替わったか通話が終わった。ここで開いた接続だけを閉じる
+            if rtclient is not None:
+                await self._close_quietly(rtclient)
+            raise
+        except Exception as e:
+            logger.error(f"Failed to open the realtime session for call_id {call_id}: {e}")
+            if rtclient is not None:
+                await self._close_rtclient_quietly()
+            # 次の発話でもう一度接続する
+            self._open_task = None
+            self._reconnecting = False
+            self._local_prompt = not self._closing
+
+    def _cancel_open(self) -> None:
+        if self._open_task is not None:
+            self._open_task.cancel()
+            self._open_task = None
+            self._reconnecting = False
+
+    def _observe_first_audio(self) -> None:
+        # ロール切り替え後、または通話開始後に最初の音声を送るまでの時間を記録
+        self._awaiting_first_audio = False
+        state = self._conversation_state
+        if state is None:
+            return
+        if state.role_switch_requested_at is not None:
+            DTMF_TO_ROLE_AUDIO_SECONDS.observe_since(state.role_switch_requested_at)
+            state.role_switch_requested_at = None
+        elif state.connected_at is not None:
+            CALL_CONNECTED_TO_FIRST_AUDIO_SECONDS.observe_since(state.connected_at)
+            state.connected_at = None
 
     def _output_complete_message(self, transcript_delta: str) -> ResponseCreateMessage:
         self._transcript_buffer += transcript_delta
         if any(transcript_delta.endswith(punct) for punct in ['。', '！', '？', '.', '!', '?', '」', '\n']):
             complete_sentence = self._transcript_buffer.strip()
-            print(f"Complete sentence: {complete_sentence}")
+            logger.info(f"Complete sentence: {complete_sentence}")
             self._transcript_buffer = ""
+            self._recent_items.append(("assistant", complete_sentence))
+            conversation_summaries.add_turn(self._conversation_state, "assistant", complete_sentence)
+            if self._conversation_state is not None:
+                transcript_archive.append(
+                    self._conversation_state.call_id, "assistant", complete_sentence, role = self._current_role()
+                )
+
+    def _current_role(self) -> Optional[str]:
+        return self._conversation_state.current_role if self._conversation_state else None
+
+    async def _reconnect(self, call_id: str) -> bool:
+        # 切断中の受信音声はバッファに貯め、再接続後にロールの指示と直近の会話を復元してから再送する
+        REALTIME_DISCONNECTS.inc()
+        self._reconnecting = True
+        dropped_at = time.monotonic()
+        delay = settings.REALTIME_RECONNECT_INITIAL_DELAY_SECONDS
+        try:
+            for attempt in range(1, settings.REALTIME_RECONNECT_MAX_ATTEMPTS + 1):
+                if self._closing:
+                    return False
+                try:
+                    await self._close_rtclient_quietly()
+                    self._rtclient = await self._connect()
+                    await self._restore_session()
+                    replayed = await self._replay_inbound_audio()
+                    REALTIME_RECONNECTS_SUCCEEDED.inc()
+                    REALTIME_RECOVERY_SECONDS.observe_since(dropped_at)
+                    trace_recorder.record(call_id, "realtime_reconnected", attempt = attempt, replayed_frames = replayed)
+                    logger.info(f"Realtime session reconnected for call_id {call_id} (attempt {attempt}, {replayed} frames replayed)")
+                    return True
+                except Exception as e:
+                    logger.warning(f"Realtime reconnect attempt {attempt} failed for call_id {call_id}: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, settings.REALTIME_RECONNECT_MAX_DELAY_SECONDS)
+            REALTIME_RECONNECTS_FAILED.inc()
+            logger.error(f"Giving up reconnecting the realtime session for call_id {call_id}")
+            self._closing = True
+            return False
+        finally:
+            self._reconnecting = False
+
+    async def _restore_session(self) -> None:
+        current_role = self._conversation_state.current_role if self._conversation_state else None
+        caller_context = self._conversation_state.caller_context if self._conversation_state else None
+        # response.create で指示を送ると最初の発話からやり直すため、セッションの指示として復元する
+        await self._send_payload(role_profiles.get(current_role).session_update_payload_for(caller_context))
+        for role, text in list(self._recent_items):
+            await self._rtclient.send(self._conversation_item_message(role, text))
+
+    async def _replay_inbound_audio(self) -> int:
+        # 再送中に届いた音声も取りこぼさないよう、通し番号で未送信分がなくなるまで送る
+        replayed = 0
+        last_seq = -1
+        while True:
+            pending = [(seq, audio) for seq, audio, _ in self._inbound_audio if seq > last_seq]
+            if not pending:
+                return replayed
+            for seq, audio in pending:
+                await self._rtclient.send(self._audio_buffer_append_message(audio))
+                last_seq = seq
+                replayed += 1
+
+    def _buffer_inbound_audio(self, audio_data: str) -> None:
+        size = base64_decoded_length(audio_data)
+        self._inbound_audio_seq += 1
+        self._inbound_audio.append((self._inbound_audio_seq, audio_data, size))
+        self._inbound_audio_bytes += size
+        while self._inbound_audio_bytes > self._max_inbound_audio_bytes and len(self._inbound_audio) > 1:
+            _, _, dropped = self._inbound_audio.popleft()
+            self._inbound_audio_bytes -= dropped
+
+    async def _close_rtclient_quietly(self) -> None:
+        await self._close_quietly(self._rtclient)
+
+    @staticmethod
+    async def _close_quietly(rtclient: RTLowLevelClient) -> None:
+        try:
+            await rtclient.close()
+        except Exception:
+            pass
+
+    async def recover(self) -> None:
+        # 応答が止まった接続を閉じる。受信ループが切断を検知し、会話を復元して接続し直す
+        if self._closing or self._reconnecting or self._local_prompt:
+            return
+        await self._close_rtclient_quietly()
+
+    async def ping(self) -> None:
+        if self._closing or self._reconnecting or self._local_prompt:
+            return
+        await self._rtclient.ws.ping()
 
     async def send_audio_buffer_to_realtime_api(self, audio_data: str) -> None:
+        if self._closing:
+            return
+        if self._local_prompt:
+            # 定型文の間は realtime に接続していない。発話を検知したら接続する (メニューの選択は DTMF で受ける)
+            if self._speech.feed(audio_data) and self._conversation_state is not None:
+                REALTIME_SPEECH_OPENS.inc()
+                trace_recorder.record(self._conversation_state.call_id, "speech_detected", role = self._current_role())
+                self._start_open(self._conversation_state.call_id)
+            return
+        self._buffer_inbound_audio(audio_data)
+        if self._reconnecting:
+            # 再接続中の音声はバッファに貯め、接続後にまとめて送る
+            return
         message = self._audio_buffer_append_message(audio_data)
-        await self._rtclient.send(message)
+        try:
+            await self._rtclient.send(message)
+        except Exception as e:
+            # 切断は受信ループで検知して再接続するため、ACS 側の受信ループは止めない
+            logger.warning(f"Failed to send audio to the realtime API: {e}", category = "realtime.send_failed")
 
     def _audio_buffer_append_message(self, audio_data: str) -> InputAudioBufferAppendMessage:
         message = InputAudioBufferAppendMessage(
@@ -92,25 +423,25 @@ class Realtime(RealtimeInterface):
         )
         return message
     
-    async def _send_instructions(self, instructions: str) -> None:
-        message = self._response_create_message(instructions)
-        await self._rtclient.send(message)
-    
-    def _response_create_message(self, instructions: str) -> ResponseCreateMessage:
-        params = ResponseCreateParams(
-            modalities = {"audio", "text"},
-            instructions = instructions,
-            voice = "shimmer",
-            output_audio_format = "pcm16",
-            input_audio_format = "pcm16",
-            input_audio_transcription = {"model": "whisper-1"}
-        )
-        message = ResponseCreateMessage(
-            response = params
-        )
-        return message
-    
+    async def _send_payload(self, payload: str) -> None:
+        # ロールのプロファイルは読み込み時にシリアライズ済みのため、rtclient.send を通さずにそのまま送る
+        await self._rtclient.ws.send_str(payload)
+
+    def _conversation_item_message(self, role: str, text: str) -> ItemCreateMessage:
+        if role == "user":
+            item = UserMessageItem(content = [InputTextContentPart(text = text)])
+        else:
+            item = AssistantMessageItem(content = [OutputTextContentPart(text = text)])
+        return ItemCreateMessage(item = item)
+
     async def rtclient_close(self) -> None:
+        self._closing = True
+        self._stop_prompt()
+        self._cancel_open()
+        # 再接続用に保持していた音声と会話履歴を通話の終了後まで残さない
+        self._inbound_audio.clear()
+        self._inbound_audio_bytes = 0
+        self._recent_items.clear()
         try:
             await self._rtclient.close()
         except AttributeError:
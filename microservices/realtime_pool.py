@@ -0,0 +1,116 @@
+import asyncio
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Deque, Dict, Optional, Tuple
+from settings import settings
+from logger import get_logger
+from loop_monitor import loop_monitor
+
+if TYPE_CHECKING:
+    # rtclient (aiohttp) の読み込みは起動後に回す
+    from rtclient import RTLowLevelClient
+
+logger = get_logger(__name__)
+
+class RealtimeConnectionPool:
+    # 接続済みの realtime クライアントを待機させておき、再接続時の接続時間を省く
+    def __init__(self, size: int, max_idle_seconds: float, refill_interval: float = 10.0) -> None:
+        self._size = size
+        self._max_idle_seconds = max_idle_seconds
+        self._refill_interval = refill_interval
+        self._factory: Optional[Callable[[], "RTLowLevelClient"]] = None
+        # (クライアント, 接続した時刻)
+        self._idle: Deque[Tuple["RTLowLevelClient", float]] = deque()
+        self._connecting = 0
+        self._refill_task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.connect_errors = 0
+
+    def start(self, factory: Callable[[], "RTLowLevelClient"]) -> None:
+        if self._size <= 0 or self._refill_task is not None:
+            return
+        self._factory = factory
+        self._refill_task = loop_monitor.spawn(self._refill_loop(), None, "realtime-pool")
+
+    async def stop(self) -> None:
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            try:
+                await self._refill_task
+            except asyncio.CancelledError:
+                pass
+            self._refill_task = None
+        while self._idle:
+            rtclient, _ = self._idle.popleft()
+            await self._close(rtclient)
+
+    async def acquire(self) -> Optional["RTLowLevelClient"]:
+        # 有効な待機中クライアントがなければ None を返す (呼び出し側で新規に接続する)
+        now = time.monotonic()
+        while self._idle:
+            rtclient, connected_at = self._idle.popleft()
+            if now - connected_at <= self._max_idle_seconds and not getattr(rtclient, "closed", False):
+                self.hits += 1
+                self._wakeup.set()
+                return rtclient
+            self.expired += 1
+            await self._close(rtclient)
+        if self._refill_task is not None:
+            self.misses += 1
+            self._wakeup.set()
+        return None
+
+    async def _refill_loop(self) -> None:
+        while True:
+            await self._discard_expired()
+            while len(self._idle) + self._connecting < self._size:
+                self._connecting += 1
+                try:
+                    rtclient = self._factory()
+                    await rtclient.connect()
+                    self._idle.append((rtclient, time.monotonic()))
+                except Exception as e:
+                    self.connect_errors += 1
+                    logger.warning(f"Failed to open a warm realtime connection: {e}", category = "realtime_pool.connect")
+                    break
+                finally:
+                    self._connecting -= 1
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout = self._refill_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _discard_expired(self) -> None:
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self._max_idle_seconds:
+            rtclient, _ = self._idle.popleft()
+            self.expired += 1
+            await self._close(rtclient)
+
+    async def _close(self, rtclient: "RTLowLevelClient") -> None:
+        try:
+            await rtclient.close()
+        except Exception:
+            pass
+
+    def idle(self) -> int:
+        return len(self._idle)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "idle": len(self._idle),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "connect_errors": self.connect_errors,
+        }
+
+
+realtime_pool = RealtimeConnectionPool(
+    size = settings.REALTIME_WARM_POOL_SIZE,
+    max_idle_seconds = settings.REALTIME_WARM_POOL_MAX_IDLE_SECONDS
+)
@@ -0,0 +1,219 @@
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+from settings import settings
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# ロールごとの指示・音声・フォーマット・ツールは両アプリ共通の roles.json で定義する。
+# 読み込み時に response.create / session.update を JSON 文字列にしておき、ロール切り替えではそのまま送る。
+
+# 発信者の情報 (caller_context) を追記するときの見出し。ロールの言語によらず同じものを使う
+CALLER_CONTEXT_HEADING = "Caller context from previous contacts (use it to help the caller; do not read it out):"
+
+# 定型文 (prompt) の音声を一度だけ合成するときの指示
+PROMPT_SYNTHESIS_INSTRUCTIONS = "Read the following text aloud exactly as written, in its own language, without adding or omitting anything:\n"
+
+# ACS の DTMF トーン名と数字の対応。roles.json の dtmf はトーン名 ("one") でも数字の並び ("12") でもよい
+TONE_DIGITS = {
+    "zero": "0", "one": "1", "two": "2", "three": "3", "four": "4",
+    "five": "5", "six": "6", "seven": "7", "eight": "8", "nine": "9",
+    "asterisk": "*", "pound": "#", "a": "A", "b": "B", "c": "C", "d": "D",
+}
+
+class RoleProfile:
+    def __init__(self, name: Optional[str], definition: Dict[str, Any]) -> None:
+        self.name = name
+        dtmf = definition.get("dtmf")
+        self.dtmf: Optional[str] = TONE_DIGITS.get(dtmf, dtmf) if dtmf else None
+        if self.dtmf and "#" in self.dtmf:
+            # # は入力の確定に使う
+            raise ValueError(f"DTMF selection {self.dtmf} of {name} must not contain '#'")
+        # True のロールは AI ではなく人のオペレーターへ転送する
+        self.transfer_to_human = bool(definition.get("transfer_to_human", False))
+        self.instructions: str = definition.get("instructions", "")
+        self.voice: str = definition["voice"]
+        self.modalities: List[str] = list(definition["modalities"])
+        self.input_audio_format: str = definition["input_audio_format"]
+        self.output_audio_format: str = definition["output_audio_format"]
+        self.input_audio_transcription: Optional[dict] = definition.get("input_audio_transcription")
+        self.turn_detection: Optional[dict] = definition.get("turn_detection")
+        self.tools: List[dict] = list(definition.get("tools") or [])
+        # 定型文。音声をキャッシュ済みなら realtime に接続せずにそれを流す (まだなら instructions で読ませる)
+        self.prompt: Optional[str] = definition.get("prompt")
+        self.response_create_payload = self._serialize("response.create", "response", self._response_params())
+        self.session_update_payload = self._serialize("session.update", "session", self._session_params())
+        self.prompt_synthesis_payload: Optional[str] = None
+        if self.prompt:
+            params = {**self._response_params(), "instructions": PROMPT_SYNTHESIS_INSTRUCTIONS + self.prompt}
+            self.prompt_synthesis_payload = self._serialize("response.create", "response", params)
+
+    def _common_params(self) -> Dict[str, Any]:
+        params: Dict[str, Any] = {
+            "instructions": self.instructions,
+            "voice": self.voice,
+            "input_audio_format": self.input_audio_format,
+            "output_audio_format": self.output_audio_format,
+        }
+        if self.input_audio_transcription:
+            params["input_audio_transcription"] = self.input_audio_transcription
+        if self.tools:
+            params["tools"] = self.tools
+        return params
+
+    def _response_params(self) -> Dict[str, Any]:
+        return {"modalities": self.modalities, **self._common_params()}
+
+    def _session_params(self) -> Dict[str, Any]:
+        params = self._common_params()
+        # 未指定ならサーバー側の既定値 (server_vad) を使う
+        if self.turn_detection is not None:
+            params["turn_detection"] = self.turn_detection
+        return params
+
+    def response_create_payload_for(self, caller_context: Optional[str]) -> str:
+        # 発信者の情報がある通話だけ、指示に追記してシリアライズし直す
+        if not caller_context:
+            return self.response_create_payload
+        params = {**self._response_params(), "instructions": self._instructions_with(caller_context)}
+        return self._serialize("response.create", "response", params)
+
+    def session_update_payload_for(self, caller_context: Optional[str]) -> str:
+        if not caller_context:
+            return self.session_update_payload
+        params = {**self._session_params(), "instructions": self._instructions_with(caller_context)}
+        return self._serialize("session.update", "session", params)
+
+    def _instructions_with(self, caller_context: str) -> str:
+        return f"{self.instructions}\n\n{CALLER_CONTEXT_HEADING}\n{caller_context}"
+
+    @staticmethod
+    def _serialize(message_type: str, key: str, params: Dict[str, Any]) -> str:
+        return json.dumps({"type": message_type, key: params}, ensure_ascii = False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "dtmf": self.dtmf,
+            "transfer_to_human": self.transfer_to_human,
+            "voice": self.voice,
+            "input_audio_format": self.input_audio_format,
+            "output_audio_format": self.output_audio_format,
+            "input_audio_transcription": self.input_audio_transcription,
+            "turn_detection": self.turn_detection,
+            "tools": [tool.get("name") for tool in self.tools],
+            "prompt": self.prompt,
+        }
+
+
+class RoleProfileRegistry:
+    def __init__(self, path: str, check_interval: float) -> None:
+        self._path = path
+        self._check_interval = check_interval
+        self._roles: Dict[str, RoleProfile] = {}
+        self._by_digits: Dict[str, RoleProfile] = {}
+        # 登録済みの選択番号の途中まで (さらに入力が続く可能性がある並び)
+        self._prefixes: Set[str] = set()
+        self._menu: Optional[RoleProfile] = None
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self.loads = 0
+        self.reload_errors = 0
+
+    def load(self) -> None:
+        # 読み込みに失敗した場合は例外を送出し、それまでのプロファイルをそのまま使う
+        mtime = os.stat(self._path).st_mtime
+        with open(self._path, encoding = "utf-8") as file:
+            document = json.load(file)
+        roles, by_digits, menu = self._build(document)
+        self._roles, self._by_digits, self._menu = roles, by_digits, menu
+        self._prefixes = {digits[:length] for digits in by_digits for length in range(1, len(digits))}
+        self._mtime = mtime
+        self._checked_at = time.monotonic()
+        self.loads += 1
+        logger.info(f"Loaded {len(roles)} role profiles from {self._path}")
+
+    def reload(self) -> bool:
+        try:
+            self.load()
+            return True
+        except Exception as e:
+            self.reload_errors += 1
+            logger.error(f"Failed to load role profiles from {self._path}: {e}")
+            return False
+
+    def _build(self, document: Dict[str, Any]) -> Tuple[Dict[str, RoleProfile], Dict[str, RoleProfile], RoleProfile]:
+        defaults = document.get("defaults", {})
+        roles: Dict[str, RoleProfile] = {}
+        by_digits: Dict[str, RoleProfile] = {}
+        for name, definition in document.get("roles", {}).items():
+            profile = RoleProfile(name, {**defaults, **definition})
+            roles[name] = profile
+            if profile.dtmf:
+                if profile.dtmf in by_digits:
+                    raise ValueError(f"DTMF selection {profile.dtmf} is assigned to both {by_digits[profile.dtmf].name} and {name}")
+                by_digits[profile.dtmf] = profile
+        menu = RoleProfile(None, {**defaults, **document.get("menu", {})})
+        return roles, by_digits, menu
+
+    def _check_for_changes(self) -> None:
+        # ファイルの更新時刻を一定間隔で確認し、変わっていれば再起動せずに読み直す
+        if self._mtime is None:
+            self.load()
+            return
+        now = time.monotonic()
+        if now - self._checked_at < self._check_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except OSError as e:
+            logger.warning(f"Cannot stat role profiles at {self._path}: {e}", category = "role_profiles.stat")
+            return
+        if mtime != self._mtime and not self.reload():
+            # 壊れたファイルを毎回読み直さないよう、次に更新されるまでは読まない
+            self._mtime = mtime
+
+    def get(self, role: Optional[str]) -> RoleProfile:
+        # 未知のロール (未選択を含む) にはメニューのプロファイルを返す
+        self._check_for_changes()
+        return self._roles.get(role, self._menu) if role else self._menu
+
+    def for_tone(self, tone: Optional[str]) -> Optional[RoleProfile]:
+        return self.for_digits(TONE_DIGITS.get(tone, tone))
+
+    def for_digits(self, digits: Optional[str]) -> Optional[RoleProfile]:
+        self._check_for_changes()
+        return self._by_digits.get(digits)
+
+    def prompts(self) -> List[RoleProfile]:
+        # 定型文を持つプロファイル (メニューを含む)。起動時に音声を用意しておく
+        self._check_for_changes()
+        profiles = [self._menu, *self._roles.values()]
+        return [profile for profile in profiles if profile is not None and profile.prompt]
+
+    def expects_more(self, digits: str) -> bool:
+        # 入力中の並びで始まる、より長い選択番号があるか
+        return digits in self._prefixes
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "roles": len(self._roles),
+            "loads": self.loads,
+            "reload_errors": self.reload_errors,
+        }
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "path": self._path,
+            **self.stats(),
+            "profiles": [profile.to_dict() for profile in self._roles.values()],
+        }
+
+
+role_profiles = RoleProfileRegistry(
+    path = settings.ROLE_PROFILES_PATH,
+    check_interval = settings.ROLE_PROFILES_CHECK_INTERVAL_SECONDS
+)
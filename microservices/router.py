@@ -1,100 +1,360 @@
 import asyncio
+import time
+from typing import Optional
 from fastapi import APIRouter, Request, Response
 from fastapi.responses import JSONResponse, PlainTextResponse
 from azure.eventgrid import EventGridEvent, SystemEventNames
 from call_context import CallContext, CallContextFactory
 from call_handler import CallHandler
 from job_router import JobRouter
-from dtmf import DTMFHandler
+from event_cache import ProcessedEventCache
 from fastapi import WebSocket as FastAPIWebSocket
 from websocket import WebSocket as ACSWebSocket
 from azure.eventgrid import EventGridEvent, SystemEventNames
-from azure.core.messaging import CloudEvent
+from callback_dispatcher import CallbackDispatcher, CallDependencies
+import logger as log_config
+from logger import get_logger, bind_call
+from metrics import registry as metrics_registry
+from trace_recorder import recorder as trace_recorder
+from loop_monitor import loop_monitor
+from role_profiles import RoleProfile, role_profiles
+from summarizer import conversation_summaries
+from transcript_archive import transcript_archive
+from call_recorder import call_recorder
+from drain import ADMIN_TOKEN_HEADER, drain_controller
+from dtmf_collector import dtmf_collectors
+from admission import admission_controller, SHED_BUSY, SHED_REDIRECT
+from state_manager import ConversationStateManager
+from media_plane import media_plane
+from startup import startup_timer
+from caller_context import caller_contexts
+
+logger = get_logger(__name__)
 
 router = APIRouter()
+callback_dispatcher = CallbackDispatcher()
 
 @router.get("/")
 async def read_root():
-    print("Sample ACS Realtime API Call Center is running")
+    logger.debug("Sample ACS Realtime API Call Center is running")
     return PlainTextResponse("Sample ACS Realtime API Call Center is running")
 
+@router.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type = "text/plain; version=0.0.4")
+
+@router.get("/debug/logging")
+async def get_logging_status():
+    return JSONResponse(content = log_config.stats())
+
+@router.put("/debug/logging")
+async def update_logging(level: str):
+    # 再起動せずにログレベルを変更する
+    try:
+        log_config.set_level(level)
+    except ValueError:
+        return JSONResponse(content = {"message": f"Unknown log level: {level}"}, status_code = 400)
+    return JSONResponse(content = log_config.stats())
+
+@router.get("/debug/loop")
+async def get_loop_status(limit: int = 10):
+    return JSONResponse(content = loop_monitor.snapshot(limit))
+
+@router.get("/debug/tasks")
+async def get_tasks(call_id: Optional[str] = None, limit: int = 100):
+    # call_id を指定するとその通話の生きているタスクだけを返す (切断後に残っていないことの確認用)
+    return JSONResponse(content = {
+        "tasks_by_call": loop_monitor.tasks_by_call(),
+        "tasks": loop_monitor.tasks(limit, call_id = call_id),
+    })
+
+@router.post("/debug/loop/profile")
+async def profile_loop(seconds: float = 10.0, interval: float = 0.005):
+    # 本番環境でも一時的にサンプリングプロファイラを動かして、ループを占有しているコードを調べる
+    if not 0 < seconds <= 60 or not 0.001 <= interval <= 1:
+        return JSONResponse(content = {"message": "seconds must be in (0, 60] and interval in [0.001, 1]"}, status_code = 400)
+    try:
+        result = await loop_monitor.profile(seconds, interval)
+    except RuntimeError as e:
+        return JSONResponse(content = {"message": str(e)}, status_code = 409)
+    return JSONResponse(content = result)
+
+@router.get("/debug/startup")
+async def get_startup_status():
+    return JSONResponse(content = {"warmed": startup_timer.warmed, **startup_timer.stats()})
+
+@router.get("/debug/roles")
+async def get_role_profiles():
+    return JSONResponse(content = role_profiles.snapshot())
+
+@router.post("/debug/roles/reload")
+async def reload_role_profiles():
+    # roles.json の更新は自動で反映されるが、確認間隔を待たずにすぐ読み直す
+    if not role_profiles.reload():
+        return JSONResponse(content = {"message": "Failed to load role profiles, keeping the previous ones"}, status_code = 400)
+    return JSONResponse(content = role_profiles.snapshot())
+
+@router.get("/debug/transcripts/{call_id}")
+async def get_transcript(call_id: str):
+    # アーカイブ済みの文字起こしを返す (書き込みスレッドが未書き込みの直近の発話は含まない)
+    if not transcript_archive.enabled:
+        return JSONResponse(content = {"message": "Transcript archive is disabled"}, status_code = 404)
+    entries = await asyncio.to_thread(transcript_archive.read, call_id)
+    return JSONResponse(content = {"call_id": call_id, "entries": entries})
+
+@router.get("/admin/drain")
+async def get_drain_status():
+    return JSONResponse(content = drain_controller.status())
+
+@router.post("/admin/drain")
+async def start_drain(request: Request):
+    # デプロイの preStop などから呼び出し、完了は GET /admin/drain で確認する
+    if not drain_controller.authorize(request.headers.get(ADMIN_TOKEN_HEADER)):
+        return JSONResponse(content = {"message": "Forbidden"}, status_code = 403)
+    drain_controller.start()
+    return JSONResponse(content = drain_controller.status(), status_code = 202)
+
+@router.get("/debug/admission")
+async def get_admission_status():
+    return JSONResponse(content = {"shed_action": admission_controller.shed_action, **admission_controller.stats()})
+
 @router.post("/api/incomingCall")
 async def incoming_call_handler(request: Request):
-    print("Incoming call received")
-    factory = CallContextFactory(request)
-    call_context = await factory.build()
-    job_router: JobRouter = request.app.state.job_router
-    call_handler = CallHandler(call_context.call_id)
+    logger.info("Incoming call received")
+    events = await request.json()
 
-    for event_dict in call_context.events:
+    # Event Grid Subscription 検証
+    for event_dict in events:
         event = EventGridEvent.from_dict(event_dict)
-
-        # Event Grid Subscription 検証
         if event.event_type == SystemEventNames.EventGridSubscriptionValidationEventName:
             validation_code = event.data["validationCode"]
             return JSONResponse(content = {"validationResponse": validation_code})
-        
-        # incoming call event のハンドリング
-        elif event.event_type == "Microsoft.Communication.IncomingCall":
-            print("Incoming call event received")
-            try:
-                incoming_call_context = event.data.get("incomingCallContext")
-                print("Debug: incoming_call_context", incoming_call_context)
+
+    # ドレイン中は応答せず、Event Grid に再配信させて他のレプリカで受ける
+    if drain_controller.draining:
+        drain_controller.reject(len(events))
+        logger.info("Rejecting incoming calls while draining")
+        return JSONResponse(content = {"message": "Draining"}, status_code = 503, headers = {"Retry-After": "1"})
+
+    # incoming call event のハンドリング (バッチ内の全着信を並列に応答)
+    factory = CallContextFactory(request)
+    call_contexts = await factory.build_incoming()
+    if not call_contexts:
+        return JSONResponse(content = {"message": "No incoming call event"}, status_code = 400)
+
+    job_router: JobRouter = request.app.state.job_router
+    semaphore: asyncio.Semaphore = request.app.state.incoming_call_semaphore
+    conversation_state_manager: ConversationStateManager = request.app.state.conversation_state_manager
+    # 受付制御は応答の順番待ちより前に行い、断る着信を待たせない
+    decisions = [(call_context, admission_controller.admit(call_context.call_id)) for call_context in call_contexts]
+    results = await asyncio.gather(*(
+        answer_incoming_call(call_context, job_router, semaphore, conversation_state_manager) if reason is None
+        else shed_incoming_call(call_context, reason, conversation_state_manager)
+        for call_context, reason in decisions
+    ))
+
+    # 一件でも応答 (または断る処理) できていれば 200 を返し、処理済みの着信が再配信されないようにする
+    answered = any(result["status"] in ("answered", "shed") for result in results)
+    return JSONResponse(content = {"results": results}, status_code = 200 if answered else 500)
+
+async def answer_incoming_call(
+    call_context: CallContext,
+    job_router: JobRouter,
+    semaphore: asyncio.Semaphore,
+    conversation_state_manager: ConversationStateManager
+) -> dict:
+    event_id = call_context.events[0].get("id")
+    trace_recorder.begin(call_context.call_id, app = "microservices")
+    trace_recorder.record(call_context.call_id, "incoming", event = call_context.events[0])
+    # 発信者のプロファイルはジョブの作成や応答と並行して読み込む (応答は待たない)
+    caller_contexts.prefetch(call_context.conversation_state.caller_id)
+    async with semaphore:
+        bind_call(call_context.call_id)
+        logger.info("Incoming call event received", caller_id = call_context.conversation_state.caller_id)
+        try:
+            call_handler = CallHandler(call_context.call_id)
+            with loop_monitor.tagged(call_context.call_id, "offer-wait"):
                 await job_router.create_and_assign_job(call_context)
-                incoming_call_context = event.data.get("incomingCallContext")
-                await call_handler.answer_call(incoming_call_context, call_context)
-                return JSONResponse(content = {"message": "Call answeared"}, status_code = 200)
-            except Exception as e:
-                print(f"Error handling incoming call: {e}")
-                return JSONResponse(content = {"message": "Error handling incoming call"}, status_code = 500)
+            if media_plane.enabled:
+                # メディアの接続先になるワーカーを決め、会話状態を渡してから応答する
+                await media_plane.prepare(call_context.conversation_state)
+            await call_handler.answer_call(call_context.incoming_call_context, call_context)
+            trace_recorder.record(call_context.call_id, "answered")
+            return {"eventId": event_id, "callId": call_context.call_id, "status": "answered"}
+        except Exception as e:
+            logger.error(f"Error handling incoming call {call_context.call_id}: {e}")
+            trace_recorder.record(call_context.call_id, "answer_failed", error = str(e))
+            trace_recorder.end(call_context.call_id)
+            admission_controller.release(call_context.call_id)
+            media_plane.discard(call_context.call_id)
+            # 応答できなかった通話の会話状態と、割り当て済みのジョブを残さない
+            conversation_state_manager.delete(call_context.call_id)
+            if call_context.conversation_state.job_id:
+                try:
+                    await job_router.finish_job_by_id(call_context.conversation_state.job_id)
+                except Exception as finish_error:
+                    logger.error(f"Failed to finish job {call_context.conversation_state.job_id}: {finish_error}")
+            return {"eventId": event_id, "callId": call_context.call_id, "status": "error", "error": str(e)}
+
+async def shed_incoming_call(
+    call_context: CallContext,
+    reason: str,
+    conversation_state_manager: ConversationStateManager
+) -> dict:
+    event_id = call_context.events[0].get("id")
+    action = admission_controller.shed_action
+    bind_call(call_context.call_id)
+    try:
+        call_handler = CallHandler(call_context.call_id)
+        if action == SHED_BUSY:
+            call_context.conversation_state.busy = True
+            await call_handler.answer_busy_call(call_context.incoming_call_context, call_context)
+        else:
+            conversation_state_manager.delete(call_context.call_id)
+            if action == SHED_REDIRECT:
+                await call_handler.redirect_call(call_context.incoming_call_context, admission_controller.redirect_number)
+            else:
+                await call_handler.reject_call(call_context.incoming_call_context)
+        return {"eventId": event_id, "callId": call_context.call_id, "status": "shed", "reason": reason, "action": action}
+    except Exception as e:
+        logger.error(f"Error shedding incoming call {call_context.call_id}: {e}")
+        return {"eventId": event_id, "callId": call_context.call_id, "status": "error", "error": str(e)}
 
 @router.post("/api/callbacks/{call_id}")
 async def handle_callback(request: Request, call_id: str):
-    print("Callback event received")
-    factory = CallContextFactory(request, call_id)
-    call_context: CallContext = await factory.build()
-    realtime = request.app.state.realtime_manager.get(call_id)
-    job_router: JobRouter = request.app.state.job_router
-    dtmf_handler = DTMFHandler(job_router, call_id, realtime)
-    call_handler = CallHandler(call_id)
-
-    for event_dict in call_context.events:
-        event = CloudEvent.from_dict(event_dict)
-
-        # 通話が開始された時
-        if event.type == "Microsoft.Communication.CallConnected":
-            print("Call connected")
-            asyncio.create_task(dtmf_handler.start_recognition(call_context.conversation_state))
-
-        # DTMFトーンの受信
-        elif event.type == "Microsoft.Communication.ContinuousDtmfRecognitionToneReceived":
-            print("DTMF tone received")
-            tone = event.data.get("tone")
-            if tone in DTMFHandler.AI_ROLE_MAP:
-                await dtmf_handler.handle_tone_received(call_context, tone)
-            elif tone in DTMFHandler.HUMAN_ROLE_MAP:
-                print("transfering to human operator...")
-                call_handler.transfer_call(call_context)
-            else:
-                print(f"Unhandled DTMF tone: {tone}")
-
-        # その他のイベント
-        elif event.type == "Microsoft.Communication.RouterJobQueued":
-            print("Job queued")
-        elif event.type == "Microsoft.Communication.RouterJobOffered":
-            print("Job offered")
-        elif event.type == "Microsoft.Communication.RouterWorkerOfferAccepted":
-            print("Worker offer accepted")
-        elif event.type == "Microsoft.Communication.MediaStreamingStarted":
-            print("Media streaming started")
-        elif event.type == "Microsoft.Communication.CallDisconnected":
-            print("Call disconnected")
-            await call_handler.hangup(call_context)
+    bind_call(call_id)
+    logger.debug("Callback event received")
+    events = await request.json()
+    processed_event_cache: ProcessedEventCache = request.app.state.processed_event_cache
+
+    for event_dict in events:
+        trace_recorder.record(call_id, "webhook", event = event_dict)
+        # 再配信されたイベントは処理しない
+        event_id = event_dict.get("id")
+        if await processed_event_cache.check_and_mark(call_id, event_id):
+            logger.info(f"Skipping duplicate callback event {event_id} for call_id {call_id}")
+            continue
+        try:
+            await callback_dispatcher.dispatch(request.app.state, call_id, event_dict)
+        except Exception:
+            await processed_event_cache.forget(call_id, event_id)
+            raise
     return Response(status_code = 200)
 
+# 通話が開始された時
+@callback_dispatcher.on("Microsoft.Communication.CallConnected")
+async def on_call_connected(event: dict, dependencies: CallDependencies) -> None:
+    logger.info("Call connected")
+    conversation_state = dependencies.conversation_state
+    if conversation_state and conversation_state.busy:
+        # 受付制御で断った通話は、話中案内を流して再生後に切断する
+        await dependencies.call_handler.play_busy_message(event["data"]["callConnectionId"], admission_controller.busy_audio_url)
+        return
+    if conversation_state:
+        conversation_state.call_connection_id = event["data"]["callConnectionId"]
+        conversation_state.connected_at = time.monotonic()
+        # 読み込みが済んでいれば、メディアワーカーにも会話状態と一緒に渡る
+        conversation_state.caller_context = caller_contexts.get(conversation_state.caller_id)
+        if media_plane.enabled:
+            loop_monitor.spawn(sync_media_state(conversation_state), dependencies.call_id, "media-ipc")
+    call_connection = dependencies.call_handler.get_call_connection(event["data"]["callConnectionId"])
+    loop_monitor.spawn(dependencies.dtmf_handler.start_recognition(call_connection), dependencies.call_id, "dtmf")
+
+async def sync_media_state(conversation_state) -> None:
+    try:
+        await media_plane.sync(conversation_state)
+    except Exception as e:
+        logger.warning(f"Failed to sync the conversation state to the media worker: {e}")
+
+# DTMFトーンの受信
+@callback_dispatcher.on("Microsoft.Communication.ContinuousDtmfRecognitionToneReceived")
+async def on_dtmf_tone_received(event: dict, dependencies: CallDependencies) -> None:
+    logger.info("DTMF tone received")
+    tone = event["data"].get("tone")
+    conversation_state = dependencies.conversation_state
+    if conversation_state is None:
+        logger.info(f"No conversation state for DTMF tone: {tone}")
+        return
+    conversation_state.role_switch_requested_at = time.monotonic()
+    # 入力が確定してから切り替える (続けて押された数字や重複したトーンで切り替えを重ねない)
+    dtmf_collectors.add(
+        dependencies.call_id,
+        tone,
+        lambda profile: switch_role(profile, dependencies),
+        lambda: conversation_state.current_role
+    )
+
+async def switch_role(profile: RoleProfile, dependencies: CallDependencies) -> None:
+    if profile.transfer_to_human:
+        logger.info("transfering to human operator...")
+        await dependencies.call_handler.transfer_call(dependencies.call_context)
+    else:
+        await dependencies.dtmf_handler.switch_role(dependencies.call_context, profile)
+
+# 話中案内の再生が終わった時
+@callback_dispatcher.on("Microsoft.Communication.PlayCompleted")
+async def on_play_completed(event: dict, dependencies: CallDependencies) -> None:
+    await hangup_busy_call(event, dependencies)
+
+@callback_dispatcher.on("Microsoft.Communication.PlayFailed")
+async def on_play_failed(event: dict, dependencies: CallDependencies) -> None:
+    logger.warning(f"Play failed: {event['data'].get('resultInformation')}")
+    await hangup_busy_call(event, dependencies)
+
+async def hangup_busy_call(event: dict, dependencies: CallDependencies) -> None:
+    conversation_state = dependencies.conversation_state
+    if conversation_state and conversation_state.busy:
+        await dependencies.call_handler.hangup_connection(event["data"]["callConnectionId"])
+
+# その他のイベント
+@callback_dispatcher.on("Microsoft.Communication.RouterJobQueued")
+async def on_router_job_queued(event: dict, dependencies: CallDependencies) -> None:
+    logger.info("Job queued")
+
+@callback_dispatcher.on("Microsoft.Communication.RouterJobOffered")
+async def on_router_job_offered(event: dict, dependencies: CallDependencies) -> None:
+    logger.info("Job offered")
+
+@callback_dispatcher.on("Microsoft.Communication.RouterWorkerOfferAccepted")
+async def on_router_worker_offer_accepted(event: dict, dependencies: CallDependencies) -> None:
+    logger.info("Worker offer accepted")
+
+@callback_dispatcher.on("Microsoft.Communication.MediaStreamingStarted")
+async def on_media_streaming_started(event: dict, dependencies: CallDependencies) -> None:
+    logger.info("Media streaming started")
+
+@callback_dispatcher.on("Microsoft.Communication.CallDisconnected")
+async def on_call_disconnected(event: dict, dependencies: CallDependencies) -> None:
+    logger.info("Call disconnected")
+    if dependencies.conversation_state is not None:
+        # ACS 側で切断済みのため、hangup では ACS を呼ばずに片付けだけを行う
+        dependencies.conversation_state.call_connection_id = None
+    await dependencies.call_handler.hangup(dependencies.call_context)
+    callback_dispatcher.release(dependencies.call_id)
+    dtmf_collectors.discard(dependencies.call_id)
+    media_plane.discard(dependencies.call_id)
+    conversation_summaries.discard(dependencies.call_id)
+    # 通話のために spawn したタスク (中継、オファー待ち、DTMF など) をまとめて止める
+    await loop_monitor.cancel_call(dependencies.call_id)
+    # 止めたロール切り替えが戻したジョブも含めて終了してから、通話の状態を外す
+    conversation_state = dependencies.conversation_state
+    if conversation_state is not None and conversation_state.job_id:
+        try:
+            await dependencies.job_router.finish_job_by_id(conversation_state.job_id)
+        except Exception as e:
+            logger.error(f"Failed to finish job {conversation_state.job_id}: {e}")
+        conversation_state.job_id = None
+    dependencies.discard()
+    trace_recorder.call_disconnected(dependencies.call_id)
+
 @router.websocket("/ws/{call_id}")
 async def websocket_endpoint(websocket: FastAPIWebSocket, call_id: str):
-    print("WebSocket connection established")
+    bind_call(call_id)
+    logger.info("WebSocket connection established")
+    trace_recorder.record(call_id, "media_connected")
+    # 以降は中継中の通話 (ACTIVE_CALLS) として数える
+    admission_controller.release(call_id)
+    call_recorder.begin(call_id)
     conversation_state = websocket.app.state.conversation_state_manager.get(call_id)
     ws = ACSWebSocket(websocket, call_id, None)
     realtime = websocket.app.state.realtime_manager.create(call_id, ws)
@@ -1,3 +1,4 @@
+import os
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -17,6 +18,119 @@ class Settings(BaseSettings):
     AZURE_OPENAI_SERVICE_KEY: str ="your_aoai_service_key"
     OPERATOR_PHONE_NUMBER: str = "+1234567890"
     OPERATOR_CALLBACK_BASEURL: str = "https://example.com/operator_callback"
+    INCOMING_CALL_CONCURRENCY: int = 8
+    # 着信時にジョブのオファーを待つ最大時間。過ぎたらジョブを取り消して応答しない (応答の同時実行枠を塞がない)
+    JOB_OFFER_TIMEOUT_SECONDS: float = 30.0
+    PROCESSED_EVENT_CACHE_SIZE: int = 10000
+    PROCESSED_EVENT_TTL_SECONDS: int = 600
+    COSMOS_CONNECTION_STRING: str = ""
+    COSMOS_DATABASE_NAME: str = "callcenter"
+    COSMOS_PROCESSED_EVENT_CONTAINER_NAME: str = "processed_events"
+    # 発信者のプロファイル (id とパーティションキーが caller_id) のコンテナ。空なら読み込まない
+    COSMOS_CALLER_PROFILE_CONTAINER_NAME: str = ""
+    # 読み込んだプロファイルのキャッシュ。見つからなかった発信者も NEGATIVE_TTL の間は読み直さない
+    CALLER_CONTEXT_CACHE_SIZE: int = 10000
+    CALLER_CONTEXT_TTL_SECONDS: float = 900.0
+    CALLER_CONTEXT_NEGATIVE_TTL_SECONDS: float = 300.0
+    CALLER_CONTEXT_LOOKUP_TIMEOUT_SECONDS: float = 2.0
+    # ロールの指示に追記する最大文字数
+    CALLER_CONTEXT_MAX_CHARS: int = 1000
+    LOG_LEVEL: str = "INFO"
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_RATE_LIMIT_PER_SECOND: float = 5.0
+    LOG_RATE_LIMIT_BURST: int = 10
+    TRACE_ENABLED: bool = False
+    TRACE_DIRECTORY: str = "traces"
+    TRACE_REDACT_AUDIO: bool = True
+    TRACE_SAMPLE_RATE: float = 1.0
+    TRACE_MAX_ACTIVE_CALLS: int = 100
+    TRACE_QUEUE_SIZE: int = 100000
+    LOOP_MONITOR_INTERVAL_SECONDS: float = 0.1
+    LOOP_STALL_THRESHOLD_SECONDS: float = 0.25
+    REALTIME_REPLAY_SECONDS: float = 3.0
+    REALTIME_RESTORE_ITEMS: int = 10
+    REALTIME_RECONNECT_MAX_ATTEMPTS: int = 5
+    REALTIME_RECONNECT_INITIAL_DELAY_SECONDS: float = 0.2
+    REALTIME_RECONNECT_MAX_DELAY_SECONDS: float = 5.0
+    REALTIME_WARM_POOL_SIZE: int = 1
+    REALTIME_WARM_POOL_MAX_IDLE_SECONDS: float = 240.0
+    # 定型文を流している間は realtime に接続せず、AI のロールが選ばれるか発話を検知してから接続する。
+    # False なら定型文と並行してすぐに接続する (発話の検知を待たない分、接続数とトークンは減らない)
+    REALTIME_LAZY_CONNECT: bool = True
+    # 発話とみなす音量 (16bit PCM の RMS) と継続時間、接続後にモデルへ送る検知前の音声の長さ
+    REALTIME_LAZY_SPEECH_THRESHOLD: float = 1000.0
+    REALTIME_LAZY_SPEECH_MIN_SECONDS: float = 0.2
+    REALTIME_LAZY_PRE_ROLL_SECONDS: float = 1.0
+    # 両アプリ共通のロール定義 (既定はリポジトリ直下の roles.json)
+    ROLE_PROFILES_PATH: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "roles.json")
+    ROLE_PROFILES_CHECK_INTERVAL_SECONDS: float = 2.0
+    # roles.json の prompt (定型文) の音声キャッシュ。合成済みの音声は realtime に接続せずに流す
+    PROMPT_AUDIO_ENABLED: bool = True
+    PROMPT_AUDIO_DIRECTORY: str = "prompt_audio"
+    # ACS に送る 1 フレームの長さと、実時間より先行して送る長さ
+    PROMPT_AUDIO_CHUNK_SECONDS: float = 0.1
+    PROMPT_AUDIO_LEAD_SECONDS: float = 0.5
+    PROMPT_AUDIO_SYNTHESIS_TIMEOUT_SECONDS: float = 30.0
+    # 転送時に operation_context として渡す会話の要約 (SUMMARIZER は "keyword" または "model")
+    SUMMARY_ENABLED: bool = True
+    SUMMARIZER: str = "keyword"
+    SUMMARY_MAX_CHARS: int = 500
+    SUMMARY_MAX_TURNS: int = 50
+    SUMMARY_MODEL_DEPLOYMENT_NAME: str = ""
+    SUMMARY_MODEL_API_VERSION: str = "2024-06-01"
+    SUMMARY_MODEL_MIN_INTERVAL_SECONDS: float = 5.0
+    TRANSCRIPT_ARCHIVE_ENABLED: bool = False
+    TRANSCRIPT_ARCHIVE_DIRECTORY: str = "transcripts"
+    TRANSCRIPT_ARCHIVE_SEGMENT_MAX_BYTES: int = 64 * 1024 * 1024
+    TRANSCRIPT_ARCHIVE_SEGMENT_MAX_SECONDS: float = 3600.0
+    TRANSCRIPT_ARCHIVE_FLUSH_INTERVAL_SECONDS: float = 1.0
+    TRANSCRIPT_ARCHIVE_QUEUE_SIZE: int = 100000
+    # 封印済みセグメントのコピー先 (空なら送らない)
+    TRANSCRIPT_ARCHIVE_UPLOAD_DIRECTORY: str = ""
+    RECORDING_ENABLED: bool = False
+    RECORDING_DIRECTORY: str = "recordings"
+    RECORDING_WRITER_THREADS: int = 2
+    # 書き込みが追いつかない場合に通話ごとに溜めておける音声の長さ。超えた分は捨てる
+    RECORDING_BUFFER_SECONDS: float = 10.0
+    RECORDING_DRAIN_INTERVAL_SECONDS: float = 0.5
+    # ドレイン開始から通話の終了を待つ最大時間。過ぎたら残りの通話を切断して片付ける
+    DRAIN_TIMEOUT_SECONDS: float = 120.0
+    # POST /admin/drain の X-Admin-Token に求めるトークン。空ならドレインは停止時にだけ行う
+    ADMIN_TOKEN: str = ""
+    # 受付制御。同時通話数の上限 (0 はワーカーの WORKER_CAPACITY / CAPACITY_COST_PER_JOB だけで判断)、
+    # ループ遅延 (移動平均) の上限、待機中の realtime 接続の下限 (0 は無効)
+    ADMISSION_MAX_CALLS: int = 0
+    ADMISSION_MAX_LOOP_LAG_SECONDS: float = 0.1
+    ADMISSION_MIN_POOL_IDLE: int = 0
+    # 上限を超えた着信の扱い ("reject" / "redirect" / "busy")
+    ADMISSION_SHED_ACTION: str = "reject"
+    ADMISSION_REDIRECT_NUMBER: str = ""
+    # 話中案内の音声ファイル (ACS が URL ごとにキャッシュして再生する)
+    ADMISSION_BUSY_AUDIO_URL: str = ""
+    ADMISSION_RESERVATION_SECONDS: float = 15.0
+    # 続きの数字を待つ時間 (複数桁のメニュー用) と、確定した選択を適用するまでの待ち時間
+    DTMF_INTER_DIGIT_TIMEOUT_SECONDS: float = 2.0
+    DTMF_SELECTION_DELAY_SECONDS: float = 0.3
+    # ロール切り替え時に新しいジョブのオファーを待つ最大時間。過ぎたら切り替えを取り消す
+    ROLE_SWITCH_JOB_TIMEOUT_SECONDS: float = 30.0
+    # ウォッチドッグ。ACS は無音でも 20ms ごとに音声を送るため、受信が途絶えた通話は切断して片付ける。
+    # realtime の応答が途中で止まった通話と ping に失敗した通話は realtime だけを接続し直す (0 は無効)
+    MEDIA_IDLE_TIMEOUT_SECONDS: float = 10.0
+    REALTIME_STALL_TIMEOUT_SECONDS: float = 15.0
+    REALTIME_PING_INTERVAL_SECONDS: float = 10.0
+    WATCHDOG_INTERVAL_SECONDS: float = 1.0
+    # ACS の WebSocket に uvicorn が送る ping の間隔と、pong を待つ時間
+    WEBSOCKET_PING_INTERVAL_SECONDS: float = 5.0
+    WEBSOCKET_PING_TIMEOUT_SECONDS: float = 5.0
+    # メディアワーカーのプロセス数。0 は従来どおり webhook と同じプロセスで音声を中継する
+    MEDIA_WORKERS: int = 0
+    # ワーカー i は MEDIA_WORKER_BASE_PORT + i で /media/{i}/ws/{call_id} を受ける
+    MEDIA_WORKER_BASE_PORT: int = 8081
+    # ACS に渡すメディアの接続先 ({worker} と {port} を置き換える)。空なら wss://<CALLBACK_BASEURL のホスト>/media/{worker}
+    MEDIA_WEBSOCKET_BASEURL: str = ""
+    MEDIA_IPC_DIRECTORY: str = "/tmp/callcenter"
+    MEDIA_IPC_TIMEOUT_SECONDS: float = 5.0
+    MEDIA_WORKER_RESTART_DELAY_SECONDS: float = 1.0
 
     class Config:
         env_file = ".env"
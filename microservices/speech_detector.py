@@ -0,0 +1,61 @@
+import base64
+import math
+import operator
+from array import array
+from collections import deque
+from typing import Deque, List, Tuple
+from settings import settings
+
+# 定型文を流している間 (realtime 未接続) の受信音声から発話を検知する。
+# ACS は無音でも 20ms ごとに音声を送るため、音量 (RMS) が閾値を超えるフレームが続いたら発話とみなし、
+# 検知までの直近の音声を接続後にモデルへ送れるよう保持しておく
+
+# PCM 24kHz 16bit mono
+AUDIO_BYTES_PER_SECOND = 48000
+
+class SpeechDetector:
+    def __init__(self, threshold: float, min_seconds: float, pre_roll_seconds: float) -> None:
+        self._threshold = threshold
+        self._min_bytes = int(min_seconds * AUDIO_BYTES_PER_SECOND)
+        self._max_pre_roll_bytes = int(pre_roll_seconds * AUDIO_BYTES_PER_SECOND)
+        # 検知前の音声 (Base64 音声, バイト数)。古いものから捨てる
+        self._pre_roll: Deque[Tuple[str, int]] = deque()
+        self._pre_roll_bytes = 0
+        self._voiced_bytes = 0
+
+    def feed(self, audio_data_base64: str) -> bool:
+        # 閾値を超えるフレームが min_seconds 続いたら True を返す
+        pcm = base64.b64decode(audio_data_base64)
+        self._pre_roll.append((audio_data_base64, len(pcm)))
+        self._pre_roll_bytes += len(pcm)
+        while self._pre_roll_bytes > self._max_pre_roll_bytes and len(self._pre_roll) > 1:
+            _, dropped = self._pre_roll.popleft()
+            self._pre_roll_bytes -= dropped
+        samples = array("h", pcm[:len(pcm) // 2 * 2])
+        if not samples:
+            return False
+        rms = math.sqrt(sum(map(operator.mul, samples, samples)) / len(samples))
+        if rms >= self._threshold:
+            self._voiced_bytes += len(pcm)
+        else:
+            self._voiced_bytes = 0
+        return self._voiced_bytes >= self._min_bytes
+
+    def drain(self) -> List[str]:
+        # 保持していた音声を古い順に返して空にする
+        audio = [audio_data_base64 for audio_data_base64, _ in self._pre_roll]
+        self.reset()
+        return audio
+
+    def reset(self) -> None:
+        self._pre_roll.clear()
+        self._pre_roll_bytes = 0
+        self._voiced_bytes = 0
+
+
+def create_speech_detector() -> SpeechDetector:
+    return SpeechDetector(
+        threshold = settings.REALTIME_LAZY_SPEECH_THRESHOLD,
+        min_seconds = settings.REALTIME_LAZY_SPEECH_MIN_SECONDS,
+        pre_roll_seconds = settings.REALTIME_LAZY_PRE_ROLL_SECONDS
+    )
@@ -0,0 +1,67 @@
+import time
+
+# 起動時間の計測はこのモジュールの読み込みから始める (エントリポイントで最初に import する)
+_STARTED_AT = time.perf_counter()
+
+import asyncio
+import importlib
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+class StartupTimer:
+    # 起動の内訳 (import、lifespan の各段階、受け付け開始後の読み込み) を記録する。
+    # スケールアウト直後のレプリカが着信を受けられるまでの時間を短くするため、どこに時間がかかったかを残す
+    def __init__(self, started_at: float) -> None:
+        self._started_at = started_at
+        self._marked_at = started_at
+        self.phases: Dict[str, float] = {}
+        self.ready_seconds: Optional[float] = None
+        self.warmed: List[str] = []
+        self.warmup_errors = 0
+
+    def mark(self, name: str) -> None:
+        # 前回の mark からここまでを name の所要時間とする (import、lifespan 全体など)
+        now = time.perf_counter()
+        self.phases[name] = now - self._marked_at
+        self._marked_at = now
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        # mark の区間の内訳として、個別の処理の所要時間を記録する
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started_at
+
+    def ready(self) -> None:
+        # lifespan の準備が済み、接続を受け付けられるようになった時点で呼び出す
+        self.ready_seconds = time.perf_counter() - self._started_at
+        logger.info(
+            f"Ready to accept connections in {self.ready_seconds:.3f}s",
+            **{f"{name}_seconds": round(seconds, 3) for name, seconds in self.phases.items()}
+        )
+
+    async def warm(self, modules: Iterable[str]) -> None:
+        # 着信の受け付けに不要なモジュールを、受け付け開始後にスレッドで読み込んでおく (最初の通話で待たせない)
+        with self.phase("warmup"):
+            for name in modules:
+                try:
+                    await asyncio.to_thread(importlib.import_module, name)
+                    self.warmed.append(name)
+                except Exception as e:
+                    self.warmup_errors += 1
+                    logger.error(f"Failed to import {name} during warmup: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        stats = {f"{name}_seconds": round(seconds, 6) for name, seconds in self.phases.items()}
+        stats["ready_seconds"] = round(self.ready_seconds or 0.0, 6)
+        stats["warmed_modules"] = len(self.warmed)
+        stats["warmup_errors"] = self.warmup_errors
+        return stats
+
+
+startup_timer = StartupTimer(_STARTED_AT)
@@ -1,7 +1,11 @@
 from models import ConversationState
-from typing import Dict, Optional
+import asyncio
+from typing import TYPE_CHECKING, Dict, List, Optional
 from interface import WebSocketInterface
-from realtime import Realtime
+from loop_monitor import loop_monitor
+
+if TYPE_CHECKING:
+    from realtime import Realtime
 
 class ConversationStateManager:
     def __init__(self):
@@ -29,32 +33,43 @@ class ConversationStateManager:
     def exists(self, call_id: str) -> bool:
         return call_id in self._states
 
+    def all(self) -> List[ConversationState]:
+        return list(self._states.values())
+
 
 class RealtimeManager:
     def __init__(self) -> None:
-        self._clients: Dict[str, Realtime] = {}
+        self._clients: Dict[str, "Realtime"] = {}
 
-    def create(self, call_id: str, web_socket: WebSocketInterface) -> Realtime:
+    def create(self, call_id: str, web_socket: WebSocketInterface) -> "Realtime":
         # 既存クライアントがあれば停止・削除
         if call_id in self._clients:
             self.delete(call_id)
 
+        # realtime (rtclient) は最初の通話で読み込む (起動時は startup_timer.warm で先に読み込んでおく)
+        from realtime import Realtime
         client = Realtime(web_socket)
         self._clients[call_id] = client
         return client
 
-    def get(self, call_id: str) -> Optional[Realtime]:
+    def get(self, call_id: str) -> Optional["Realtime"]:
         return self._clients.get(call_id)
 
     def exists(self, call_id: str) -> bool:
         return call_id in self._clients
 
+    async def close_all(self) -> int:
+        # 残っているクライアントを並行して閉じる
+        clients = list(self._clients.values())
+        self._clients.clear()
+        await asyncio.gather(*(client.rtclient_close() for client in clients), return_exceptions = True)
+        return len(clients)
+
     def delete(self, call_id: str) -> None:
         client = self._clients.pop(call_id, None)
         if client:
             # クライアントの後始末（WebSocket や RT client を閉じる）
             try:
-                import asyncio
-                asyncio.create_task(client.rtclient_close())
+                loop_monitor.spawn(client.rtclient_close(), call_id, "realtime-close", cleanup = True)
             except Exception:
                 pass
@@ -0,0 +1,280 @@
+import asyncio
+import re
+import time
+from collections import Counter, deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+from settings import settings
+from models import ConversationState
+from interface import SummarizerInterface
+from logger import get_logger
+from loop_monitor import loop_monitor
+
+logger = get_logger(__name__)
+
+# 英数字の単語、カタカナ語、漢字の連続、3 桁以上の数字 (注文番号など) をキーワード候補とする
+KEYWORD_PATTERN = re.compile(r"[A-Za-z][A-Za-z0-9\-]{2,}|[ァ-ー]{2,}|[一-鿿]{2,}|\d{3,}")
+STOPWORDS = frozenset({
+    "the", "and", "you", "your", "for", "that", "this", "with", "have", "are", "can", "please",
+    "hello", "thank", "thanks", "what", "how", "would", "like", "want",
+})
+
+def cap_summary(text: str, max_chars: int) -> str:
+    # 転送の operation_context に収まるよう文字数を制限する
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars - 1] + "…"
+
+
+class CallTranscript:
+    # 要約の材料になる通話ごとの文字起こし。発話が確定するたびに追記する
+    def __init__(self, max_turns: int) -> None:
+        self.turns: Deque[Tuple[str, str]] = deque(maxlen = max_turns)
+        self.first_user_text: Optional[str] = None
+        self.keywords: Counter = Counter()
+        self.revision = 0
+        self.model_summary: Optional[str] = None
+        self.model_revision = -1
+        self.model_requested_at = 0.0
+        self.published_revision = -1
+
+    def add(self, speaker: str, text: str) -> None:
+        self.turns.append((speaker, text))
+        if speaker == "user":
+            if self.first_user_text is None:
+                self.first_user_text = text
+            self.keywords.update(
+                word for word in (match.lower() for match in KEYWORD_PATTERN.findall(text))
+                if word not in STOPWORDS
+            )
+        self.revision += 1
+
+    def last(self, speaker: str) -> Optional[str]:
+        for turn_speaker, text in reversed(self.turns):
+            if turn_speaker == speaker:
+                return text
+        return None
+
+
+class KeywordSummarizer(SummarizerInterface):
+    # 最初のユーザー発話 (要件)・頻出キーワード・直近の発話を抜き出すだけのローカルな要約
+    def __init__(self, max_keywords: int = 8) -> None:
+        self._max_keywords = max_keywords
+
+    async def summarize(self, transcript: CallTranscript, role: Optional[str]) -> Optional[str]:
+        return self.build(transcript, role)
+
+    def build(self, transcript: CallTranscript, role: Optional[str]) -> str:
+        parts = [f"ロール: {role or 'メニュー'}", f"発話数: {len(transcript.turns)}"]
+        if transcript.first_user_text:
+            parts.append(f"要件: {transcript.first_user_text}")
+        if transcript.keywords:
+            keywords = ", ".join(word for word, _ in transcript.keywords.most_common(self._max_keywords))
+            parts.append(f"キーワード: {keywords}")
+        last_user = transcript.last("user")
+        if last_user and last_user != transcript.first_user_text:
+            parts.append(f"直近の発話: {last_user}")
+        last_assistant = transcript.last("assistant")
+        if last_assistant:
+            parts.append(f"直近の応答: {last_assistant}")
+        return " / ".join(parts)
+
+
+class ModelSummarizer(SummarizerInterface):
+    # Azure OpenAI のチャットモデルで要約する。通話中のバックグラウンドでのみ呼び出す
+    def __init__(
+        self,
+        endpoint: str,
+        key: str,
+        deployment: str,
+        api_version: str,
+        max_chars: int,
+        timeout: float = 10.0
+    ) -> None:
+        self._url = f"{endpoint.rstrip('/')}/openai/deployments/{deployment}/chat/completions?api-version={api_version}"
+        self._key = key
+        self._max_chars = max_chars
+        self._timeout = timeout
+        self._session = None
+
+    async def start(self) -> None:
+        # aiohttp は rtclient の依存として入っているが、モデル要約を使う場合にだけ読み込む
+        import aiohttp
+        self._session = aiohttp.ClientSession(timeout = aiohttp.ClientTimeout(total = self._timeout))
+
+    async def stop(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def summarize(self, transcript: CallTranscript, role: Optional[str]) -> Optional[str]:
+        if self._session is None:
+            return None
+        lines = "\n".join(
+            f"{'顧客' if speaker == 'user' else 'AI'}: {text}" for speaker, text in transcript.turns
+        )
+        body = {
+            "messages": [
+                {
+                    "role": "system",
+                    "content": f"コールセンターの通話内容を、オペレーターへの引き継ぎ用に {self._max_chars} 文字以内で要約してください。"
+                               "顧客の要件、確認済みの情報、未解決の事項を含めてください。"
+                },
+                {"role": "user", "content": f"現在のロール: {role or 'メニュー'}\n{lines}"},
+            ],
+            "max_tokens": 300,
+            "temperature": 0,
+        }
+        async with self._session.post(self._url, json = body, headers = {"api-key": self._key}) as response:
+            response.raise_for_status()
+            data = await response.json()
+        return data["choices"][0]["message"]["content"].strip()
+
+
+class ConversationSummaries:
+    # 発話が確定するたびにバックグラウンドで要約を更新し、ConversationState.conversation_summary に置いておく。
+    # 転送時は要約を待たずに、その時点の要約をそのまま operation_context として渡す
+    def __init__(
+        self,
+        enabled: bool,
+        max_chars: int,
+        max_turns: int,
+        model: Optional[ModelSummarizer] = None,
+        model_min_interval: float = 5.0
+    ) -> None:
+        self.enabled = enabled
+        self._max_chars = max_chars
+        self._max_turns = max_turns
+        self._local = KeywordSummarizer()
+        self._model = model
+        self._model_min_interval = model_min_interval
+        self._transcripts: Dict[str, CallTranscript] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.local_updates = 0
+        self.model_updates = 0
+        self.model_errors = 0
+        self._on_publish: Optional[Callable[[str, str], None]] = None
+
+    def configure(self, on_publish: Optional[Callable[[str, str], None]]) -> None:
+        # on_publish は要約を更新するたびに (call_id, 要約) で呼ばれる。メディアワーカーではコントロールプレーンへの通知に使う
+        self._on_publish = on_publish
+
+    async def start(self) -> None:
+        if self.enabled and self._model is not None:
+            await self._model.start()
+
+    async def stop(self) -> None:
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+        self._transcripts.clear()
+        if self._model is not None:
+            await self._model.stop()
+
+    def add_turn(self, conversation_state: Optional[ConversationState], speaker: str, text: str) -> None:
+        if not self.enabled or conversation_state is None or not text:
+            return
+        call_id = conversation_state.call_id
+        transcript = self._transcripts.get(call_id)
+        if transcript is None:
+            transcript = CallTranscript(self._max_turns)
+            self._transcripts[call_id] = transcript
+        transcript.add(speaker, text)
+        task = self._tasks.get(call_id)
+        if task is None or task.done():
+            self._tasks[call_id] = loop_monitor.spawn(
+                self._refresh(conversation_state, transcript), call_id, "summary"
+            )
+
+    def flush(self, conversation_state: ConversationState) -> Optional[str]:
+        # 転送の直前に呼び出し、バックグラウンドでまだ反映していない発話をローカルの要約で反映する
+        transcript = self._transcripts.get(conversation_state.call_id)
+        if transcript is not None and transcript.published_revision != transcript.revision:
+            self._publish(conversation_state, transcript)
+        return conversation_state.conversation_summary
+
+    def discard(self, call_id: str) -> None:
+        self._transcripts.pop(call_id, None)
+        task = self._tasks.pop(call_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def _refresh(self, conversation_state: ConversationState, transcript: CallTranscript) -> None:
+        # 要約中に追加された発話は次の周回でまとめて反映する
+        summarized = -1
+        while summarized != transcript.revision:
+            summarized = transcript.revision
+            self._publish(conversation_state, transcript)
+            if self._model_due(transcript):
+                await self._refresh_model_summary(conversation_state, transcript)
+
+    def _publish(self, conversation_state: ConversationState, transcript: CallTranscript) -> None:
+        if transcript.model_summary:
+            # モデルの要約を基本とし、その後の発話だけローカルで補う
+            summary = transcript.model_summary
+            if transcript.model_revision != transcript.revision:
+                last_user = transcript.last("user")
+                if last_user:
+                    summary = f"{summary} / 直近の発話: {last_user}"
+        else:
+            summary = self._local.build(transcript, conversation_state.current_role)
+        conversation_state.conversation_summary = cap_summary(summary, self._max_chars)
+        transcript.published_revision = transcript.revision
+        self.local_updates += 1
+        if self._on_publish is not None:
+            self._on_publish(conversation_state.call_id, conversation_state.conversation_summary)
+
+    def _model_due(self, transcript: CallTranscript) -> bool:
+        return (
+            self._model is not None
+            and transcript.model_revision != transcript.revision
+            and time.monotonic() - transcript.model_requested_at >= self._model_min_interval
+        )
+
+    async def _refresh_model_summary(self, conversation_state: ConversationState, transcript: CallTranscript) -> None:
+        revision = transcript.revision
+        transcript.model_requested_at = time.monotonic()
+        try:
+            summary = await self._model.summarize(transcript, conversation_state.current_role)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.model_errors += 1
+            logger.warning(f"Model summary failed: {e}", category = "summary.model_failed")
+            return
+        if summary:
+            transcript.model_summary = summary
+            transcript.model_revision = revision
+            self.model_updates += 1
+            self._publish(conversation_state, transcript)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active_calls": len(self._transcripts),
+            "local_updates": self.local_updates,
+            "model_updates": self.model_updates,
+            "model_errors": self.model_errors,
+        }
+
+
+def create_model_summarizer() -> Optional[ModelSummarizer]:
+    if settings.SUMMARIZER != "model":
+        return None
+    if not settings.SUMMARY_MODEL_DEPLOYMENT_NAME:
+        logger.warning("SUMMARIZER is 'model' but SUMMARY_MODEL_DEPLOYMENT_NAME is empty, using the keyword summarizer")
+        return None
+    return ModelSummarizer(
+        endpoint = settings.AZURE_OPENAI_SERVICE_ENDPOINT,
+        key = settings.AZURE_OPENAI_SERVICE_KEY,
+        deployment = settings.SUMMARY_MODEL_DEPLOYMENT_NAME,
+        api_version = settings.SUMMARY_MODEL_API_VERSION,
+        max_chars = settings.SUMMARY_MAX_CHARS
+    )
+
+
+conversation_summaries = ConversationSummaries(
+    enabled = settings.SUMMARY_ENABLED,
+    max_chars = settings.SUMMARY_MAX_CHARS,
+    max_turns = settings.SUMMARY_MAX_TURNS,
+    model = create_model_summarizer(),
+    model_min_interval = settings.SUMMARY_MODEL_MIN_INTERVAL_SECONDS
+)
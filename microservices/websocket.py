@@ -1,33 +1,49 @@
 import asyncio
 import json
+import time
 from datetime import datetime
+from typing import Optional
 from fastapi import WebSocket as FastAPIWebSocket
 from models import ConversationState
 from interface import RealtimeInterface, WebSocketInterface
+from logger import get_logger
+from trace_recorder import recorder as trace_recorder
+from loop_monitor import loop_monitor
+from call_recorder import call_recorder, INBOUND, OUTBOUND
+from call_watchdog import call_watchdog
+from metrics import ACTIVE_CALLS, INBOUND_BYTES, INBOUND_FRAMES, OUTBOUND_BYTES, OUTBOUND_FRAMES, base64_decoded_length
+
+logger = get_logger(__name__)
 
 class WebSocket(WebSocketInterface):
     def __init__(self, websocket: FastAPIWebSocket, call_id: str, realtime: RealtimeInterface) -> None:
         self._websocket = websocket
         self._call_id = call_id
         self._realtime = realtime
+        self.relay_task: Optional[asyncio.Task] = None
 
     async def websocket_handler(self, conversation_state: ConversationState) -> None:
         await self._websocket.accept()
-        print(f"WebSocket connection established for call_id: {conversation_state.call_id}")
+        logger.info(f"WebSocket connection established for call_id: {conversation_state.call_id}")
         await self._realtime.start_realtime_conversation_loop(conversation_state)
         await self.start_acs_conversation_loop()
     
     async def websocket_update(self, conversation_state: ConversationState) -> None:
-        print(f"WebSocket update for call_id: {conversation_state.call_id}")
+        logger.info(f"WebSocket update for call_id: {conversation_state.call_id}")
         await self._realtime.start_realtime_conversation_loop(conversation_state)
 
     async def start_acs_conversation_loop(self) -> None:   
-        asyncio.create_task(self.transfer_acs_to_realtime_api_until_disconnect())
+        self.relay_task = loop_monitor.spawn(self.transfer_acs_to_realtime_api_until_disconnect(), self._call_id, "relay-in")
 
     async def transfer_acs_to_realtime_api_until_disconnect(self) -> None:
+        ACTIVE_CALLS.inc()
+        # ACS からの受信が途絶えたらウォッチドッグがこのタスクを止め、realtime の停止は realtime だけを接続し直す
+        relay_task = asyncio.current_task()
+        activity = call_watchdog.watch(self._call_id, relay_task.cancel, self._realtime.recover, self._realtime.ping)
         try:
             while True:
                 message = await self._websocket.receive()
+                activity.inbound_at = time.monotonic()
                 msg_type = message.get('type')
 
                 if msg_type == 'websocket.receive':
@@ -35,29 +51,38 @@ class WebSocket(WebSocketInterface):
                     kind = payload.get('kind')
 
                     if kind != 'AudioData':
-                        print(f"Skipping non-audio payload kind: {kind}")
+                        trace_recorder.record(self._call_id, "acs_message", payload = payload)
+                        logger.debug(f"Skipping non-audio payload kind: {kind}", category = "acs.non_audio_payload")
                         continue
 
                     audio_data_base64 = payload.get('audioData', {}).get('data')
                     if not audio_data_base64:
-                        print(f"Unexpected payload format or no audio data: {payload}")
+                        logger.warning("Unexpected payload format or no audio data", category = "acs.invalid_payload")
                         continue
-                    
+
+                    trace_recorder.record_audio(self._call_id, "acs_audio", audio_data_base64)
+                    INBOUND_FRAMES.inc()
+                    INBOUND_BYTES.inc(base64_decoded_length(audio_data_base64))
+                    call_recorder.tap(self._call_id, INBOUND, audio_data_base64)
                     await self._realtime.send_audio_buffer_to_realtime_api(audio_data_base64)
                 
                 elif msg_type == 'websocket.disconnect':
-                    print("WebSocket disconnected")
+                    logger.info("WebSocket disconnected")
                     break
 
         except Exception as e:
-            print(f"Exception in receive_message_until_disconnect: {e}")
+            logger.error(f"Exception in receive_message_until_disconnect: {e}")
         
         finally:
+            call_watchdog.unwatch(self._call_id, activity)
+            ACTIVE_CALLS.dec()
+            trace_recorder.media_closed(self._call_id)
+            call_recorder.end(self._call_id)
             try:
                 await self._realtime.rtclient_close()
             except Exception as e:
-                print(f"Error closing realtime client: {e}")
-            print(f"Connection closed for call_id: {self._call_id}")
+                logger.error(f"Error closing realtime client: {e}")
+            logger.info(f"Connection closed for call_id: {self._call_id}")
 
     async def send_text_to_acs(self, audio_data_base64: str) -> None:
         message = {
@@ -70,3 +95,9 @@ class WebSocket(WebSocketInterface):
         }
         message_str = json.dumps(message)
         await self._websocket.send_text(message_str)
+        activity = call_watchdog.get(self._call_id)
+        if activity is not None:
+            activity.outbound_at = time.monotonic()
+        call_recorder.tap(self._call_id, OUTBOUND, audio_data_base64)
+        OUTBOUND_FRAMES.inc()
+        OUTBOUND_BYTES.inc(base64_decoded_length(audio_data_base64))
@@ -0,0 +1,140 @@
+import time
+from typing import Callable, Dict, Optional
+from config import (
+    ADMISSION_MAX_CALLS,
+    ADMISSION_MAX_LOOP_LAG_SECONDS,
+    ADMISSION_SHED_ACTION,
+    ADMISSION_REDIRECT_NUMBER,
+    ADMISSION_BUSY_AUDIO_URL,
+    ADMISSION_RESERVATION_SECONDS,
+)
+from logger import get_logger
+from loop_monitor import loop_monitor
+
+logger = get_logger(__name__)
+
+# 受付制御。1 つのイベントループで中継できる通話数を超えると全通話の音声が同時に劣化するため、
+# 着信ごとに現在の負荷を確認し、上限を超える着信は応答せずに拒否・転送・話中案内のいずれかで断る
+SHED_REJECT = "reject"
+SHED_REDIRECT = "redirect"
+SHED_BUSY = "busy"
+SHED_ACTIONS = (SHED_REJECT, SHED_REDIRECT, SHED_BUSY)
+
+REASON_CAPACITY = "capacity"
+REASON_LOOP_LAG = "loop_lag"
+REASON_POOL = "pool"
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_calls: int = 0,
+        max_loop_lag: float = 0.0,
+        min_pool_idle: int = 0,
+        shed_action: str = SHED_REJECT,
+        redirect_number: str = "",
+        busy_audio_url: str = "",
+        reservation_seconds: float = 15.0
+    ) -> None:
+        # 0 は無効 (max_calls はジョブの容量だけで判断する)
+        self._max_calls = max_calls
+        self._max_loop_lag = max_loop_lag
+        self._min_pool_idle = min_pool_idle
+        self.shed_action = self._effective_action(shed_action, redirect_number, busy_audio_url)
+        self.redirect_number = redirect_number
+        self.busy_audio_url = busy_audio_url
+        self._reservation_seconds = reservation_seconds
+        self._active_calls: Optional[Callable[[], int]] = None
+        self._pool_idle: Optional[Callable[[], int]] = None
+        self._job_capacity = 0
+        # 応答済みでメディアの WebSocket がまだ接続していない通話。call_id -> 受け付けた時刻
+        self._reservations: Dict[str, float] = {}
+        self.admitted = 0
+        self.shed: Dict[str, int] = {REASON_CAPACITY: 0, REASON_LOOP_LAG: 0, REASON_POOL: 0}
+
+    @staticmethod
+    def _effective_action(action: str, redirect_number: str, busy_audio_url: str) -> str:
+        if action not in SHED_ACTIONS:
+            logger.warning(f"Unknown ADMISSION_SHED_ACTION '{action}', rejecting calls over the limit")
+            return SHED_REJECT
+        if action == SHED_REDIRECT and not redirect_number:
+            logger.warning("ADMISSION_SHED_ACTION is 'redirect' but ADMISSION_REDIRECT_NUMBER is empty, rejecting instead")
+            return SHED_REJECT
+        if action == SHED_BUSY and not busy_audio_url:
+            logger.warning("ADMISSION_SHED_ACTION is 'busy' but ADMISSION_BUSY_AUDIO_URL is empty, rejecting instead")
+            return SHED_REJECT
+        return action
+
+    def configure(
+        self,
+        active_calls: Callable[[], int],
+        job_capacity: int = 0,
+        pool_idle: Optional[Callable[[], int]] = None
+    ) -> None:
+        # active_calls は中継中の通話数、job_capacity はワーカーが同時に持てるジョブ数 (capacity / capacity_cost_per_job)
+        self._active_calls = active_calls
+        self._job_capacity = job_capacity
+        self._pool_idle = pool_idle
+
+    @property
+    def max_calls(self) -> int:
+        limits = [limit for limit in (self._max_calls, self._job_capacity) if limit > 0]
+        return min(limits) if limits else 0
+
+    def _expire_reservations(self) -> None:
+        # 応答後に WebSocket が接続されなかった通話は、一定時間で数えなくなる
+        deadline = time.monotonic() - self._reservation_seconds
+        for call_id in [call_id for call_id, admitted_at in self._reservations.items() if admitted_at < deadline]:
+            del self._reservations[call_id]
+
+    def calls(self) -> int:
+        self._expire_reservations()
+        active = self._active_calls() if self._active_calls else 0
+        return active + len(self._reservations)
+
+    def admit(self, call_id: str) -> Optional[str]:
+        # 受け付ける場合は枠を確保して None を、断る場合はその理由を返す
+        reason = self._check()
+        if reason is not None:
+            self.shed[reason] += 1
+            logger.warning(f"Shedding incoming call ({reason}), action: {self.shed_action}", category = "admission.shed")
+            return reason
+        self._reservations[call_id] = time.monotonic()
+        self.admitted += 1
+        return None
+
+    def _check(self) -> Optional[str]:
+        max_calls = self.max_calls
+        if max_calls and self.calls() >= max_calls:
+            return REASON_CAPACITY
+        if self._max_loop_lag and loop_monitor.smoothed_lag > self._max_loop_lag:
+            return REASON_LOOP_LAG
+        if self._min_pool_idle and self._pool_idle is not None and self._pool_idle() < self._min_pool_idle:
+            return REASON_POOL
+        return None
+
+    def release(self, call_id: str) -> None:
+        # メディアが接続された (以降は中継中の通話として数える) か、応答に失敗した時に呼び出す
+        self._reservations.pop(call_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "max_calls": self.max_calls,
+            "max_loop_lag_seconds": self._max_loop_lag,
+            "min_pool_idle": self._min_pool_idle,
+            "calls": self.calls(),
+            "reserved": len(self._reservations),
+            "admitted": self.admitted,
+            "shed_capacity": self.shed[REASON_CAPACITY],
+            "shed_loop_lag": self.shed[REASON_LOOP_LAG],
+            "shed_pool": self.shed[REASON_POOL],
+        }
+
+
+admission_controller = AdmissionController(
+    max_calls = ADMISSION_MAX_CALLS,
+    max_loop_lag = ADMISSION_MAX_LOOP_LAG_SECONDS,
+    shed_action = ADMISSION_SHED_ACTION,
+    redirect_number = ADMISSION_REDIRECT_NUMBER,
+    busy_audio_url = ADMISSION_BUSY_AUDIO_URL,
+    reservation_seconds = ADMISSION_RESERVATION_SECONDS
+)
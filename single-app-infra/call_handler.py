@@ -1,4 +1,5 @@
 import asyncio
+import time
 import uuid
 from urllib.parse import urlencode, urlparse
 
@@ -6,33 +7,161 @@ from fastapi import APIRouter, Request, Response
 from fastapi.responses import JSONResponse, PlainTextResponse
 
 from azure.eventgrid import EventGridEvent, SystemEventNames
-from azure.core.messaging import CloudEvent
 from azure.communication.callautomation import (
     MediaStreamingOptions,
     AudioFormat,
     MediaStreamingTransportType,
     MediaStreamingContentType,
     MediaStreamingAudioChannelType,
-    DtmfTone,
+    CallRejectReason,
+    FileSource,
+    PhoneNumberIdentifier,
 )
 
 from config import CALLBACK_EVENTS_URI, TRIGGER_MODE
-from clients import acs_client
-from job_router import submit_job_to_queue, handle_job_offers, handle_job_offer_event, handle_job_completion
-from conversation_manager import update_conversation
-from utils import print_debug, parse_communication_identifier
+import clients
+from job_router import submit_job_to_queue, handle_job_offers, handle_job_offer_event, close_outstanding_job
+from conversation_manager import update_conversation, close_gpt_client_quietly
+from utils import print_debug, parse_communication_identifier, set_log_level
+import logger as log_config
+from metrics import (
+    registry as metrics_registry,
+    INCOMING_CALL_TO_ANSWER_SECONDS,
+    ROLE_SWITCH_ROUTING_SECONDS,
+    ROLE_SWITCHES_COMPLETED,
+    ROLE_SWITCHES_ROLLED_BACK,
+)
+from logger import bind_call
+from trace_recorder import recorder as trace_recorder
+from loop_monitor import loop_monitor
+from role_profiles import role_profiles
+from transcript_archive import transcript_archive
+from drain import ADMIN_TOKEN_HEADER, drain_controller
+from dtmf_collector import dtmf_collectors
+from admission import admission_controller, SHED_BUSY, SHED_REDIRECT
+from startup import startup_timer
+from caller_context import caller_contexts
 
 router = APIRouter()
 
 @router.get("/")
 async def read_root():
-    print_debug("Sample ACS Realtime API Call Center is running")
+    print_debug("Sample ACS Realtime API Call Center is running", log_level="debug")
     return PlainTextResponse("Sample ACS Realtime API Call Center is running")
 
+@router.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/debug/logging")
+async def get_logging_status():
+    return JSONResponse(content=log_config.stats())
+
+@router.put("/debug/logging")
+async def update_logging(level: str):
+    """
+    再起動せずにログレベルを変更します。
+    """
+    try:
+        set_log_level(level)
+    except ValueError:
+        return JSONResponse(content={"message": f"Unknown log level: {level}"}, status_code=400)
+    return JSONResponse(content=log_config.stats())
+
+@router.get("/debug/loop")
+async def get_loop_status(limit: int = 10):
+    """
+    イベントループの遅延、ストールの多いスタック、通話ごとのタスクを返します。
+    """
+    return JSONResponse(content=loop_monitor.snapshot(limit))
+
+@router.get("/debug/tasks")
+async def get_tasks(call_id: str = None, limit: int = 100):
+    """
+    生きているタスクを返します。call_id を指定するとその通話のタスクだけを返します (切断後に残っていないことの確認用)。
+    """
+    return JSONResponse(content={
+        "tasks_by_call": loop_monitor.tasks_by_call(),
+        "tasks": loop_monitor.tasks(limit, call_id=call_id),
+    })
+
+@router.post("/debug/loop/profile")
+async def profile_loop(seconds: float = 10.0, interval: float = 0.005):
+    """
+    指定秒数だけサンプリングプロファイラを動かし、ループを占有しているスタックを返します。
+    """
+    if not 0 < seconds <= 60 or not 0.001 <= interval <= 1:
+        return JSONResponse(content={"message": "seconds must be in (0, 60] and interval in [0.001, 1]"}, status_code=400)
+    try:
+        result = await loop_monitor.profile(seconds, interval)
+    except RuntimeError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=409)
+    return JSONResponse(content=result)
+
+@router.get("/debug/roles")
+async def get_role_profiles():
+    """
+    読み込み済みのロールプロファイルを返します。
+    """
+    return JSONResponse(content=role_profiles.snapshot())
+
+@router.post("/debug/roles/reload")
+async def reload_role_profiles():
+    """
+    roles.json の更新は自動で反映されますが、確認間隔を待たずにすぐ読み直します。
+    """
+    if not role_profiles.reload():
+        return JSONResponse(content={"message": "Failed to load role profiles, keeping the previous ones"}, status_code=400)
+    return JSONResponse(content=role_profiles.snapshot())
+
+@router.get("/debug/transcripts/{call_id}")
+async def get_transcript(call_id: str):
+    """
+    アーカイブ済みの文字起こしを返します (書き込みスレッドが未書き込みの直近の発話は含みません)。
+    """
+    if not transcript_archive.enabled:
+        return JSONResponse(content={"message": "Transcript archive is disabled"}, status_code=404)
+    entries = await asyncio.to_thread(transcript_archive.read, call_id)
+    return JSONResponse(content={"call_id": call_id, "entries": entries})
+
+@router.get("/admin/drain")
+async def get_drain_status():
+    """
+    ドレインの状態 (残りの通話数、経過時間、受け付けなかった着信数) を返します。
+    """
+    return JSONResponse(content=drain_controller.status())
+
+@router.post("/admin/drain")
+async def start_drain(request: Request):
+    """
+    新規着信の受け付けを止め、通話の終了を待ってから残りを片付けます。デプロイの preStop などから呼び出します。
+    X-Admin-Token ヘッダーに ADMIN_TOKEN と同じ値が必要です。
+    """
+    if not drain_controller.authorize(request.headers.get(ADMIN_TOKEN_HEADER)):
+        return JSONResponse(content={"message": "Forbidden"}, status_code=403)
+    drain_controller.start()
+    return JSONResponse(content=drain_controller.status(), status_code=202)
+
+@router.get("/debug/startup")
+async def get_startup_status():
+    """
+    起動の内訳 (import・lifespan の各段階・受け付け開始後の読み込み) を返します。
+    """
+    return JSONResponse(content={"warmed": startup_timer.warmed, **startup_timer.stats()})
+
+@router.get("/debug/admission")
+async def get_admission_status():
+    """
+    受付制御の閾値と、現在の通話数・断った着信数を返します。
+    """
+    return JSONResponse(content={"shed_action": admission_controller.shed_action, **admission_controller.stats()})
+
 @router.post("/api/incomingCall")
 async def incoming_call_handler(request: Request):
     print_debug("Incoming call received")
+    received_at = time.monotonic()
     events = await request.json()
+    incoming_call_events = []
     for event_dict in events:
         print_debug("event_dict:", {
             **event_dict,
@@ -47,154 +176,453 @@ async def incoming_call_handler(request: Request):
             print_debug("Validation code:", validation_code)
             return JSONResponse(content={"validationResponse": validation_code})
         elif event.event_type == "Microsoft.Communication.IncomingCall":
-            call_id = str(uuid.uuid4())
-            caller_id = (
-                event.data["from"]["phoneNumber"]["value"]
-                if event.data["from"]["kind"] == "phoneNumber"
-                else event.data["from"]["rawId"]
+            incoming_call_events.append(event)
+
+    if not incoming_call_events:
+        return Response(status_code=400)
+
+    # ドレイン中は応答せず、Event Grid に再配信させて他のレプリカで受ける
+    if drain_controller.draining:
+        drain_controller.reject(len(incoming_call_events))
+        print_debug("Rejecting incoming calls while draining")
+        return JSONResponse(content={"message": "Draining"}, status_code=503, headers={"Retry-After": "1"})
+
+    # バッチ内の着信をそれぞれ独立した通話として並列に応答する
+    # 受付制御は応答の順番待ちより前に行い、断る着信を待たせない
+    semaphore = request.app.state.incoming_call_semaphore
+    decisions = []
+    for event in incoming_call_events:
+        call_id = str(uuid.uuid4())
+        decisions.append((event, call_id, admission_controller.admit(call_id)))
+    results = await asyncio.gather(*(
+        answer_incoming_call(request.app, event, call_id, semaphore, received_at) if reason is None
+        else shed_incoming_call(request.app, event, call_id, reason)
+        for event, call_id, reason in decisions
+    ))
+    # 一件でも応答 (または断る処理) できていれば 200 を返し、処理済みの着信が再配信されないようにする
+    answered = any(result["status"] in ("answered", "shed") for result in results)
+    return JSONResponse(content={"results": results}, status_code=200 if answered else 500)
+
+async def answer_incoming_call(app, event: EventGridEvent, call_id: str, semaphore: asyncio.Semaphore, received_at: float) -> dict:
+    """
+    IncomingCall イベント 1 件に応答し、イベントごとの処理結果を返します。
+    """
+    bind_call(call_id)
+    trace_recorder.begin(call_id, app="single-app")
+    trace_recorder.record(call_id, "incoming", event={
+        "id": event.id,
+        "eventType": event.event_type,
+        "subject": event.subject,
+        "data": event.data,
+    })
+    async with semaphore:
+        try:
+            await _answer_incoming_call(app, event, call_id, received_at)
+            trace_recorder.record(call_id, "answered")
+            return {"eventId": event.id, "callId": call_id, "status": "answered"}
+        except Exception as e:
+            print_debug(f"Error handling incoming call {call_id}: {e}")
+            trace_recorder.record(call_id, "answer_failed", error=str(e))
+            trace_recorder.end(call_id)
+            admission_controller.release(call_id)
+            return {"eventId": event.id, "callId": call_id, "status": "error", "error": str(e)}
+
+async def shed_incoming_call(app, event: EventGridEvent, call_id: str, reason: str) -> dict:
+    """
+    受付制御の上限を超えた着信を、設定に応じて拒否・転送するか、応答して話中案内を流します。
+    """
+    bind_call(call_id)
+    action = admission_controller.shed_action
+    incoming_call_context = event.data["incomingCallContext"]
+    try:
+        if action == SHED_BUSY:
+            # 話中案内だけを流すため、メディアストリーミングなしで応答する
+            app.state.conversation_states[call_id] = {"call_id": call_id, "busy": True}
+            await clients.acs_client.answer_call(
+                incoming_call_context=incoming_call_context,
+                operation_context="busy",
+                callback_url=f"{CALLBACK_EVENTS_URI}/{call_id}",
             )
-            incoming_call_context = event.data["incomingCallContext"]
-            print_debug("Caller ID:", caller_id)
-            query_parameters = urlencode({"callerId": caller_id})
-            callback_uri = f"{CALLBACK_EVENTS_URI}/{call_id}?{query_parameters}"
-            parsed_url = urlparse(CALLBACK_EVENTS_URI)
-            websocket_url = f"wss://{parsed_url.netloc}/ws/{call_id}"
-            print_debug("websocket_url:", websocket_url)
-
-            media_streaming_options = MediaStreamingOptions(
-                transport_url=websocket_url,
-                transport_type=MediaStreamingTransportType.WEBSOCKET,
-                content_type=MediaStreamingContentType.AUDIO,
-                audio_channel_type=MediaStreamingAudioChannelType.MIXED,
-                start_media_streaming=True,
-                enable_bidirectional=True,
-                audio_format=AudioFormat.PCM24_K_MONO,
+        elif action == SHED_REDIRECT:
+            await clients.acs_client.redirect_call(
+                incoming_call_context=incoming_call_context,
+                target_participant=PhoneNumberIdentifier(admission_controller.redirect_number),
             )
-
-            # Answer the incoming call
-            await acs_client.answer_call(
+        else:
+            await clients.acs_client.reject_call(
                 incoming_call_context=incoming_call_context,
-                operation_context="incomingCall",
-                callback_url=callback_uri,
-                media_streaming=media_streaming_options,
+                call_reject_reason=CallRejectReason.BUSY,
             )
+        return {"eventId": event.id, "callId": call_id, "status": "shed", "reason": reason, "action": action}
+    except Exception as e:
+        print_debug(f"Error shedding incoming call {call_id}: {e}", log_level="error")
+        app.state.conversation_states.pop(call_id, None)
+        return {"eventId": event.id, "callId": call_id, "status": "error", "error": str(e)}
 
-            selected_role = "RoleDefault"
-            generated_job_id = str(uuid.uuid4())
-            queue_id = request.app.state.queues["queue-0"]["id"]
-            print_debug("queue_id:", queue_id)
-            # Assuming a queue has already been created and attached to the FastAPI app state
-            submitted_job_id = await submit_job_to_queue(
-                generated_job_id, "voice", queue_id, priority=1, role_label=selected_role
-            )
+async def _answer_incoming_call(app, event: EventGridEvent, call_id: str, received_at: float):
+    caller_id = (
+        event.data["from"]["phoneNumber"]["value"]
+        if event.data["from"]["kind"] == "phoneNumber"
+        else event.data["from"]["rawId"]
+    )
+    incoming_call_context = event.data["incomingCallContext"]
+    print_debug("Caller ID:", caller_id)
+    # 発信者のプロファイルは応答やジョブの登録と並行して読み込む (応答は待たない)
+    caller_contexts.prefetch(caller_id)
+    query_parameters = urlencode({"callerId": caller_id})
+    callback_uri = f"{CALLBACK_EVENTS_URI}/{call_id}?{query_parameters}"
+    parsed_url = urlparse(CALLBACK_EVENTS_URI)
+    websocket_url = f"wss://{parsed_url.netloc}/ws/{call_id}"
+    print_debug("websocket_url:", websocket_url)
 
-            request.app.state.job_id_to_call_id[submitted_job_id] = call_id
-            print_debug("Call ID", call_id)
-
-            caller = parse_communication_identifier(event.data["from"])
-            conversation_state = {
-                "call_id": call_id,
-                "job_id": submitted_job_id,
-                "caller_id": caller_id,
-                "caller_communication_identifier": caller,
-                "media_streaming_options": media_streaming_options,
-                "websocket_ready": False,
-                "current_role": None,
-            }
+    media_streaming_options = MediaStreamingOptions(
+        transport_url=websocket_url,
+        transport_type=MediaStreamingTransportType.WEBSOCKET,
+        content_type=MediaStreamingContentType.AUDIO,
+        audio_channel_type=MediaStreamingAudioChannelType.MIXED,
+        start_media_streaming=True,
+        enable_bidirectional=True,
+        audio_format=AudioFormat.PCM24_K_MONO,
+    )
 
-            request.app.state.conversation_states[call_id] = conversation_state
-            print_debug("Conversation states:", conversation_state)
+    # Answer the incoming call
+    await clients.acs_client.answer_call(
+        incoming_call_context=incoming_call_context,
+        operation_context="incomingCall",
+        callback_url=callback_uri,
+        media_streaming=media_streaming_options,
+    )
+    INCOMING_CALL_TO_ANSWER_SECONDS.observe_since(received_at)
 
-            # Start processing job offers asynchronously
-            if conversation_state.get("job_offer_task"):
-                conversation_state["job_offer_task"].cancel()
-            if TRIGGER_MODE == "polling":
-                conversation_state["job_offer_task"] = asyncio.create_task(
-                    handle_job_offers(submitted_job_id, call_id, conversation_state)
-                )
-            return Response(status_code=200)
-    return Response(status_code=400)
+    selected_role = "RoleDefault"
+    generated_job_id = str(uuid.uuid4())
+    queue_id = app.state.queues["queue-0"]["id"]
+    print_debug("queue_id:", queue_id)
+    job_submitted_at = time.monotonic()
+    # Assuming a queue has already been created and attached to the FastAPI app state
+    submitted_job_id = await submit_job_to_queue(
+        generated_job_id, "voice", queue_id, priority=1, role_label=selected_role
+    )
+
+    app.state.job_id_to_call_id[submitted_job_id] = call_id
+    print_debug("Call ID", call_id)
+
+    caller = parse_communication_identifier(event.data["from"])
+    conversation_state = {
+        "call_id": call_id,
+        "job_id": submitted_job_id,
+        "caller_id": caller_id,
+        "caller_communication_identifier": caller,
+        "media_streaming_options": media_streaming_options,
+        "websocket_ready": False,
+        "current_role": None,
+        "job_submitted_at": job_submitted_at,
+    }
+
+    app.state.conversation_states[call_id] = conversation_state
+    print_debug("Conversation states:", conversation_state)
+
+    # Start processing job offers asynchronously
+    if conversation_state.get("job_offer_task"):
+        conversation_state["job_offer_task"].cancel()
+    if TRIGGER_MODE == "polling":
+        conversation_state["job_offer_task"] = loop_monitor.spawn(
+            handle_job_offers(submitted_job_id, call_id, conversation_state), call_id, "offer-wait"
+        )
 
 @router.post("/api/callbacks/{call_id}")
 async def handle_callback(call_id: str, request: Request):
+    bind_call(call_id)
     events = await request.json()
     print_debug("Callback events:", events, log_level="debug")
+    processed_event_cache = request.app.state.processed_event_cache
     for event_dict in events:
-        event = CloudEvent.from_dict(event_dict)
-        print_debug("Callback event:", event, log_level="debug")
-        call_connection_id = event.data["callConnectionId"]
-        conversation_state = request.app.state.conversation_states.get(call_id)
-        
-        if event.type == "Microsoft.Communication.CallConnected":
-            print_debug("Call connected")
-            await start_dtmf_recognition(call_connection_id, call_id, conversation_state)
-        elif event.type == "Microsoft.Communication.ContinuousDtmfRecognitionToneReceived":
-            tone = event.data["tone"]
-            role_map = {
-                DtmfTone.ONE.value: "RoleA",
-                DtmfTone.TWO.value: "RoleB",
-                DtmfTone.THREE.value: "RoleC",
-                DtmfTone.FOUR.value: "RoleD",
-                DtmfTone.FIVE.value: "RoleE"
-            }
-            if tone in role_map:
-                print_debug(f"Tone {tone} received, switching role to {role_map[tone]}")
-                conversation_state["current_role"] = role_map[tone]
-            else:
-                print_debug(f"Received unhandled DTMF tone: {tone}")
-
-            previous_job_id = conversation_state.get("job_id")
-            previous_assignment_id = conversation_state.get("assignment_id")
-            # Handle previous job completion if necessary
-            if previous_job_id:
-                if previous_assignment_id:
-                    await handle_job_completion(previous_job_id, previous_assignment_id)
-                    print_debug(f"Completed previous job {previous_job_id}.")
-                else:
-                    print_debug("No assignment ID found for previous job, skipping job completion.")
-                conversation_state.pop("job_id", None)
-                conversation_state.pop("assignment_id", None)
-                removed_call_id = request.app.state.job_id_to_call_id.pop(previous_job_id, None)
-                if removed_call_id is not None:
-                    print_debug(f"Removed job_id {removed_call_id} with call_id {removed_call_id}")
-                else:
-                    print_debug(f"Job_id {removed_call_id} not found in mapping")
-
-            new_job_id = str(uuid.uuid4())
-            conversation_state["job_id"] = new_job_id
-            queue_id = request.app.state.queues["queue-1"]["id"]
-            print_debug("queue_id:", queue_id)
-            submitted_job_id = await submit_job_to_queue(
-                new_job_id,
-                "voice",
-                queue_id,
-                priority=1,
-                role_label=conversation_state["current_role"],
-            )
-            request.app.state.job_id_to_call_id[new_job_id] = call_id
-            print_debug("Job ID to call ID mapping:", request.app.state.job_id_to_call_id)
-            if conversation_state.get("job_offer_task"):
-                conversation_state["job_offer_task"].cancel()
-            if TRIGGER_MODE == "polling":
-                conversation_state["job_offer_task"] = asyncio.create_task(
-                    handle_job_offers(submitted_job_id, call_id, conversation_state)
-                )
-            await update_conversation(call_id, conversation_state)
-        elif event.type == "Microsoft.Communication.RouterJobQueued":
-            print_debug("Job queued")
-        elif event.type == "Microsoft.Communication.RouterJobOffered":
-            print_debug("Job offered")
-            if TRIGGER_MODE == "event":
-                handle_job_offer_event(event, call_id, conversation_state)
-        elif event.type == "Microsoft.Communication.RouterWorkerOfferAccepted":
-            print_debug("Worker offer accepted")
-        elif event.type == "Microsoft.Communication.MediaStreamingStarted":
-            print_debug("Media streaming started")
-        elif event.type == "Microsoft.Communication.CallDisconnected":
-            print_debug("Call disconnected")
-            await handle_hangup(call_connection_id)
+        trace_recorder.record(call_id, "webhook", event=event_dict)
+        # 再配信されたイベントは処理しない
+        event_id = event_dict.get("id")
+        if await processed_event_cache.check_and_mark(call_id, event_id):
+            print_debug(f"Skipping duplicate callback event {event_id} for call_id {call_id}")
+            continue
+        try:
+            await dispatch_callback_event(call_id, event_dict, request)
+        except Exception:
+            await processed_event_cache.forget(call_id, event_id)
+            raise
     return Response(status_code=200)
 
+# event type -> 非同期ハンドラ
+callback_handlers = {}
+# event type -> [件数, 合計処理時間 (秒), 最大処理時間 (秒)]
+callback_latency_stats = {}
+
+def callback_latency_metrics_lines():
+    """
+    イベント種別ごとの処理件数と処理時間を Prometheus テキスト形式で返します。
+    """
+    for event_type, (count, total, maximum) in callback_latency_stats.items():
+        labels = f'{{event_type="{event_type}"}}'
+        yield f"callcenter_callback_handled_total{labels} {count}"
+        yield f"callcenter_callback_handling_seconds_sum{labels} {total}"
+        yield f"callcenter_callback_handling_seconds_max{labels} {maximum}"
+
+def on_callback(event_type: str):
+    """
+    コールバックイベントのハンドラを登録するデコレーター。
+    """
+    def decorator(handler):
+        callback_handlers[event_type] = handler
+        callback_latency_stats[event_type] = [0, 0.0, 0.0]
+        return handler
+    return decorator
+
+async def dispatch_callback_event(call_id: str, event_dict: dict, request: Request):
+    """
+    コールバックイベント 1 件を登録済みハンドラに振り分けます。未登録のイベントは何もせず読み捨てます。
+    """
+    event_type = event_dict.get("type")
+    handler = callback_handlers.get(event_type)
+    if handler is None:
+        return
+    print_debug("Callback event:", event_dict, log_level="debug")
+    started_at = time.perf_counter()
+    role = "dtmf" if "Dtmf" in event_type else "callback"
+    try:
+        with loop_monitor.tagged(call_id, role):
+            await handler(call_id, event_dict, request.app)
+    finally:
+        elapsed = time.perf_counter() - started_at
+        stats = callback_latency_stats[event_type]
+        stats[0] += 1
+        stats[1] += elapsed
+        if elapsed > stats[2]:
+            stats[2] = elapsed
+
+def get_call_connection(conversation_state: dict, call_connection_id: str):
+    """
+    通話ごとの CallConnectionClient を必要になった時点で生成し、会話状態にキャッシュします。
+    """
+    if conversation_state is None:
+        return clients.acs_client.get_call_connection(call_connection_id)
+    call_connection = conversation_state.get("call_connection")
+    if call_connection is None:
+        call_connection = clients.acs_client.get_call_connection(call_connection_id)
+        conversation_state["call_connection"] = call_connection
+    return call_connection
+
+@on_callback("Microsoft.Communication.CallConnected")
+async def on_call_connected(call_id: str, event: dict, app):
+    print_debug("Call connected")
+    conversation_state = app.state.conversation_states.get(call_id)
+    if conversation_state is not None and conversation_state.get("busy"):
+        # 受付制御で断った通話は、話中案内を流して再生後に切断する
+        await get_call_connection(conversation_state, event["data"]["callConnectionId"]).play_media_to_all(
+            FileSource(url=admission_controller.busy_audio_url),
+            operation_context="busy",
+        )
+        return
+    if conversation_state is not None:
+        conversation_state["connected_at"] = time.monotonic()
+    await start_dtmf_recognition(event["data"]["callConnectionId"], call_id, conversation_state)
+
+@on_callback("Microsoft.Communication.ContinuousDtmfRecognitionToneReceived")
+async def on_dtmf_tone_received(call_id: str, event: dict, app):
+    conversation_state = app.state.conversation_states.get(call_id)
+    tone = event["data"]["tone"]
+    if conversation_state is None:
+        print_debug(f"No conversation state for DTMF tone: {tone}")
+        return
+    conversation_state["role_switch_requested_at"] = time.monotonic()
+    # 入力が確定してから切り替える (続けて押された数字や重複したトーンで切り替えを重ねない)
+    dtmf_collectors.add(
+        call_id,
+        tone,
+        lambda profile: switch_role(app, call_id, conversation_state, profile),
+        lambda: conversation_state.get("current_role")
+    )
+
+async def switch_role(app, call_id: str, conversation_state: dict, profile):
+    """
+    確定した DTMF の選択に従ってロールを切り替えます。
+    新しいロールの会話をすぐに始め、旧ジョブの完了と新しいジョブの投入はその裏で並行して進めます。
+    いずれかの段階が失敗したら、切り替え前のロールとジョブに戻します。
+    """
+    # このアプリは人への転送を行わないため、transfer_to_human のロールも AI が応対する
+    print_debug(f"Switching role to {profile.name}")
+    switch = {
+        "previous_role": conversation_state.get("current_role"),
+        "previous_job_id": conversation_state.pop("job_id", None),
+        "previous_assignment_id": conversation_state.pop("assignment_id", None),
+        "new_job_id": None,
+        "committed": False,
+    }
+    switch["previous_job_finished"] = switch["previous_job_id"] is None
+    # 旧ジョブのオファー待ちは止める (旧ジョブは完了またはキャンセルする)
+    if conversation_state.get("job_offer_task"):
+        conversation_state["job_offer_task"].cancel()
+    conversation_state["current_role"] = profile.name
+    routing = loop_monitor.spawn(route_role_switch(app, call_id, conversation_state, switch), call_id, "role-routing")
+    try:
+        # 発信者に聞こえるまでの時間は GPT クライアントの再接続だけで決まる
+        if not await update_conversation(call_id, conversation_state):
+            raise RuntimeError(f"Failed to start the conversation for {profile.name}")
+        await routing
+    except asyncio.CancelledError:
+        # 新しい選択に置き換えられた。後続の切り替えが引き継げるよう、同期的に状態を戻してから抜ける
+        hand_over_role_switch(call_id, conversation_state, switch, routing)
+        raise
+    except Exception as e:
+        print_debug(f"Role switch to {profile.name} failed, rolling back to {switch['previous_role']}: {e}", log_level="error")
+        await rollback_role_switch(app, call_id, conversation_state, switch, routing)
+        ROLE_SWITCHES_ROLLED_BACK.inc()
+        return
+    ROLE_SWITCHES_COMPLETED.inc()
+
+async def route_role_switch(app, call_id: str, conversation_state: dict, switch: dict):
+    """
+    旧ジョブの完了と新しいジョブの投入を並行して行い、投入が済んだら会話状態に反映します。
+    """
+    started_at = time.monotonic()
+
+    async def finish_previous_job():
+        previous_job_id = switch["previous_job_id"]
+        if previous_job_id:
+            await close_outstanding_job(previous_job_id, switch["previous_assignment_id"])
+            app.state.job_id_to_call_id.pop(previous_job_id, None)
+            print_debug(f"Completed previous job {previous_job_id}.")
+        switch["previous_job_finished"] = True
+
+    async def submit_new_job():
+        new_job_id = str(uuid.uuid4())
+        switch["new_job_id"] = new_job_id
+        switch["job_submitted_at"] = time.monotonic()
+        await submit_job_to_queue(
+            new_job_id,
+            "voice",
+            app.state.queues["queue-1"]["id"],
+            priority=1,
+            role_label=conversation_state["current_role"],
+        )
+
+    await asyncio.gather(finish_previous_job(), submit_new_job())
+    new_job_id = switch["new_job_id"]
+    conversation_state["job_id"] = new_job_id
+    conversation_state["job_submitted_at"] = switch["job_submitted_at"]
+    app.state.job_id_to_call_id[new_job_id] = call_id
+    switch["committed"] = True
+    if TRIGGER_MODE == "polling":
+        conversation_state["job_offer_task"] = loop_monitor.spawn(
+            handle_job_offers(new_job_id, call_id, conversation_state), call_id, "offer-wait"
+        )
+    ROLE_SWITCH_ROUTING_SECONDS.observe_since(started_at)
+
+def hand_over_role_switch(call_id: str, conversation_state: dict, switch: dict, routing: asyncio.Task):
+    """
+    後続の切り替えに置き換えられた時に、終了していない旧ジョブを会話状態に戻し、投入途中の新しいジョブを片付けます。
+    """
+    routing.cancel()
+    if switch["committed"]:
+        # 投入済みのジョブは後続の切り替えが旧ジョブとして完了する
+        return
+    if not switch["previous_job_finished"]:
+        conversation_state["job_id"] = switch["previous_job_id"]
+        if switch["previous_assignment_id"]:
+            conversation_state["assignment_id"] = switch["previous_assignment_id"]
+    if switch["new_job_id"]:
+        loop_monitor.spawn(close_abandoned_job(switch["new_job_id"]), call_id, "role-routing", cleanup=True)
+
+async def rollback_role_switch(app, call_id: str, conversation_state: dict, switch: dict, routing: asyncio.Task):
+    """
+    失敗した切り替えを取り消し、切り替え前のロールで会話を始め直します。
+    """
+    if not routing.done():
+        routing.cancel()
+        await asyncio.gather(routing, return_exceptions=True)
+    conversation_state["current_role"] = switch["previous_role"]
+    if not switch["committed"]:
+        if switch["new_job_id"]:
+            await close_abandoned_job(switch["new_job_id"])
+        if not switch["previous_job_finished"]:
+            previous_job_id = switch["previous_job_id"]
+            conversation_state["job_id"] = previous_job_id
+            if switch["previous_assignment_id"]:
+                conversation_state["assignment_id"] = switch["previous_assignment_id"]
+            elif TRIGGER_MODE == "polling":
+                conversation_state["job_offer_task"] = loop_monitor.spawn(
+                    handle_job_offers(previous_job_id, call_id, conversation_state), call_id, "offer-wait"
+                )
+    await update_conversation(call_id, conversation_state)
+
+async def close_abandoned_job(job_id: str):
+    """
+    取り消した切り替えで投入したジョブをキャンセルして削除します。
+    """
+    try:
+        await close_outstanding_job(job_id)
+    except Exception as e:
+        print_debug(f"Failed to close job {job_id} of a cancelled role switch: {e}", log_level="error")
+
+@on_callback("Microsoft.Communication.RouterJobQueued")
+async def on_router_job_queued(call_id: str, event: dict, app):
+    print_debug("Job queued")
+
+@on_callback("Microsoft.Communication.RouterJobOffered")
+async def on_router_job_offered(call_id: str, event: dict, app):
+    print_debug("Job offered")
+    if TRIGGER_MODE == "event":
+        conversation_state = app.state.conversation_states.get(call_id)
+        await handle_job_offer_event(event, conversation_state)
+
+@on_callback("Microsoft.Communication.RouterWorkerOfferAccepted")
+async def on_router_worker_offer_accepted(call_id: str, event: dict, app):
+    print_debug("Worker offer accepted")
+
+@on_callback("Microsoft.Communication.MediaStreamingStarted")
+async def on_media_streaming_started(call_id: str, event: dict, app):
+    print_debug("Media streaming started")
+
+@on_callback("Microsoft.Communication.PlayCompleted")
+async def on_play_completed(call_id: str, event: dict, app):
+    await hangup_busy_call(call_id, event, app)
+
+@on_callback("Microsoft.Communication.PlayFailed")
+async def on_play_failed(call_id: str, event: dict, app):
+    print_debug("Play failed:", event["data"].get("resultInformation"), log_level="warning")
+    await hangup_busy_call(call_id, event, app)
+
+async def hangup_busy_call(call_id: str, event: dict, app):
+    conversation_state = app.state.conversation_states.get(call_id)
+    if conversation_state is not None and conversation_state.get("busy"):
+        await handle_hangup(event["data"]["callConnectionId"], conversation_state)
+
+@on_callback("Microsoft.Communication.CallDisconnected")
+async def on_call_disconnected(call_id: str, event: dict, app):
+    print_debug("Call disconnected")
+    conversation_state = app.state.conversation_states.get(call_id)
+    await handle_hangup(event["data"]["callConnectionId"], conversation_state)
+    dtmf_collectors.discard(call_id)
+    # 通話のために spawn したタスク (オファー待ち、realtime の受信など) をまとめて止める
+    await loop_monitor.cancel_call(call_id)
+    # 止めたロール切り替えが戻したジョブも含めて片付けてから、通話の状態を外す (ドレインで数えないように)
+    conversation_state = app.state.conversation_states.pop(call_id, None)
+    if conversation_state is not None:
+        await release_call_state(app, call_id, conversation_state)
+    trace_recorder.call_disconnected(call_id)
+
+async def release_call_state(app, call_id: str, conversation_state: dict):
+    """
+    切断された通話の GPT クライアントを閉じ、未完了のジョブを片付けます。
+    """
+    gpt_client = conversation_state.pop("gpt_client", None)
+    if gpt_client is not None:
+        await close_gpt_client_quietly(gpt_client)
+    job_id = conversation_state.pop("job_id", None)
+    if job_id:
+        try:
+            await close_outstanding_job(job_id, conversation_state.pop("assignment_id", None))
+        except Exception as e:
+            print_debug(f"Error releasing job {job_id} for call_id {call_id}: {e}", log_level="error")
+        app.state.job_id_to_call_id.pop(job_id, None)
+
 async def start_dtmf_recognition(call_connection_id: str, call_id: str, conversation_state: dict):
     print_debug(f"Starting DTMF recognition for call_id {call_id}")
     if not conversation_state:
@@ -204,7 +632,7 @@ async def start_dtmf_recognition(call_connection_id: str, call_id: str, conversa
         print_debug(f"DTMF recognition already in progress for call_id {call_id}")
         return
     conversation_state["dtmf_recognition_in_progress"] = True
-    call_connection = acs_client.get_call_connection(call_connection_id)
+    call_connection = get_call_connection(conversation_state, call_connection_id)
     target_participant = conversation_state["caller_communication_identifier"]
     operation_context = f"dtmf_{call_id}_{uuid.uuid4()}"
     try:
@@ -217,8 +645,28 @@ async def start_dtmf_recognition(call_connection_id: str, call_id: str, conversa
         print_debug(f"Error starting DTMF recognition for call_id {call_id}: {e}")
         conversation_state["dtmf_recognition_in_progress"] = False
 
-async def handle_hangup(call_connection_id: str):
+async def release_stalled_call(app, call_id: str, reason: str):
+    """
+    ウォッチドッグが切断する通話の ACS 通話を切り、CallDisconnected を待たずにジョブを終了してワーカーの容量を戻します。
+    """
+    trace_recorder.record(call_id, "watchdog_release", reason=reason)
+    conversation_state = app.state.conversation_states.get(call_id)
+    if conversation_state is None:
+        return
+    # CallConnected で生成した CallConnectionClient を使う (call_id は ACS の接続 ID ではない)
+    call_connection = conversation_state.get("call_connection")
+    if call_connection is not None:
+        try:
+            await call_connection.hang_up(is_for_everyone=True)
+        except Exception as e:
+            print_debug(f"Error during hangup for call_id {call_id}: {e}", log_level="error")
+    job_id = conversation_state.pop("job_id", None)
+    if job_id:
+        await close_outstanding_job(job_id, conversation_state.pop("assignment_id", None), disposition_code="Stalled")
+        app.state.job_id_to_call_id.pop(job_id, None)
+
+async def handle_hangup(call_connection_id: str, conversation_state: dict = None):
     try:
-        await acs_client.get_call_connection(call_connection_id).hang_up(is_for_everyone=True)
+        await get_call_connection(conversation_state, call_connection_id).hang_up(is_for_everyone=True)
     except Exception as e:
         print_debug(f"Error during hangup for connection {call_connection_id}: {e}")
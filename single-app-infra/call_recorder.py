@@ -0,0 +1,252 @@
+import base64
+import gzip
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional, Tuple
+from config import (
+    RECORDING_ENABLED,
+    RECORDING_DIRECTORY,
+    RECORDING_WRITER_THREADS,
+    RECORDING_BUFFER_SECONDS,
+    RECORDING_DRAIN_INTERVAL_SECONDS,
+)
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 通話の受信音声 (発信者) と送信音声 (AI) を、左右チャンネルに分けた gzip 圧縮の WAV に録音する。
+# 中継ループでは Base64 のまま通話ごとのバッファに積むだけにし、デコード・整列・圧縮・書き込みは
+# 書き込みスレッドで行う。ディスクが遅くバッファがあふれた場合は、中継を待たせずにフレームを捨てて数える。
+SAMPLE_RATE = 24000
+SAMPLE_WIDTH = 2
+CHANNELS = 2
+INBOUND = 0
+OUTBOUND = 1
+# 遅れて届くフレームを待つ時間。これより古い区間は無音で埋めて書き出す
+ALIGN_LAG_SECONDS = 1.0
+
+def wav_header() -> bytes:
+    # 書き込み中はデータ長が分からないため、ストリーミング用の最大長を入れておく
+    byte_rate = SAMPLE_RATE * SAMPLE_WIDTH * CHANNELS
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 0xFFFFFFFF, b"WAVE",
+        b"fmt ", 16, 1, CHANNELS, SAMPLE_RATE, byte_rate, SAMPLE_WIDTH * CHANNELS, SAMPLE_WIDTH * 8,
+        b"data", 0xFFFFFFFF
+    )
+
+
+class CallRecording:
+    def __init__(self, call_id: str, path: str) -> None:
+        self.call_id = call_id
+        self.path = path
+        self.started_at = time.monotonic()
+        # 中継ループから積まれる (通話開始からの秒数, チャンネル, Base64 音声)
+        self.frames: Deque[Tuple[float, int, str]] = deque()
+        self.buffered_bytes = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        self.dropped_frames = 0
+        # 以降は書き込みスレッドだけが使う
+        self.file: Optional[gzip.GzipFile] = None
+        self.pending = [bytearray(), bytearray()]
+        self.written_samples = 0
+
+    def take_frames(self) -> Deque[Tuple[float, int, str]]:
+        with self.lock:
+            frames = self.frames
+            self.frames = deque()
+            self.buffered_bytes = 0
+        return frames
+
+    def channel_end(self, channel: int) -> int:
+        return self.written_samples + len(self.pending[channel]) // SAMPLE_WIDTH
+
+    def place(self, offset: float, channel: int, pcm: bytes) -> None:
+        # 到着時刻の位置に置く。AI の音声は再生より速く届くため、前のフレームと重なる場合は続けて置く
+        position = int(offset * SAMPLE_RATE)
+        end = self.channel_end(channel)
+        if position > end:
+            self.pending[channel].extend(bytes((position - end) * SAMPLE_WIDTH))
+        self.pending[channel].extend(pcm)
+
+    def pad_to(self, position: int) -> None:
+        for channel in (INBOUND, OUTBOUND):
+            end = self.channel_end(channel)
+            if position > end:
+                self.pending[channel].extend(bytes((position - end) * SAMPLE_WIDTH))
+
+    def interleaved(self) -> bytes:
+        # 両チャンネルがそろった区間だけをステレオにして取り出す
+        samples = min(len(self.pending[INBOUND]), len(self.pending[OUTBOUND])) // SAMPLE_WIDTH
+        if samples == 0:
+            return b""
+        size = samples * SAMPLE_WIDTH
+        left = array("h", bytes(self.pending[INBOUND][:size]))
+        right = array("h", bytes(self.pending[OUTBOUND][:size]))
+        stereo = array("h", bytes(size * CHANNELS))
+        stereo[0::2] = left
+        stereo[1::2] = right
+        del self.pending[INBOUND][:size]
+        del self.pending[OUTBOUND][:size]
+        self.written_samples += samples
+        if sys.byteorder != "little":
+            stereo.byteswap()
+        return stereo.tobytes()
+
+
+class CallRecorder:
+    def __init__(
+        self,
+        directory: str,
+        enabled: bool = False,
+        writer_threads: int = 2,
+        buffer_seconds: float = 10.0,
+        drain_interval: float = 0.5
+    ) -> None:
+        self._directory = directory
+        self.enabled = enabled
+        self._writer_count = max(1, writer_threads)
+        # Base64 の文字数で数える (両チャンネル分)
+        self._max_buffer_bytes = int(buffer_seconds * SAMPLE_RATE * SAMPLE_WIDTH * CHANNELS * 4 / 3)
+        self._drain_interval = drain_interval
+        self._recordings: Dict[str, CallRecording] = {}
+        # 書き込みスレッドごとの担当通話。1 通話は常に同じスレッドが書く
+        self._assignments: List[List[CallRecording]] = [[] for _ in range(self._writer_count)]
+        self._assignments_lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._stopped = threading.Event()
+        self.recordings_started = 0
+        self.recordings_finished = 0
+        self.dropped_frames = 0
+        self.write_errors = 0
+        self.bytes_written = 0
+
+    def start(self) -> None:
+        if not self.enabled or self._threads:
+            return
+        os.makedirs(self._directory, exist_ok = True)
+        self._stopped.clear()
+        for index in range(self._writer_count):
+            thread = threading.Thread(target = self._write_loop, args = (index,), name = f"call-recorder-{index}", daemon = True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        if not self._threads:
+            return
+        for call_id in list(self._recordings):
+            self.end(call_id)
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def begin(self, call_id: str) -> bool:
+        if not self._threads or call_id in self._recordings:
+            return False
+        started = datetime.now(timezone.utc)
+        filename = f"{started.strftime('%Y%m%dT%H%M%S')}_{call_id}.wav.gz"
+        recording = CallRecording(call_id, os.path.join(self._directory, filename))
+        self._recordings[call_id] = recording
+        with self._assignments_lock:
+            min(self._assignments, key = len).append(recording)
+        self.recordings_started += 1
+        return True
+
+    def tap(self, call_id: Optional[str], channel: int, audio_base64: str) -> None:
+        # 音声の中継経路から呼ばれるため、録音しない通話ではすぐに戻り、録音中もバッファに積むだけにする
+        recording = self._recordings.get(call_id) if self._recordings else None
+        if recording is None:
+            return
+        size = len(audio_base64)
+        offset = time.monotonic() - recording.started_at
+        with recording.lock:
+            if recording.buffered_bytes + size > self._max_buffer_bytes:
+                recording.dropped_frames += 1
+                self.dropped_frames += 1
+                return
+            recording.frames.append((offset, channel, audio_base64))
+            recording.buffered_bytes += size
+
+    def end(self, call_id: str) -> None:
+        recording = self._recordings.pop(call_id, None)
+        if recording is None:
+            return
+        # 残りのフレームは書き込みスレッドが書き出してからファイルを閉じる
+        recording.closed = True
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": len(self._recordings),
+            "started": self.recordings_started,
+            "finished": self.recordings_finished,
+            "dropped_frames": self.dropped_frames,
+            "write_errors": self.write_errors,
+            "bytes_written": self.bytes_written,
+        }
+
+    def _write_loop(self, index: int) -> None:
+        assigned = self._assignments[index]
+        while True:
+            stopping = self._stopped.wait(self._drain_interval)
+            with self._assignments_lock:
+                recordings = list(assigned)
+            for recording in recordings:
+                finished = self._drain(recording, final = recording.closed or stopping)
+                if finished:
+                    with self._assignments_lock:
+                        assigned.remove(recording)
+            if stopping:
+                break
+
+    def _drain(self, recording: CallRecording, final: bool) -> bool:
+        try:
+            if recording.file is None:
+                recording.file = gzip.open(recording.path, "wb", compresslevel = 1)
+                recording.file.write(wav_header())
+            for offset, channel, audio_base64 in recording.take_frames():
+                recording.place(offset, channel, base64.b64decode(audio_base64))
+            if final:
+                # 長い方のチャンネルに合わせて無音で埋め、残りをすべて書き出す
+                recording.pad_to(max(recording.channel_end(INBOUND), recording.channel_end(OUTBOUND)))
+            else:
+                recording.pad_to(int((time.monotonic() - recording.started_at - ALIGN_LAG_SECONDS) * SAMPLE_RATE))
+            data = recording.interleaved()
+            if data:
+                recording.file.write(data)
+                self.bytes_written += len(data)
+        except (OSError, ValueError) as e:
+            self.write_errors += 1
+            logger.error(f"Failed to write the recording for call_id {recording.call_id}: {e}")
+            final = True
+        if final:
+            self._close(recording)
+        return final
+
+    def _close(self, recording: CallRecording) -> None:
+        if recording.file is not None:
+            try:
+                recording.file.close()
+            except OSError as e:
+                self.write_errors += 1
+                logger.error(f"Failed to close the recording for call_id {recording.call_id}: {e}")
+            recording.file = None
+        self.recordings_finished += 1
+        if recording.dropped_frames:
+            logger.warning(f"Recording for call_id {recording.call_id} dropped {recording.dropped_frames} frames")
+
+
+call_recorder = CallRecorder(
+    directory = RECORDING_DIRECTORY,
+    enabled = RECORDING_ENABLED,
+    writer_threads = RECORDING_WRITER_THREADS,
+    buffer_seconds = RECORDING_BUFFER_SECONDS,
+    drain_interval = RECORDING_DRAIN_INTERVAL_SECONDS
+)
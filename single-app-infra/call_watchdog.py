@@ -0,0 +1,194 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional
+from config import MEDIA_IDLE_TIMEOUT_SECONDS, REALTIME_STALL_TIMEOUT_SECONDS, REALTIME_PING_INTERVAL_SECONDS, WATCHDOG_INTERVAL_SECONDS
+from logger import get_logger
+from loop_monitor import loop_monitor
+
+logger = get_logger(__name__)
+
+# 通話ごとのウォッチドッグ。中継ループは受信を待ち続けるため、ACS の WebSocket が黙って切れたり
+# realtime の応答が途中で止まったりしても気付けない。各方向の最終受信時刻を定期的に確認し、
+# ACS からの音声が途絶えた通話は切断して片付け、realtime の応答が止まった通話は realtime だけを接続し直す
+REASON_MEDIA_IDLE = "media_idle"
+REASON_REALTIME_STALL = "realtime_stall"
+REASON_PING_FAILED = "ping_failed"
+
+class CallActivity:
+    # 中継ループが属性を直接更新する (音声フレームごとに呼ばれるため関数呼び出しを挟まない)
+    __slots__ = (
+        "call_id", "inbound_at", "outbound_at", "realtime_at", "response_started_at",
+        "pinged_at", "close", "recover", "ping", "closing"
+    )
+
+    def __init__(
+        self,
+        call_id: str,
+        close: Callable[[], None],
+        recover: Optional[Callable[[], Awaitable[None]]],
+        ping: Optional[Callable[[], Awaitable[None]]]
+    ) -> None:
+        now = time.monotonic()
+        self.call_id = call_id
+        # ACS からの受信、ACS への送信、realtime からの受信
+        self.inbound_at = now
+        self.outbound_at = now
+        self.realtime_at = now
+        # 応答の生成中 (response.create から response.done まで) なら開始時刻
+        self.response_started_at: Optional[float] = None
+        self.pinged_at = now
+        self.close = close
+        self.recover = recover
+        self.ping = ping
+        self.closing = False
+
+
+class CallWatchdog:
+    def __init__(
+        self,
+        idle_timeout: float,
+        stall_timeout: float,
+        ping_interval: float,
+        check_interval: float = 1.0
+    ) -> None:
+        # 0 はそれぞれの確認を無効にする
+        self._idle_timeout = idle_timeout
+        self._stall_timeout = stall_timeout
+        self._ping_interval = ping_interval
+        self._check_interval = check_interval
+        self._activities: Dict[str, CallActivity] = {}
+        self._release: Optional[Callable[[str, str], Awaitable[None]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self.media_idle_teardowns = 0
+        self.realtime_stall_recoveries = 0
+        self.pings = 0
+        self.ping_failures = 0
+        self.release_errors = 0
+
+    def configure(self, release: Callable[[str, str], Awaitable[None]]) -> None:
+        # release は切断する通話 (call_id, 理由) の ACS 通話とジョブを片付ける処理
+        self._release = release
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = loop_monitor.spawn(self._check_loop(), None, "watchdog")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def watch(
+        self,
+        call_id: str,
+        close: Callable[[], None],
+        recover: Optional[Callable[[], Awaitable[None]]] = None,
+        ping: Optional[Callable[[], Awaitable[None]]] = None
+    ) -> CallActivity:
+        # close は中継を止める処理、recover は realtime を接続し直す処理、ping は realtime への ping
+        activity = CallActivity(call_id, close, recover, ping)
+        self._activities[call_id] = activity
+        return activity
+
+    def get(self, call_id: Optional[str]) -> Optional[CallActivity]:
+        return self._activities.get(call_id)
+
+    def unwatch(self, call_id: str, activity: Optional[CallActivity] = None) -> None:
+        # 同じ call_id で張り直された後の古い中継からは外さない
+        if activity is None or self._activities.get(call_id) is activity:
+            self._activities.pop(call_id, None)
+
+    async def _check_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._check_interval)
+            self.check(time.monotonic())
+
+    def check(self, now: float) -> None:
+        for activity in list(self._activities.values()):
+            if activity.closing:
+                continue
+            if self._idle_timeout and now - activity.inbound_at > self._idle_timeout:
+                self._tear_down(activity, REASON_MEDIA_IDLE, now - activity.inbound_at)
+                continue
+            if (
+                self._stall_timeout
+                and activity.recover is not None
+                and activity.response_started_at is not None
+                and now - activity.response_started_at > self._stall_timeout
+                and now - activity.realtime_at > self._stall_timeout
+            ):
+                self._recover(activity, REASON_REALTIME_STALL, now)
+                continue
+            if self._ping_interval and activity.ping is not None and now - activity.pinged_at >= self._ping_interval:
+                activity.pinged_at = now
+                loop_monitor.spawn(self._ping(activity), activity.call_id, "watchdog")
+
+    def _tear_down(self, activity: CallActivity, reason: str, idle_seconds: float) -> None:
+        activity.closing = True
+        self.media_idle_teardowns += 1
+        logger.warning(
+            f"No media from ACS for {idle_seconds:.1f}s, tearing down call_id {activity.call_id}",
+            category = "watchdog.teardown"
+        )
+        loop_monitor.spawn(self._release_and_close(activity, reason), activity.call_id, "watchdog", cleanup = True)
+
+    async def _release_and_close(self, activity: CallActivity, reason: str) -> None:
+        # 会話状態が残っているうちに通話とジョブを片付けてから、中継を止める
+        try:
+            if self._release is not None:
+                await asyncio.wait_for(self._release(activity.call_id, reason), timeout = max(self._idle_timeout, 5.0))
+        except Exception as e:
+            self.release_errors += 1
+            logger.error(f"Failed to release call_id {activity.call_id} after {reason}: {e}")
+        finally:
+            activity.close()
+            self.unwatch(activity.call_id, activity)
+
+    def _recover(self, activity: CallActivity, reason: str, now: float) -> None:
+        # 再接続が済むまで同じ通話で重ねて検知しないよう、時刻を進めておく
+        activity.response_started_at = None
+        activity.realtime_at = now
+        self.realtime_stall_recoveries += 1
+        logger.warning(f"Realtime stream stalled ({reason}), reconnecting call_id {activity.call_id}", category = "watchdog.recover")
+        loop_monitor.spawn(self._run_recover(activity), activity.call_id, "watchdog")
+
+    async def _run_recover(self, activity: CallActivity) -> None:
+        try:
+            await activity.recover()
+        except Exception as e:
+            logger.error(f"Failed to recover the realtime stream for call_id {activity.call_id}: {e}")
+
+    async def _ping(self, activity: CallActivity) -> None:
+        # 閉じた接続は送信が失敗するため ping で検知できる (応答が止まっただけの接続は response の停止で検知する)
+        self.pings += 1
+        try:
+            await asyncio.wait_for(activity.ping(), timeout = self._ping_interval)
+        except Exception as e:
+            self.ping_failures += 1
+            logger.warning(f"Realtime ping failed for call_id {activity.call_id}: {e}", category = "watchdog.ping")
+            if not activity.closing and activity.recover is not None:
+                self._recover(activity, REASON_PING_FAILED, time.monotonic())
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "idle_timeout_seconds": self._idle_timeout,
+            "stall_timeout_seconds": self._stall_timeout,
+            "watched_calls": len(self._activities),
+            "media_idle_teardowns": self.media_idle_teardowns,
+            "realtime_stall_recoveries": self.realtime_stall_recoveries,
+            "pings": self.pings,
+            "ping_failures": self.ping_failures,
+            "release_errors": self.release_errors,
+        }
+
+
+call_watchdog = CallWatchdog(
+    idle_timeout = MEDIA_IDLE_TIMEOUT_SECONDS,
+    stall_timeout = REALTIME_STALL_TIMEOUT_SECONDS,
+    ping_interval = REALTIME_PING_INTERVAL_SECONDS,
+    check_interval = WATCHDOG_INTERVAL_SECONDS
+)
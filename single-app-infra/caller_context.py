@@ -0,0 +1,155 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from config import (
+    CALLER_CONTEXT_CACHE_SIZE,
+    CALLER_CONTEXT_TTL_SECONDS,
+    CALLER_CONTEXT_NEGATIVE_TTL_SECONDS,
+    CALLER_CONTEXT_LOOKUP_TIMEOUT_SECONDS,
+    CALLER_CONTEXT_MAX_CHARS
+)
+from logger import get_logger
+from loop_monitor import loop_monitor
+
+logger = get_logger(__name__)
+
+# 発信者のプロファイル (過去の問い合わせなど) を着信の応答と並行して読み込み、ロールの指示に追記する。
+# 応答は読み込みを待たない。間に合わなかった通話は追記なしで始まり、以降のロール切り替えから反映される
+CallerLookup = Callable[[str], Awaitable[Optional[Dict[str, Any]]]]
+
+# プロファイルのうち指示に含めない項目 (Cosmos DB のシステムプロパティなど)
+IGNORED_FIELDS = {"id", "ttl", "caller_id"}
+
+def format_caller_context(profile: Optional[Dict[str, Any]], max_chars: int) -> Optional[str]:
+    # summary があればそのまま、なければ項目を 1 行ずつ並べる
+    if not profile:
+        return None
+    summary = profile.get("summary")
+    if isinstance(summary, str) and summary.strip():
+        text = summary.strip()
+    else:
+        lines = []
+        for key, value in profile.items():
+            if key in IGNORED_FIELDS or key.startswith("_") or value in (None, "", [], {}):
+                continue
+            if isinstance(value, list):
+                value = ", ".join(str(item) for item in value)
+            lines.append(f"- {key}: {value}")
+        text = "\n".join(lines)
+    if not text:
+        return None
+    return text[:max_chars]
+
+
+class CallerContextCache:
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        negative_ttl_seconds: float,
+        lookup_timeout: float,
+        max_chars: int
+    ) -> None:
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._negative_ttl_seconds = negative_ttl_seconds
+        self._lookup_timeout = lookup_timeout
+        self._max_chars = max_chars
+        self._lookup: Optional[CallerLookup] = None
+        # caller_id -> (有効期限 (monotonic), 指示に追記する文字列。プロファイルがなければ None)
+        self._entries: "OrderedDict[str, Tuple[float, Optional[str]]]" = OrderedDict()
+        # 読み込み中の caller_id。同じ発信者から続けて着信しても読み込みは 1 回にする
+        self._pending: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.lookups = 0
+        self.lookup_errors = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._lookup is not None
+
+    def configure(self, lookup: Optional[CallerLookup]) -> None:
+        # lookup は caller_id のプロファイルを返す (見つからなければ None)。None なら何もしない
+        self._lookup = lookup
+
+    def prefetch(self, caller_id: Optional[str]) -> None:
+        # 着信の応答前に呼び出す。キャッシュにあるか読み込み中なら DB は読まない
+        if not self.enabled or not caller_id:
+            return
+        entry = self._lookup_entry(caller_id, time.monotonic())
+        if entry is not None:
+            if entry[1] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return
+        if caller_id in self._pending:
+            return
+        self.misses += 1
+        self._pending[caller_id] = loop_monitor.spawn(self._load(caller_id), None, "caller-context")
+
+    def get(self, caller_id: Optional[str]) -> Optional[str]:
+        # realtime セッションの開始時に呼び出す。読み込みが済んでいなければ待たずに None を返す
+        if not self.enabled or not caller_id:
+            return None
+        entry = self._lookup_entry(caller_id, time.monotonic())
+        if entry is None:
+            return None
+        return entry[1]
+
+    async def _load(self, caller_id: str) -> None:
+        self.lookups += 1
+        try:
+            profile = await asyncio.wait_for(self._lookup(caller_id), timeout = self._lookup_timeout)
+        except Exception as e:
+            # 失敗はキャッシュせず、次の着信で読み直す
+            self.lookup_errors += 1
+            logger.warning(f"Failed to look up the caller profile: {e}", category = "caller_context.lookup_failed")
+            return
+        finally:
+            self._pending.pop(caller_id, None)
+        context = format_caller_context(profile, self._max_chars)
+        ttl = self._ttl_seconds if context is not None else self._negative_ttl_seconds
+        self._insert(caller_id, context, time.monotonic() + ttl)
+
+    def _lookup_entry(self, caller_id: str, now: float) -> Optional[Tuple[float, Optional[str]]]:
+        entry = self._entries.get(caller_id)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[caller_id]
+            return None
+        self._entries.move_to_end(caller_id)
+        return entry
+
+    def _insert(self, caller_id: str, context: Optional[str], expires_at: float) -> None:
+        self._entries[caller_id] = (expires_at, context)
+        self._entries.move_to_end(caller_id)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last = False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "pending": len(self._pending),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "lookups": self.lookups,
+            "lookup_errors": self.lookup_errors,
+            "evictions": self.evictions,
+        }
+
+
+caller_contexts = CallerContextCache(
+    max_entries = CALLER_CONTEXT_CACHE_SIZE,
+    ttl_seconds = CALLER_CONTEXT_TTL_SECONDS,
+    negative_ttl_seconds = CALLER_CONTEXT_NEGATIVE_TTL_SECONDS,
+    lookup_timeout = CALLER_CONTEXT_LOOKUP_TIMEOUT_SECONDS,
+    max_chars = CALLER_CONTEXT_MAX_CHARS
+)
@@ -1,11 +1,52 @@
-from azure.communication.callautomation.aio import CallAutomationClient as AsyncCallAutomationClient
-from azure.communication.jobrouter.aio import JobRouterClient as AsyncJobRouterClient
-from azure.communication.jobrouter.aio import JobRouterAdministrationClient as AsyncJobRouterAdministrationClient
-from config import ACS_CONNECTION_STRING
+from config import ACS_CONNECTION_STRING, COSMOS_CONNECTION_STRING, COSMOS_DATABASE_NAME, COSMOS_CALLER_PROFILE_CONTAINER_NAME
 
-# Initialize ACS Call Automation client
-acs_client = AsyncCallAutomationClient.from_connection_string(ACS_CONNECTION_STRING)
+# SDK クライアントは import 時ではなく lifespan で生成する (init_clients)。
+# 呼び出し側は `import clients` として clients.acs_client のように参照すること
+acs_client = None
+router_admin_client = None
+router_client = None
+cosmos_client = None
+caller_profile_container = None
 
-# Initialize Job Router clients
-router_admin_client = AsyncJobRouterAdministrationClient.from_connection_string(ACS_CONNECTION_STRING)
-router_client = AsyncJobRouterClient.from_connection_string(ACS_CONNECTION_STRING)
+def init_clients():
+    """
+    Call Automation / Job Router の SDK を読み込み、クライアントを生成します。lifespan の最初に呼び出します。
+    """
+    global acs_client, router_admin_client, router_client, cosmos_client, caller_profile_container
+    from azure.communication.callautomation.aio import CallAutomationClient as AsyncCallAutomationClient
+    from azure.communication.jobrouter.aio import JobRouterClient as AsyncJobRouterClient
+    from azure.communication.jobrouter.aio import JobRouterAdministrationClient as AsyncJobRouterAdministrationClient
+
+    # Initialize ACS Call Automation client
+    acs_client = AsyncCallAutomationClient.from_connection_string(ACS_CONNECTION_STRING)
+
+    # Initialize Job Router clients
+    router_admin_client = AsyncJobRouterAdministrationClient.from_connection_string(ACS_CONNECTION_STRING)
+    router_client = AsyncJobRouterClient.from_connection_string(ACS_CONNECTION_STRING)
+
+    # Cosmos DB is optional (only for caller profiles)
+    if COSMOS_CONNECTION_STRING and COSMOS_CALLER_PROFILE_CONTAINER_NAME:
+        from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+        cosmos_client = AsyncCosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
+        caller_profile_container = (
+            cosmos_client.get_database_client(COSMOS_DATABASE_NAME)
+            .get_container_client(COSMOS_CALLER_PROFILE_CONTAINER_NAME)
+        )
+
+async def close_clients():
+    """
+    生成済みのクライアントを閉じます。
+    """
+    for client in (acs_client, router_admin_client, router_client, cosmos_client):
+        if client is not None:
+            await client.close()
+
+async def read_caller_profile(caller_id: str):
+    """
+    発信者のプロファイルを Cosmos DB から読み込みます (見つからなければ None)。
+    """
+    from azure.cosmos.exceptions import CosmosResourceNotFoundError
+    try:
+        return await caller_profile_container.read_item(item=caller_id, partition_key=caller_id)
+    except CosmosResourceNotFoundError:
+        return None
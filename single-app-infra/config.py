@@ -8,11 +8,116 @@ load_dotenv()
 ACS_CONNECTION_STRING = os.getenv("ACS_CONNECTION_STRING")
 CALLBACK_URI_HOST = os.getenv("CALLBACK_URI_HOST")
 CALLBACK_EVENTS_URI = f"{CALLBACK_URI_HOST}/api/callbacks"
+# Maximum number of incoming calls answered concurrently
+INCOMING_CALL_CONCURRENCY = int(os.getenv("INCOMING_CALL_CONCURRENCY", "8"))
+# Duplicate callback suppression (Event Grid / ACS deliver at least once)
+PROCESSED_EVENT_CACHE_SIZE = int(os.getenv("PROCESSED_EVENT_CACHE_SIZE", "10000"))
+PROCESSED_EVENT_TTL_SECONDS = int(os.getenv("PROCESSED_EVENT_TTL_SECONDS", "600"))
+
+# Caller profiles prefetched while answering and appended to the role instructions
+# (Cosmos DB container with partition key /id and the caller ID as id; disabled when unset)
+COSMOS_CONNECTION_STRING = os.getenv("COSMOS_CONNECTION_STRING", "")
+COSMOS_DATABASE_NAME = os.getenv("COSMOS_DATABASE_NAME", "callcenter")
+COSMOS_CALLER_PROFILE_CONTAINER_NAME = os.getenv("COSMOS_CALLER_PROFILE_CONTAINER_NAME", "")
+# Unknown callers are cached too, for the negative TTL
+CALLER_CONTEXT_CACHE_SIZE = int(os.getenv("CALLER_CONTEXT_CACHE_SIZE", "10000"))
+CALLER_CONTEXT_TTL_SECONDS = float(os.getenv("CALLER_CONTEXT_TTL_SECONDS", "900"))
+CALLER_CONTEXT_NEGATIVE_TTL_SECONDS = float(os.getenv("CALLER_CONTEXT_NEGATIVE_TTL_SECONDS", "300"))
+CALLER_CONTEXT_LOOKUP_TIMEOUT_SECONDS = float(os.getenv("CALLER_CONTEXT_LOOKUP_TIMEOUT_SECONDS", "2.0"))
+CALLER_CONTEXT_MAX_CHARS = int(os.getenv("CALLER_CONTEXT_MAX_CHARS", "1000"))
 
 # Azure OpenAI service configuration
 AZURE_OPENAI_SERVICE_ENDPOINT = os.getenv("AZURE_OPENAI_SERVICE_ENDPOINT")
 AZURE_OPENAI_SERVICE_KEY = os.getenv("AZURE_OPENAI_SERVICE_KEY")
 AZURE_OPENAI_DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
 
+# Logging configuration
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_RATE_LIMIT_PER_SECOND = float(os.getenv("LOG_RATE_LIMIT_PER_SECOND", "5"))
+LOG_RATE_LIMIT_BURST = int(os.getenv("LOG_RATE_LIMIT_BURST", "10"))
+
+# Call trace recording configuration (opt-in, replayed by loadtest/replay.py)
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "false").lower() == "true"
+TRACE_DIRECTORY = os.getenv("TRACE_DIRECTORY", "traces")
+TRACE_REDACT_AUDIO = os.getenv("TRACE_REDACT_AUDIO", "true").lower() == "true"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_MAX_ACTIVE_CALLS = int(os.getenv("TRACE_MAX_ACTIVE_CALLS", "100"))
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "100000"))
+
+# Event loop monitoring configuration
+LOOP_MONITOR_INTERVAL_SECONDS = float(os.getenv("LOOP_MONITOR_INTERVAL_SECONDS", "0.1"))
+LOOP_STALL_THRESHOLD_SECONDS = float(os.getenv("LOOP_STALL_THRESHOLD_SECONDS", "0.25"))
+
+# Role profiles shared with the microservices app (instructions, voice, formats and tools per role)
+ROLE_PROFILES_PATH = os.getenv(
+    "ROLE_PROFILES_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "roles.json")
+)
+ROLE_PROFILES_CHECK_INTERVAL_SECONDS = float(os.getenv("ROLE_PROFILES_CHECK_INTERVAL_SECONDS", "2.0"))
+
+# Prompt audio cache (roles.json "prompt" lines synthesized once per voice and role, then played without a realtime session)
+PROMPT_AUDIO_ENABLED = os.getenv("PROMPT_AUDIO_ENABLED", "true").lower() == "true"
+PROMPT_AUDIO_DIRECTORY = os.getenv("PROMPT_AUDIO_DIRECTORY", "prompt_audio")
+# Length of each frame sent to ACS, and how far ahead of real time frames are sent
+PROMPT_AUDIO_CHUNK_SECONDS = float(os.getenv("PROMPT_AUDIO_CHUNK_SECONDS", "0.1"))
+PROMPT_AUDIO_LEAD_SECONDS = float(os.getenv("PROMPT_AUDIO_LEAD_SECONDS", "0.5"))
+PROMPT_AUDIO_SYNTHESIS_TIMEOUT_SECONDS = float(os.getenv("PROMPT_AUDIO_SYNTHESIS_TIMEOUT_SECONDS", "30.0"))
+
+# Lazy realtime sessions (while a cached prompt plays, connect only once an AI role is selected or speech is detected;
+# false connects right away alongside the prompt)
+REALTIME_LAZY_CONNECT = os.getenv("REALTIME_LAZY_CONNECT", "true").lower() == "true"
+# Speech level (RMS of 16-bit PCM) and duration, and how much audio before the detection is sent after connecting
+REALTIME_LAZY_SPEECH_THRESHOLD = float(os.getenv("REALTIME_LAZY_SPEECH_THRESHOLD", "1000"))
+REALTIME_LAZY_SPEECH_MIN_SECONDS = float(os.getenv("REALTIME_LAZY_SPEECH_MIN_SECONDS", "0.2"))
+REALTIME_LAZY_PRE_ROLL_SECONDS = float(os.getenv("REALTIME_LAZY_PRE_ROLL_SECONDS", "1.0"))
+
+# Transcript archive (append-only compressed segments, read back by call_id)
+TRANSCRIPT_ARCHIVE_ENABLED = os.getenv("TRANSCRIPT_ARCHIVE_ENABLED", "false").lower() == "true"
+TRANSCRIPT_ARCHIVE_DIRECTORY = os.getenv("TRANSCRIPT_ARCHIVE_DIRECTORY", "transcripts")
+TRANSCRIPT_ARCHIVE_SEGMENT_MAX_BYTES = int(os.getenv("TRANSCRIPT_ARCHIVE_SEGMENT_MAX_BYTES", str(64 * 1024 * 1024)))
+TRANSCRIPT_ARCHIVE_SEGMENT_MAX_SECONDS = float(os.getenv("TRANSCRIPT_ARCHIVE_SEGMENT_MAX_SECONDS", "3600"))
+TRANSCRIPT_ARCHIVE_FLUSH_INTERVAL_SECONDS = float(os.getenv("TRANSCRIPT_ARCHIVE_FLUSH_INTERVAL_SECONDS", "1.0"))
+TRANSCRIPT_ARCHIVE_QUEUE_SIZE = int(os.getenv("TRANSCRIPT_ARCHIVE_QUEUE_SIZE", "100000"))
+# Sealed segments are copied here when set (e.g. a mounted file share)
+TRANSCRIPT_ARCHIVE_UPLOAD_DIRECTORY = os.getenv("TRANSCRIPT_ARCHIVE_UPLOAD_DIRECTORY", "")
+
+# Call recording (caller on the left channel, AI on the right, gzip-compressed WAV)
+RECORDING_ENABLED = os.getenv("RECORDING_ENABLED", "false").lower() == "true"
+RECORDING_DIRECTORY = os.getenv("RECORDING_DIRECTORY", "recordings")
+RECORDING_WRITER_THREADS = int(os.getenv("RECORDING_WRITER_THREADS", "2"))
+# Audio kept per call while the writers catch up; frames beyond this are dropped
+RECORDING_BUFFER_SECONDS = float(os.getenv("RECORDING_BUFFER_SECONDS", "10.0"))
+RECORDING_DRAIN_INTERVAL_SECONDS = float(os.getenv("RECORDING_DRAIN_INTERVAL_SECONDS", "0.5"))
+
+# Graceful drain for rolling deploys (maximum wait for active calls before releasing the rest)
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "120.0"))
+# Token required in the X-Admin-Token header of POST /admin/drain (empty disables the endpoint; drain still runs on shutdown)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Admission control (0 disables a limit; the call limit is also capped by worker-0's capacity / capacity_cost_per_job)
+ADMISSION_MAX_CALLS = int(os.getenv("ADMISSION_MAX_CALLS", "0"))
+ADMISSION_MAX_LOOP_LAG_SECONDS = float(os.getenv("ADMISSION_MAX_LOOP_LAG_SECONDS", "0.1"))
+# What to do with calls over the limit: "reject", "redirect" or "busy"
+ADMISSION_SHED_ACTION = os.getenv("ADMISSION_SHED_ACTION", "reject")
+ADMISSION_REDIRECT_NUMBER = os.getenv("ADMISSION_REDIRECT_NUMBER", "")
+# Busy message audio file (ACS caches file sources per URL)
+ADMISSION_BUSY_AUDIO_URL = os.getenv("ADMISSION_BUSY_AUDIO_URL", "")
+ADMISSION_RESERVATION_SECONDS = float(os.getenv("ADMISSION_RESERVATION_SECONDS", "15.0"))
+
+# DTMF collection (wait for further digits of multi-digit menus, and debounce completed selections)
+DTMF_INTER_DIGIT_TIMEOUT_SECONDS = float(os.getenv("DTMF_INTER_DIGIT_TIMEOUT_SECONDS", "2.0"))
+DTMF_SELECTION_DELAY_SECONDS = float(os.getenv("DTMF_SELECTION_DELAY_SECONDS", "0.3"))
+
+# Per-call watchdog (0 disables a check). ACS sends audio every 20ms even in silence, so calls with no
+# inbound media are torn down; stalled responses and failed pings restart the realtime conversation
+MEDIA_IDLE_TIMEOUT_SECONDS = float(os.getenv("MEDIA_IDLE_TIMEOUT_SECONDS", "10.0"))
+REALTIME_STALL_TIMEOUT_SECONDS = float(os.getenv("REALTIME_STALL_TIMEOUT_SECONDS", "15.0"))
+REALTIME_PING_INTERVAL_SECONDS = float(os.getenv("REALTIME_PING_INTERVAL_SECONDS", "10.0"))
+WATCHDOG_INTERVAL_SECONDS = float(os.getenv("WATCHDOG_INTERVAL_SECONDS", "1.0"))
+# Protocol-level pings uvicorn sends on the ACS WebSocket, and how long to wait for the pong
+WEBSOCKET_PING_INTERVAL_SECONDS = float(os.getenv("WEBSOCKET_PING_INTERVAL_SECONDS", "5.0"))
+WEBSOCKET_PING_TIMEOUT_SECONDS = float(os.getenv("WEBSOCKET_PING_TIMEOUT_SECONDS", "5.0"))
+
 # Event Handling configuration
 TRIGGER_MODE = "polling" # "event" or "polling" note: event mode does not work job router in this version
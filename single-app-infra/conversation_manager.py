@@ -1,105 +1,222 @@
 import asyncio
+import time
 import json
 import base64
 from datetime import datetime
-from azure.core.credentials import AzureKeyCredential
-from rtclient import (
-    ResponseCreateMessage,
-    RTLowLevelClient,
-    ResponseCreateParams,
-    InputAudioBufferAppendMessage
-)
-from config import AZURE_OPENAI_SERVICE_ENDPOINT, AZURE_OPENAI_SERVICE_KEY, AZURE_OPENAI_DEPLOYMENT_NAME
+from typing import TYPE_CHECKING
+from collections import deque
+from config import AZURE_OPENAI_SERVICE_ENDPOINT, AZURE_OPENAI_SERVICE_KEY, AZURE_OPENAI_DEPLOYMENT_NAME, REALTIME_LAZY_CONNECT
 from utils import print_debug
+from trace_recorder import recorder as trace_recorder
+from loop_monitor import loop_monitor
+from role_profiles import role_profiles
+from transcript_archive import transcript_archive
+from call_recorder import call_recorder, INBOUND, OUTBOUND
+from call_watchdog import call_watchdog
+from caller_context import caller_contexts
+from prompt_audio import prompt_audio
+from speech_detector import create_speech_detector
+from metrics import (
+    CALL_CONNECTED_TO_FIRST_AUDIO_SECONDS,
+    DTMF_TO_ROLE_AUDIO_SECONDS,
+    REALTIME_CONNECT_SECONDS,
+    REALTIME_SPEECH_OPENS,
+    INBOUND_FRAMES,
+    INBOUND_BYTES,
+    OUTBOUND_FRAMES,
+    OUTBOUND_BYTES,
+    base64_decoded_length,
+)
 
-def get_instructions(current_role: str) -> str:
-    """
-    共通化した指示文の生成関数。
-    """
-    if current_role == 'RoleA':
-        return """
-            あなたは日本語の AI アシスタントです。
-            ユーザーからの質問にわかりやすく丁寧に回答してください。
-            また、最初は「お電話変わりました。AI アシスタントです。ご要件をお伺いいたします。」
-            と言ってください。
-        """
-    elif current_role == 'RoleB':
-        return """
-            You are English AI assistant. 
-            You are working in a call center answering questions from users.
-            Firstly, Please say 'Hello, I am an AI assistant. How can I help you?'.
-        """
-    elif current_role == 'RoleC':
-        return """
-            あなたは日本人のオペレーターです。
-            ユーザーからの質問にわかりやすく丁寧に回答してください。
-            また、最初は「お電話変わりました。オペレーターの山田です。ご要件をお伺いいたします。」
-            と言ってください。
-        """
-    elif current_role == 'RoleD':
-        return """
-            You are English operator. 
-            You are working in a call center answering questions from users.
-            Please say 'Hello, I am operator Emma. How can I help you?'.
-        """
-    elif current_role == 'RoleE':
-        return "「電話を終了しました。電話を切ってください。」と言ってください。"
-    else:
-        return """
-            「コールセンターにお電話いただきありがとうございます。
-            日本語の AI アシスタントと会話をする場合は 1 を、
-            英語の AI アシスタントと会話をする場合は 2 を、
-            日本人のオペレーターと会話をする場合は 3 を、
-            アメリカ人のオペレーターと会話をする場合は 4 を、
-            通話を終了する場合は 5 を入力してください。」
-            と言ってください。
-        """
-
-async def send_instructions(gpt_client: RTLowLevelClient, instructions: str):
-    """
-    gpt_client を用いて共通のパラメータで指示を送信する。
-    """
-    await gpt_client.send(
-        ResponseCreateMessage(
-            response=ResponseCreateParams(
-                modalities={"audio", "text"},
-                instructions=instructions,
-                voice="shimmer",
-                output_audio_format="pcm16",
-                input_audio_format="pcm16",
-                input_audio_transcription={"model": "whisper-1"}
-            )
-        )
+if TYPE_CHECKING:
+    # rtclient (aiohttp) は最初の会話の開始時に読み込む (起動時は startup_timer.warm で先に読み込んでおく)
+    from rtclient import RTLowLevelClient
+
+async def send_role_profile(gpt_client: "RTLowLevelClient", current_role: str, caller_context: str = None):
+    """
+    current_role のプロファイル (roles.json) から事前にシリアライズした response.create を送信する。
+    発信者の情報 (caller_context) があれば指示に追記する。
+    """
+    profile = role_profiles.get(current_role)
+    await gpt_client.ws.send_str(profile.response_create_payload_for(caller_context))
+
+def create_gpt_client() -> "RTLowLevelClient":
+    from azure.core.credentials import AzureKeyCredential
+    from rtclient import RTLowLevelClient
+    return RTLowLevelClient(
+        url=AZURE_OPENAI_SERVICE_ENDPOINT,
+        azure_deployment=AZURE_OPENAI_DEPLOYMENT_NAME,
+        key_credential=AzureKeyCredential(AZURE_OPENAI_SERVICE_KEY)
     )
 
+async def synthesize_prompt(profile) -> bytes:
+    """
+    定型文 (profile.prompt) を一度だけモデルに読ませて PCM を返す (prompt_audio がキャッシュする)。
+    """
+    gpt_client = create_gpt_client()
+    await gpt_client.connect()
+    try:
+        await gpt_client.ws.send_str(profile.prompt_synthesis_payload)
+        chunks = []
+        while True:
+            message = await gpt_client.recv()
+            if message is None:
+                raise ConnectionError("Realtime session closed before the prompt was synthesized")
+            if message.type == "response.audio.delta":
+                chunks.append(base64.b64decode(message.delta))
+            elif message.type == "response.done":
+                return b"".join(chunks)
+            elif message.type == "error":
+                raise RuntimeError(f"Realtime API error while synthesizing a prompt: {message}")
+    finally:
+        await gpt_client.close()
+
 async def start_conversation(call_id: str, conversation_state: dict):
     """
     RTLowLevelClient を用いて AI 会話を開始
-    current_role に応じた指示を送信し、gpt_client を会話状態に保存
+    current_role に応じた指示を送信し、gpt_client を会話状態に保存 (開始できたら True を返す)
+    定型文の音声がキャッシュにあれば、GPT クライアントには接続せずにその音声を流す
     """
+    gpt_client = None
     try:
         print_debug("start conversation")
         current_role = conversation_state.get('current_role')
-        instructions = get_instructions(current_role)
+        stop_prompt(conversation_state)
+        cancel_open(conversation_state)
+        # 応答と並行して読み込んだ発信者の情報 (済んでいなければ待たずに追記なしで始める)
+        if conversation_state.get('caller_context') is None:
+            conversation_state['caller_context'] = caller_contexts.get(conversation_state.get('caller_id'))
+        prompt = prompt_audio.get(role_profiles.get(current_role))
+        if prompt is not None:
+            play_prompt(call_id, conversation_state, current_role, prompt)
+            if not REALTIME_LAZY_CONNECT:
+                start_open(call_id, conversation_state, [])
+            return True
 
         # GPT クライアントの初期化と接続
-        deployment_name = AZURE_OPENAI_DEPLOYMENT_NAME
-        gpt_client = RTLowLevelClient(
-            url=AZURE_OPENAI_SERVICE_ENDPOINT,
-            azure_deployment=deployment_name,
-            key_credential=AzureKeyCredential(AZURE_OPENAI_SERVICE_KEY)
-        )
+        gpt_client = create_gpt_client()
+        connect_started_at = time.monotonic()
         await gpt_client.connect()
-        await send_instructions(gpt_client, instructions)
+        REALTIME_CONNECT_SECONDS.observe_since(connect_started_at)
+        trace_recorder.record(call_id, "realtime_connected", role=current_role)
+        conversation_state['local_prompt'] = False
+        conversation_state['awaiting_first_audio'] = True
+        await send_role_profile(gpt_client, current_role, conversation_state['caller_context'])
+        trace_recorder.record(call_id, "realtime_out", type="response.create")
+        activity = call_watchdog.get(call_id)
+        if activity is not None:
+            activity.realtime_at = activity.response_started_at = time.monotonic()
         conversation_state['gpt_client'] = gpt_client
-        asyncio.create_task(receive_messages(call_id, conversation_state))
+        loop_monitor.spawn(receive_messages(call_id, conversation_state), call_id, "relay-out")
         print_debug(f"AI conversation started for call_id: {call_id}")
+        return True
+    except asyncio.CancelledError:
+        # 後続の切り替えに置き換えられた。受信タスクを始める前なら、ここで開いた接続を閉じる
+        if gpt_client is not None and conversation_state.get('gpt_client') is not gpt_client:
+            await close_gpt_client_quietly(gpt_client)
+        raise
     except Exception as e:
         print_debug(f"Exception in start_conversation: {e}")
+        return False
+
+async def close_gpt_client_quietly(gpt_client: "RTLowLevelClient"):
+    """
+    GPT クライアントを閉じます (閉じる際の失敗は無視します)。
+    """
+    try:
+        await gpt_client.close()
+    except Exception:
+        pass
+
+def play_prompt(call_id: str, conversation_state: dict, current_role: str, prompt):
+    """
+    モデルに読ませる代わりに、キャッシュした定型文の音声を ACS への送信経路で流します。
+    """
+    conversation_state['local_prompt'] = True
+    conversation_state['speech_detector'] = create_speech_detector()
+    conversation_state['awaiting_first_audio'] = True
+    activity = call_watchdog.get(call_id)
+    if activity is not None:
+        activity.response_started_at = None
+    trace_recorder.record(call_id, "prompt_audio", role=current_role, seconds=round(prompt.seconds, 3))
+
+    async def send_frame(audio_data_base64: str):
+        if conversation_state.get('awaiting_first_audio'):
+            observe_first_audio(conversation_state)
+        await send_audio_to_acs(call_id, audio_data_base64, conversation_state)
+
+    conversation_state['prompt_task'] = loop_monitor.spawn(prompt_audio.play(prompt, send_frame), call_id, "prompt")
+
+def stop_prompt(conversation_state: dict):
+    """
+    再生中の定型文を止めます (ACS に送り済みの分だけ再生されて終わる)。
+    """
+    prompt_task = conversation_state.pop('prompt_task', None)
+    if prompt_task is not None:
+        prompt_task.cancel()
+
+def start_open(call_id: str, conversation_state: dict, pre_roll: list):
+    """
+    定型文の再生中に GPT クライアントへの接続を始めます。
+    接続が済むまでの音声は pending_audio に貯め、検知前の音声 (pre_roll) と合わせて接続後に送ります。
+    """
+    conversation_state['local_prompt'] = False
+    conversation_state['pending_audio'] = deque(pre_roll)
+    conversation_state['open_task'] = loop_monitor.spawn(open_session(call_id, conversation_state), call_id, "realtime-open")
+
+async def open_session(call_id: str, conversation_state: dict):
+    """
+    定型文の後に続く会話のセッションを開きます。指示は session.update で渡し、定型文はモデルに読ませません。
+    """
+    gpt_client = None
+    try:
+        current_role = conversation_state.get('current_role')
+        gpt_client = create_gpt_client()
+        connect_started_at = time.monotonic()
+        await gpt_client.connect()
+        REALTIME_CONNECT_SECONDS.observe_since(connect_started_at)
+        trace_recorder.record(call_id, "realtime_connected", role=current_role)
+        profile = role_profiles.get(current_role)
+        await gpt_client.ws.send_str(profile.session_update_payload_for(conversation_state.get('caller_context')))
+        # 送信中に届いた音声も取りこぼさないよう、空になるまで送る
+        from rtclient import InputAudioBufferAppendMessage
+        pending_audio = conversation_state['pending_audio']
+        replayed = 0
+        while pending_audio:
+            await gpt_client.send(InputAudioBufferAppendMessage(type="input_audio_buffer.append", audio=pending_audio.popleft()))
+            replayed += 1
+        conversation_state.pop('pending_audio', None)
+        conversation_state.pop('open_task', None)
+        conversation_state['gpt_client'] = gpt_client
+        loop_monitor.spawn(receive_messages(call_id, conversation_state), call_id, "relay-out")
+        print_debug(f"Realtime session opened during a prompt for call_id {call_id} ({replayed} frames replayed)")
+    except asyncio.CancelledError:
+        # ロールが切り替わったか通話が終わった。ここで開いた接続だけを閉じる
+        if gpt_client is not None:
+            await close_gpt_client_quietly(gpt_client)
+        raise
+    except Exception as e:
+        print_debug(f"Failed to open the realtime session for call_id {call_id}: {e}", log_level="error")
+        if gpt_client is not None:
+            await close_gpt_client_quietly(gpt_client)
+        # 次の発話でもう一度接続する
+        conversation_state.pop('pending_audio', None)
+        conversation_state.pop('open_task', None)
+        conversation_state['speech_detector'] = create_speech_detector()
+        conversation_state['local_prompt'] = True
+
+def cancel_open(conversation_state: dict):
+    """
+    定型文の再生中に始めた接続を取り消します。
+    """
+    conversation_state.pop('pending_audio', None)
+    open_task = conversation_state.pop('open_task', None)
+    if open_task is not None:
+        open_task.cancel()
 
 async def update_conversation(call_id: str, conversation_state: dict):
     """
-    既存の gpt_client/websocket が有効な場合、一旦終了して新しい会話を開始することで最新の指示を送信
+    既存の gpt_client/websocket が有効な場合、一旦終了して新しい会話を開始することで最新の指示を送信 (開始できたら True を返す)
     """
     try:
         gpt_client = conversation_state.get('gpt_client')
@@ -108,10 +225,12 @@ async def update_conversation(call_id: str, conversation_state: dict):
             conversation_state.pop('gpt_client', None)
             await gpt_client.close()
             print_debug(f"Update conversation for call_id: {call_id}")
-        await start_conversation(call_id, conversation_state)
+        started = await start_conversation(call_id, conversation_state)
         print_debug(f"Conversation updated for call_id: {call_id}")
+        return started
     except Exception as e:
         print_debug(f"Exception in update_conversation for call_id {call_id}: {e}")
+        return False
 
 async def process_websocket_message_async(call_id: str, message_text: str, conversation_state: dict):
     """
@@ -123,8 +242,27 @@ async def process_websocket_message_async(call_id: str, message_text: str, conve
         gpt_client = conversation_state.get('gpt_client')
         
         if message.get('kind') == 'AudioData':
+            # 会話の開始時に読み込み済みのため、ここでは sys.modules から引くだけ
+            from rtclient import InputAudioBufferAppendMessage
             audio_data_base64 = message['audioData']['data']
+            trace_recorder.record_audio(call_id, "acs_audio", audio_data_base64)
+            call_recorder.tap(call_id, INBOUND, audio_data_base64)
             audio_data = base64.b64decode(audio_data_base64)
+            INBOUND_FRAMES.inc()
+            INBOUND_BYTES.inc(len(audio_data))
+            if conversation_state.get('local_prompt'):
+                # 定型文の再生中はモデルに接続していない。発話を検知したら接続する (メニューの選択は DTMF で受ける)
+                speech_detector = conversation_state.get('speech_detector')
+                if speech_detector is not None and speech_detector.feed(audio_data_base64):
+                    REALTIME_SPEECH_OPENS.inc()
+                    trace_recorder.record(call_id, "speech_detected", role=conversation_state.get('current_role'))
+                    start_open(call_id, conversation_state, speech_detector.drain())
+                return
+            pending_audio = conversation_state.get('pending_audio')
+            if pending_audio is not None:
+                # 接続中の音声は接続後にまとめて送る
+                pending_audio.append(audio_data_base64)
+                return
             if gpt_client:
                 audio_base64 = base64.b64encode(audio_data).decode('utf-8')
                 await gpt_client.send(
@@ -134,7 +272,7 @@ async def process_websocket_message_async(call_id: str, message_text: str, conve
                     )
                 )
             else:
-                print_debug(f"gpt_client doesn't exist now for call_id: {call_id}. Waiting for creation.")
+                print_debug(f"gpt_client doesn't exist now for call_id: {call_id}. Waiting for creation.", category="acs.waiting_gpt_client")
                 await wait_for_gpt_client_initialization(call_id, conversation_state)
                 print_debug(f"Created gpt_client for call_id: {call_id}")
                 gpt_client = conversation_state.get('gpt_client')
@@ -149,11 +287,12 @@ async def process_websocket_message_async(call_id: str, message_text: str, conve
                 else:
                     print_debug(f"gpt_client is still not initialized for call_id: {call_id}")
         elif message.get('kind') == 'AudioMetadata':
+            trace_recorder.record(call_id, "acs_message", payload=message)
             print_debug(f"Received AudioMetadata message for call_id: {call_id}")
         else:
-            print_debug("Unknown message kind:", message.get('kind'))
+            print_debug("Unknown message kind:", message.get('kind'), log_level="debug", category="acs.unknown_kind")
     except Exception as e:
-        print_debug(f"Exception in process_websocket_message_async for call_id {call_id}: {e}")
+        print_debug(f"Exception in process_websocket_message_async for call_id {call_id}: {e}", log_level="error", category="acs.message_error")
 
 async def wait_for_gpt_client_initialization(call_id: str, conversation_state: dict):
     """
@@ -179,22 +318,38 @@ async def receive_messages(call_id: str, conversation_state: dict):
         while not gpt_client.closed:
             message = await gpt_client.recv()
             if message:
+                trace_recorder.record(call_id, "realtime_in", type=message.type)
+                # ウォッチドッグは応答の生成中に受信が止まった接続を検知する
+                activity = call_watchdog.get(call_id)
+                if activity is not None:
+                    activity.realtime_at = time.monotonic()
+                    if message.type == "response.created":
+                        activity.response_started_at = activity.realtime_at
+                    elif message.type == "response.done":
+                        activity.response_started_at = None
+                if message.type == "response.audio.delta" and conversation_state.get('prompt_task') is not None:
+                    # モデルが発話に応答し始めたら定型文を止める
+                    stop_prompt(conversation_state)
                 if message.type == "response.audio.delta":
                     audio_data_base64 = message.delta
                     audio_data = base64.b64decode(audio_data_base64)
+                    if conversation_state.get('awaiting_first_audio'):
+                        observe_first_audio(conversation_state)
                     await receive_audio_for_outbound(call_id, audio_data, conversation_state)
                 elif message.type == "response.audio_transcript.delta":
                     transcript_delta = message.delta
-                    print_debug(f"Received transcript delta for call_id {call_id}: {transcript_delta}", log_level="debug")
+                    print_debug(f"Received transcript delta: {transcript_delta}", log_level="debug", sample=0.1)
                     conversation_state['transcript_buffer'] += transcript_delta
                     # Check for end-of-sentence punctuation to process transcript
                     if any(transcript_delta.endswith(punct) for punct in ['。', '！', '？', '.', '!', '?', '」', '\n']):
                         complete_sentence = conversation_state['transcript_buffer'].strip()
                         print_debug(f"Complete sentence for call_id {call_id}: {complete_sentence}")
+                        transcript_archive.append(call_id, "assistant", complete_sentence, role=conversation_state.get('current_role'))
                         conversation_state['transcript_buffer'] = ''
                 elif message.type == "input.audio_transcript":
                     user_transcript = message.text
                     print_debug(f"User transcript for call_id {call_id}: {user_transcript}")
+                    transcript_archive.append(call_id, "user", user_transcript, role=conversation_state.get('current_role'))
                 elif message.type == "response.audio":
                     await receive_audio_for_outbound(call_id, message.data, conversation_state)
                 elif message.type == "response.text":
@@ -202,14 +357,32 @@ async def receive_messages(call_id: str, conversation_state: dict):
     except Exception as e:
         print_debug(f"Exception in receive_messages for call_id {call_id}: {e}")
 
+def observe_first_audio(conversation_state: dict):
+    """
+    ロール切り替え後、または通話開始後に最初の音声を送るまでの時間を記録します。
+    """
+    conversation_state['awaiting_first_audio'] = False
+    role_switch_requested_at = conversation_state.pop('role_switch_requested_at', None)
+    if role_switch_requested_at is not None:
+        DTMF_TO_ROLE_AUDIO_SECONDS.observe_since(role_switch_requested_at)
+        return
+    connected_at = conversation_state.pop('connected_at', None)
+    if connected_at is not None:
+        CALL_CONNECTED_TO_FIRST_AUDIO_SECONDS.observe_since(connected_at)
+
 async def receive_audio_for_outbound(call_id: str, data: bytes, conversation_state: dict):
     """
     Send audio data outbound by encoding it in Base64 and sending it over the existing WebSocket.
     """
+    await send_audio_to_acs(call_id, base64.b64encode(data).decode('utf-8'), conversation_state)
+
+async def send_audio_to_acs(call_id: str, audio_data_base64: str, conversation_state: dict):
+    """
+    Send Base64-encoded audio data over the existing WebSocket.
+    """
     if conversation_state:
         websocket = conversation_state.get('websocket')
         if websocket:
-            audio_data_base64 = base64.b64encode(data).decode('utf-8')
             message = {
                 "kind": "AudioData",
                 "audioData": {
@@ -219,7 +392,13 @@ async def receive_audio_for_outbound(call_id: str, data: bytes, conversation_sta
                 }
             }
             await websocket.send_text(json.dumps(message))
+            activity = call_watchdog.get(call_id)
+            if activity is not None:
+                activity.outbound_at = time.monotonic()
+            call_recorder.tap(call_id, OUTBOUND, audio_data_base64)
+            OUTBOUND_FRAMES.inc()
+            OUTBOUND_BYTES.inc(base64_decoded_length(audio_data_base64))
         else:
-            print_debug(f"No active websocket for call_id: {call_id}")
+            print_debug(f"No active websocket for call_id: {call_id}", category="acs.no_websocket")
     else:
         print_debug(f"No conversation state for call_id: {call_id}")
@@ -0,0 +1,100 @@
+import asyncio
+import hmac
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+from config import ADMIN_TOKEN, DRAIN_TIMEOUT_SECONDS
+from logger import get_logger
+from loop_monitor import loop_monitor
+
+logger = get_logger(__name__)
+
+# POST /admin/drain に付ける管理用トークンのヘッダー
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+class DrainController:
+    # ローリングデプロイ用。新規着信の受け付けを止め、通話の終了を期限まで待ってから残りを後始末する
+    def __init__(self, timeout: float, admin_token: str = "", poll_interval: float = 0.5) -> None:
+        self._timeout = timeout
+        self._admin_token = admin_token
+        self._poll_interval = poll_interval
+        self._active_calls: Optional[Callable[[], int]] = None
+        self._release: Optional[Callable[[], Awaitable[Dict[str, int]]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self.draining = False
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.calls_remaining = 0
+        self.rejected_calls = 0
+        self.result: Dict[str, int] = {}
+
+    def configure(self, active_calls: Callable[[], int], release: Callable[[], Awaitable[Dict[str, int]]]) -> None:
+        # active_calls は進行中の通話数、release は残った通話の realtime クライアント・ジョブ・ワーカーを片付ける処理
+        self._active_calls = active_calls
+        self._release = release
+
+    def authorize(self, token: Optional[str]) -> bool:
+        # 外部から着信を止められないよう、ADMIN_TOKEN と一致するトークンを求める。
+        # トークン未設定なら受け付けない (DevTunnel やイングレスからの要求は送信元がループバックに見えるため、送信元では判断しない)
+        if not self._admin_token or token is None:
+            return False
+        return hmac.compare_digest(token.encode(), self._admin_token.encode())
+
+    def start(self) -> asyncio.Task:
+        if self._task is None:
+            self.draining = True
+            self.started_at = time.monotonic()
+            logger.info(f"Draining: no longer accepting calls, waiting up to {self._timeout}s for {self._active_calls()} active calls")
+            self._task = loop_monitor.spawn(self._drain(), None, "drain")
+        return self._task
+
+    async def run(self) -> None:
+        # シャットダウン時に呼び出す。ドレイン済みならすぐに戻る
+        await self.start()
+
+    def reject(self, count: int = 1) -> None:
+        self.rejected_calls += count
+
+    async def _drain(self) -> None:
+        deadline = self.started_at + self._timeout
+        while self._active_calls() > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(self._poll_interval)
+        self.calls_remaining = self._active_calls()
+        waited = time.monotonic() - self.started_at
+        try:
+            self.result = await self._release()
+        except Exception as e:
+            logger.error(f"Error while releasing calls during drain: {e}")
+        self.finished_at = time.monotonic()
+        logger.info(
+            f"Drained in {self.finished_at - self.started_at:.1f}s "
+            f"(waited {waited:.1f}s, {self.calls_remaining} calls remaining at the deadline)",
+            **self.result
+        )
+
+    def seconds(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "draining": self.draining,
+            "finished": self.finished_at is not None,
+            "seconds": round(self.seconds(), 3),
+            "timeout_seconds": self._timeout,
+            "active_calls": self._active_calls() if self._active_calls else 0,
+            "calls_remaining": self.calls_remaining,
+            "rejected_calls": self.rejected_calls,
+            **self.result,
+        }
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "draining": int(self.draining),
+            "seconds": round(self.seconds(), 3),
+            "calls_remaining": self.calls_remaining,
+            "rejected_calls": self.rejected_calls,
+        }
+
+
+drain_controller = DrainController(timeout = DRAIN_TIMEOUT_SECONDS, admin_token = ADMIN_TOKEN)
@@ -7,14 +7,15 @@ from azure.communication.jobrouter.models import (
     CloseJobOptions,
 )
 from utils import print_debug
-from clients import router_admin_client, router_client
+from metrics import JOB_SUBMIT_TO_OFFER_ACCEPTED_SECONDS
+import clients
 
 async def init_job_router_state(app):
     """
     Initialize the Job Router state by creating a distribution policy, queues, and workers.
     """
     # Create a distribution policy
-    distribution_policy = await router_admin_client.upsert_distribution_policy(
+    distribution_policy = await clients.router_admin_client.upsert_distribution_policy(
         distribution_policy_id="distribution-policy",
         offer_expires_after_seconds=60,
         mode=LongestIdleMode(),
@@ -27,15 +28,19 @@ async def init_job_router_state(app):
         {"id": "queue-0", "name": "QueueA"},
         {"id": "queue-1", "name": "QueueB"}
     ]
-    app.state.queues = {}
-    for queue in queues_settings:
-        created_queue = await router_admin_client.upsert_queue(
+    # Upsert the queues (and then the workers) concurrently to shorten startup
+    created_queues = await asyncio.gather(*(
+        clients.router_admin_client.upsert_queue(
             queue_id=queue["id"],
             name=queue["name"],
             distribution_policy_id=distribution_policy.id
         )
+        for queue in queues_settings
+    ))
+    app.state.queues = {}
+    for queue, created_queue in zip(queues_settings, created_queues):
         app.state.queues[queue["id"]] = created_queue
-        print_debug(f"Queue {queue['id']} created", log_level="debug")  
+        print_debug(f"Queue {queue['id']} created", log_level="debug")
 
     # Define worker settings and create workers
     workers_settings = [
@@ -46,9 +51,8 @@ async def init_job_router_state(app):
         {"id": "worker-4", "queue_id": "queue-1", "capacity": 10, "capacity_cost": 2, "role": "RoleD"},
         {"id": "worker-5", "queue_id": "queue-1", "capacity": 10, "capacity_cost": 1, "role": "RoleE"},
     ]
-    app.state.workers = {}
-    for worker in workers_settings:
-        created_worker = await router_client.upsert_worker(
+    created_workers = await asyncio.gather(*(
+        clients.router_client.upsert_worker(
             worker_id=worker["id"],
             capacity=worker["capacity"],
             queues=[worker["queue_id"]],
@@ -59,14 +63,26 @@ async def init_job_router_state(app):
             ],
             available_for_offers=True
         )
+        for worker in workers_settings
+    ))
+    app.state.workers = {}
+    for worker, created_worker in zip(workers_settings, created_workers):
         app.state.workers[worker["id"]] = created_worker
         print_debug(f"Worker {worker['id']} created with role {worker['role']}", log_level="debug")
 
+def job_capacity(app, worker_id: str = "worker-0") -> int:
+    """
+    ワーカーが同時に持てるジョブ数 (capacity / capacity_cost_per_job) を返します。着信はまず worker-0 (RoleDefault) に割り当てられます。
+    """
+    worker = app.state.workers[worker_id]
+    capacity_cost = max((channel.capacity_cost_per_job for channel in worker.channels), default=1)
+    return worker.capacity // max(1, capacity_cost)
+
 async def submit_job_to_queue(job_id: str, channel_id: str, queue_id: str, priority: int, role_label: str):
     """
     Submit a job to the specified queue with given selectors.
     """
-    job = await router_client.upsert_job(
+    job = await clients.router_client.upsert_job(
         job_id=job_id,
         channel_id=channel_id,
         queue_id=queue_id,
@@ -90,23 +106,30 @@ async def handle_job_offers(job_id: str, call_id: str, conversation_state: dict)
         try:
             await asyncio.sleep(1)
             for worker_id in ["worker-0", "worker-1", "worker-2", "worker-3", "worker-4", "worker-5"]:
-                worker = await router_client.get_worker(worker_id=worker_id)
-                print_debug(f"Worker {worker_id} state: {worker.state}")
-                print_debug(f"Worker {worker_id} available capacity: {worker.capacity}")
-                print_debug(f"Worker {worker_id} offers: {worker.offers}", log_level="debug")
+                worker = await clients.router_client.get_worker(worker_id=worker_id)
+                print_debug(
+                    f"Worker {worker_id} state: {worker.state}, capacity: {worker.capacity}, offers: {worker.offers}",
+                    log_level="debug",
+                    category="job_offer.poll",
+                    call_id=call_id,
+                    job_id=job_id
+                )
                 if worker and worker.offers:
                     for offer in worker.offers:
                         if offer.job_id == job_id:
                             print_debug(f"Worker {worker_id} has an active offer for job {offer.job_id}")
-                            accept = await router_client.accept_job_offer(worker_id=worker_id, offer_id=offer.offer_id)
+                            accept = await clients.router_client.accept_job_offer(worker_id=worker_id, offer_id=offer.offer_id)
                             print_debug(f"Worker {worker_id} is assigned job {accept.job_id} with assignment ID {accept.assignment_id}")
                             conversation_state['assigned_worker'] = worker  
                             conversation_state['assignment_id'] = accept.assignment_id  
+                            job_submitted_at = conversation_state.pop('job_submitted_at', None)
+                            if job_submitted_at is not None:
+                                JOB_SUBMIT_TO_OFFER_ACCEPTED_SECONDS.observe_since(job_submitted_at)
                             print_debug(f"Assigned worker {worker_id} to call_id {call_id}")
                             return # ジョブが割り当てられたらループを終了  
-            print_debug(f"No offers found for job {job_id} in this polling cycle.", log_level="debug")
+            print_debug(f"No offers found for job {job_id} in this polling cycle.", log_level="debug", category="job_offer.poll")
         except Exception as e:
-            print_debug(f"Error in handle_job_offers: {e}")
+            print_debug(f"Error in handle_job_offers: {e}", log_level="error", category="job_offer.error")
 
 async def handle_job_offer_event(event: dict, conversation_state: dict):
     """
@@ -124,7 +147,7 @@ async def handle_job_offer_event(event: dict, conversation_state: dict):
             return
         
         print_debug(f"Received job offer event for worker {worker_id} and job {job_id}", log_level="debug")
-        accept = await router_client.accept_job_offer(worker_id=worker_id, offer_id=offer_id)
+        accept = await clients.router_client.accept_job_offer(worker_id=worker_id, offer_id=offer_id)
         print_debug(f"Worker {worker_id} accepted job {job_id} with assignment ID {accept.assignment_id}", log_level="debug")
         
         conversation_state['assigned_worker'] = worker_id
@@ -136,9 +159,9 @@ async def handle_job_completion(job_id: str, assignment_id: str):
     """
     Complete, close, and finally delete a job.
     """
-    await router_client.complete_job(job_id=job_id, assignment_id=assignment_id)
+    await clients.router_client.complete_job(job_id=job_id, assignment_id=assignment_id)
     print_debug(f"Job {job_id} completed")
-    await router_client.close_job(
+    await clients.router_client.close_job(
         job_id=job_id,
         assignment_id=assignment_id,
         options=CloseJobOptions(disposition_code="Resolved")
@@ -148,10 +171,40 @@ async def handle_job_completion(job_id: str, assignment_id: str):
     # Wait for job status to become "closed" before deletion.
     job_closed = False
     while not job_closed:
-        job = await router_client.get_job(job_id=job_id)
+        job = await clients.router_client.get_job(job_id=job_id)
         if job.status == "closed":
             job_closed = True
         else:
             await asyncio.sleep(0.5)
-    await router_client.delete_job(job_id)
+    await clients.router_client.delete_job(job_id)
     print_debug(f"Job {job_id} deleted")
+
+async def close_outstanding_job(job_id: str, assignment_id: str = None, timeout: float = 10.0, disposition_code: str = "Resolved"):
+    """
+    ロール切り替えやドレインで不要になったジョブを片付けます。割り当て済みなら完了・クローズし、未割り当てならキャンセルしてから削除します。
+    handle_job_completion と違い、クローズ済みになるまでポーリングしません。
+    """
+    async def close():
+        if assignment_id:
+            await clients.router_client.complete_job(job_id=job_id, assignment_id=assignment_id)
+            await clients.router_client.close_job(
+                job_id=job_id,
+                assignment_id=assignment_id,
+                options=CloseJobOptions(disposition_code=disposition_code)
+            )
+        else:
+            await clients.router_client.cancel_job(job_id=job_id)
+        await clients.router_client.delete_job(job_id)
+        print_debug(f"Job {job_id} released")
+    await asyncio.wait_for(close(), timeout=timeout)
+
+async def set_workers_available(app, available: bool):
+    """
+    すべてのワーカーのオファー受け付けを切り替えます。ドレイン時は False にして新しいジョブが割り当てられないようにします。
+    """
+    for worker_id in app.state.workers:
+        app.state.workers[worker_id] = await clients.router_client.upsert_worker(
+            worker_id=worker_id,
+            available_for_offers=available
+        )
+    print_debug(f"Workers available_for_offers set to {available}")
@@ -0,0 +1,371 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from typing import Any, Coroutine, Dict, Iterator, List, Optional, Set, Tuple
+from weakref import WeakKeyDictionary
+from config import LOOP_MONITOR_INTERVAL_SECONDS, LOOP_STALL_THRESHOLD_SECONDS
+from logger import get_logger
+from metrics import registry as metrics_registry
+
+logger = get_logger(__name__)
+
+# イベントループの遅延 (スケジュールした時刻からの遅れ) 用バケット
+LOOP_LAG_BUCKETS: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LOOP_LAG_SECONDS = metrics_registry.histogram(
+    "callcenter_event_loop_lag_seconds",
+    "Delay between the scheduled and actual wake-up of the loop lag sampler",
+    LOOP_LAG_BUCKETS
+)
+LOOP_STALLS = metrics_registry.counter(
+    "callcenter_event_loop_stalls_total",
+    "Times the event loop did not respond within the stall threshold"
+)
+TASK_FAILURES = metrics_registry.counter(
+    "callcenter_task_failures_total",
+    "Background tasks that ended with an exception"
+)
+
+class TaskTag:
+    def __init__(self, call_id: Optional[str], role: str, cleanup: bool = False) -> None:
+        self.call_id = call_id
+        self.role = role
+        # 後片付け (ジョブの終了など) のタスクは通話の切断時に止めない
+        self.cleanup = cleanup
+        self.created_at = time.monotonic()
+
+    def label(self) -> str:
+        return f"{self.role}:{self.call_id}" if self.call_id else self.role
+
+
+class StallRecord:
+    # 同じスタックで発生したストールの集計
+    def __init__(self, stack: List[str], task: str) -> None:
+        self.stack = stack
+        self.tasks: StackCounter = StackCounter({task: 1})
+        self.count = 1
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total_seconds, 3),
+            "max_seconds": round(self.max_seconds, 3),
+            "tasks": dict(self.tasks.most_common(5)),
+            "stack": self.stack,
+        }
+
+
+class LoopMonitor:
+    def __init__(
+        self,
+        sample_interval: float,
+        stall_threshold: float,
+        max_stack_depth: int = 30,
+        max_stall_records: int = 200
+    ) -> None:
+        self._sample_interval = sample_interval
+        self._stall_threshold = stall_threshold
+        self._max_stack_depth = max_stack_depth
+        self._max_stall_records = max_stall_records
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._sampler_task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        # ループが最後に応答した時刻。ウォッチドッグスレッドから参照する
+        self._heartbeat = time.monotonic()
+        self._tags: "WeakKeyDictionary[asyncio.Task, TaskTag]" = WeakKeyDictionary()
+        # spawn したタスクは終わるまで通話ごとに参照を持つ (asyncio は弱参照しか持たないため、捨てると GC で消える)
+        self._owned: Dict[Optional[str], Set[asyncio.Task]] = {}
+        self.failures_by_role: StackCounter = StackCounter()
+        self.call_tasks_cancelled = 0
+        self._stalls: Dict[Tuple[str, ...], StallRecord] = {}
+        self._profiler_lock = threading.Lock()
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        # 一時的な遅延で判断がぶれないよう、指数移動平均も持つ (受付制御で参照する)
+        self.smoothed_lag = 0.0
+
+    # 開始 / 停止
+    def start(self) -> None:
+        if self._sampler_task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._heartbeat = time.monotonic()
+        self._sampler_task = self.spawn(self._sample_lag(), None, "loop-monitor")
+        self._watchdog = threading.Thread(target = self._watch, name = "loop-watchdog", daemon = True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._sampler_task is not None:
+            self._sampler_task.cancel()
+            try:
+                await self._sampler_task
+            except asyncio.CancelledError:
+                pass
+            self._sampler_task = None
+        if self._watchdog is not None:
+            self._watchdog.join(timeout = 1)
+            self._watchdog = None
+
+    # タスクのタグ付け
+    def spawn(self, coro: Coroutine, call_id: Optional[str], role: str, cleanup: bool = False) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tags[task] = TaskTag(call_id, role, cleanup)
+        self._owned.setdefault(call_id, set()).add(task)
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    def _on_task_done(self, task: asyncio.Task) -> None:
+        tag = self._tags.get(task)
+        call_id = tag.call_id if tag else None
+        tasks = self._owned.get(call_id)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self._owned[call_id]
+        if task.cancelled():
+            return
+        # 例外を取り出しておく (取り出さないと GC 時に "never retrieved" として出るだけで気付けない)
+        error = task.exception()
+        if error is not None:
+            role = tag.role if tag else "unknown"
+            TASK_FAILURES.inc()
+            self.failures_by_role[role] += 1
+            logger.error(f"Task {role} for call_id {call_id} failed: {error!r}", category = "task.failed")
+
+    def tag(self, task: asyncio.Task, call_id: Optional[str], role: str) -> None:
+        self._tags[task] = TaskTag(call_id, role)
+
+    @contextmanager
+    def tagged(self, call_id: Optional[str], role: str) -> Iterator[None]:
+        # 既存のタスク内で実行する処理 (オファー待ちなど) に一時的にタグを付ける
+        task = asyncio.current_task()
+        if task is None:
+            yield
+            return
+        previous = self._tags.get(task)
+        self._tags[task] = TaskTag(call_id, role)
+        try:
+            yield
+        finally:
+            if previous is None:
+                self._tags.pop(task, None)
+            else:
+                self._tags[task] = previous
+
+    async def cancel_call(self, call_id: str) -> int:
+        # 切断時に、通話のために spawn したタスクをまとめて止めて終了を待つ (後片付けのタスクは残す)
+        current = asyncio.current_task()
+        tasks = [
+            task for task in list(self._owned.get(call_id, ()))
+            if task is not current and not task.done() and not self._tags[task].cleanup
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+        self.call_tasks_cancelled += len(tasks)
+        return len(tasks)
+
+    async def cancel_call_tasks(self) -> int:
+        # シャットダウン時に、通話のために spawn したタスク (オファー待ちなど) をまとめて止める。
+        # cancel_call と同じく後片付けのタスクは残し、tagged() で一時的にタグを付けただけのタスクは対象にしない
+        current = asyncio.current_task()
+        tasks = [
+            task
+            for call_id, owned in list(self._owned.items()) if call_id is not None
+            for task in list(owned)
+            if task is not current and not task.done() and not self._tags[task].cleanup
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+        return len(tasks)
+
+    def _task_label(self, task: Optional[asyncio.Task]) -> str:
+        if task is None:
+            return "(no task)"
+        tag = self._tags.get(task)
+        return tag.label() if tag else task.get_name()
+
+    # ループ遅延の計測
+    async def _sample_lag(self) -> None:
+        while True:
+            scheduled_at = time.monotonic()
+            await asyncio.sleep(self._sample_interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag = max(0.0, now - scheduled_at - self._sample_interval)
+            self.last_lag = lag
+            self.smoothed_lag += (lag - self.smoothed_lag) * 0.2
+            if lag > self.max_lag:
+                self.max_lag = lag
+            LOOP_LAG_SECONDS.observe(lag)
+
+    # ストール検出 (別スレッド)
+    def _watch(self) -> None:
+        stalled_since: Optional[float] = None
+        record: Optional[StallRecord] = None
+        check_interval = min(self._stall_threshold / 2, self._sample_interval)
+        while not self._stopped.wait(check_interval):
+            silent_for = time.monotonic() - self._heartbeat - self._sample_interval
+            if silent_for < self._stall_threshold:
+                stalled_since = None
+                continue
+            # 同じストールの間はスタックを一度だけ取得し、時間だけ更新する
+            if stalled_since is None:
+                stalled_since = self._heartbeat
+                record = self._capture_stall()
+            elif record is not None:
+                record.total_seconds += check_interval
+            if record is not None:
+                record.max_seconds = max(record.max_seconds, silent_for)
+
+    def _capture_stall(self) -> Optional[StallRecord]:
+        stack = self._loop_stack()
+        if stack is None:
+            return None
+        LOOP_STALLS.inc()
+        task = self._task_label(self._running_task())
+        key = tuple(stack)
+        record = self._stalls.get(key)
+        if record is None:
+            if len(self._stalls) >= self._max_stall_records:
+                return None
+            record = StallRecord(stack, task)
+            self._stalls[key] = record
+        else:
+            record.count += 1
+            record.tasks[task] += 1
+        record.total_seconds += self._stall_threshold
+        logger.warning(
+            "Event loop stalled",
+            category = "loop.stall",
+            task = task,
+            location = stack[-1] if stack else None
+        )
+        return record
+
+    def _running_task(self) -> Optional[asyncio.Task]:
+        # 別スレッドからは asyncio.current_task を使えないため、ループの実行中タスクを直接参照する
+        try:
+            return asyncio.tasks._current_tasks.get(self._loop)
+        except AttributeError:
+            return None
+
+    def _loop_stack(self) -> Optional[List[str]]:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return None
+        summary = traceback.extract_stack(frame, limit = self._max_stack_depth)
+        return [f"{entry.filename}:{entry.lineno} {entry.name}" for entry in summary]
+
+    # サンプリングプロファイラ
+    async def profile(self, seconds: float, interval: float = 0.005, limit: int = 30) -> Dict[str, Any]:
+        # ループスレッドのスタックを別スレッドで定期的に採取し、出現回数の多い順に返す
+        if not self._profiler_lock.acquire(blocking = False):
+            raise RuntimeError("Profiler is already running")
+        try:
+            samples: StackCounter = StackCounter()
+            tasks: StackCounter = StackCounter()
+            stop = threading.Event()
+
+            def sample() -> None:
+                while not stop.wait(interval):
+                    frame = sys._current_frames().get(self._loop_thread_id)
+                    if frame is None:
+                        continue
+                    stack = traceback.extract_stack(frame, limit = self._max_stack_depth)
+                    samples[";".join(f"{entry.name} ({entry.filename.rsplit('/', 1)[-1]}:{entry.lineno})" for entry in stack)] += 1
+                    tasks[self._task_label(self._running_task())] += 1
+
+            sampler = threading.Thread(target = sample, name = "loop-profiler", daemon = True)
+            sampler.start()
+            await asyncio.sleep(seconds)
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            total = sum(samples.values())
+            return {
+                "seconds": seconds,
+                "interval": interval,
+                "samples": total,
+                "tasks": dict(tasks.most_common(limit)),
+                # flamegraph.pl などでそのまま扱える folded 形式
+                "stacks": [f"{stack} {count}" for stack, count in samples.most_common(limit)],
+            }
+        finally:
+            self._profiler_lock.release()
+
+    # 集計
+    def tasks_by_role(self) -> Dict[str, int]:
+        counts: StackCounter = StackCounter()
+        for task, tag in list(self._tags.items()):
+            if not task.done():
+                counts[tag.role] += 1
+        return dict(counts)
+
+    def tasks(self, limit: int = 100, call_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        # call_id を指定すると、その通話の生きているタスクだけを返す (切断後は空になるはず)
+        now = time.monotonic()
+        result = []
+        for task, tag in list(self._tags.items()):
+            if task.done() or (call_id is not None and tag.call_id != call_id):
+                continue
+            result.append({
+                "name": task.get_name(),
+                "call_id": tag.call_id,
+                "role": tag.role,
+                "cleanup": tag.cleanup,
+                "age_seconds": round(now - tag.created_at, 3),
+            })
+        result.sort(key = lambda entry: entry["age_seconds"], reverse = True)
+        return result[:limit]
+
+    def tasks_by_call(self) -> Dict[str, int]:
+        counts: StackCounter = StackCounter()
+        for task, tag in list(self._tags.items()):
+            if tag.call_id is not None and not task.done():
+                counts[tag.call_id] += 1
+        return dict(counts)
+
+    def top_stalls(self, limit: int = 10) -> List[Dict[str, Any]]:
+        records = sorted(self._stalls.values(), key = lambda record: record.total_seconds, reverse = True)
+        return [record.to_dict() for record in records[:limit]]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "lag_seconds": round(self.last_lag, 6),
+            "max_lag_seconds": round(self.max_lag, 6),
+            "smoothed_lag_seconds": round(self.smoothed_lag, 6),
+            "stalls": int(LOOP_STALLS.value),
+            "tasks": len(asyncio.all_tasks(self._loop)) if self._loop else 0,
+            "tracked_tasks": sum(self.tasks_by_role().values()),
+            "owned_tasks": sum(len(tasks) for tasks in self._owned.values()),
+            "calls_with_tasks": len(self.tasks_by_call()),
+            "task_failures": int(TASK_FAILURES.value),
+            "call_tasks_cancelled": self.call_tasks_cancelled,
+        }
+
+    def snapshot(self, limit: int = 10) -> Dict[str, Any]:
+        return {
+            **self.stats(),
+            "stall_threshold_seconds": self._stall_threshold,
+            "tasks_by_role": self.tasks_by_role(),
+            "failures_by_role": dict(self.failures_by_role),
+            "top_stalls": self.top_stalls(limit),
+            "oldest_tasks": self.tasks(limit),
+        }
+
+
+loop_monitor = LoopMonitor(
+    sample_interval = LOOP_MONITOR_INTERVAL_SECONDS,
+    stall_threshold = LOOP_STALL_THRESHOLD_SECONDS
+)
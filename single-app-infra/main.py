@@ -1,20 +1,137 @@
+from startup import startup_timer
+import asyncio
 import uvicorn
 from fastapi import FastAPI, WebSocket
 from contextlib import asynccontextmanager
 from config import *
-from clients import *
-from job_router import init_job_router_state
-from call_handler import router as call_handler_router
+import clients
+from clients import init_clients, close_clients
+from job_router import init_job_router_state, close_outstanding_job, set_workers_available, job_capacity
+from event_cache import ProcessedEventCache
+from logger import start_logging, stop_logging
+import logger as log_config
+from metrics import registry as metrics_registry, stats_collector
+from trace_recorder import recorder as trace_recorder
+from loop_monitor import loop_monitor
+from role_profiles import role_profiles
+from transcript_archive import transcript_archive
+from call_recorder import call_recorder
+from drain import drain_controller
+from admission import admission_controller
+from dtmf_collector import dtmf_collectors
+from call_watchdog import call_watchdog
+from caller_context import caller_contexts
+from prompt_audio import prompt_audio
+from metrics import ACTIVE_CALLS
+from utils import print_debug
+from call_handler import router as call_handler_router, callback_latency_metrics_lines, release_stalled_call
 from websocket_handler import websocket_endpoint as ws_handler
 
+startup_timer.mark("imports")
+
+# Modules not needed to accept calls, imported in the background before the first conversation
+WARMUP_MODULES = ["rtclient"]
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    startup_timer.mark("server_start")
+    start_logging()
+    # ロール定義に誤りがあれば起動時に失敗させる
+    role_profiles.load()
+    loop_monitor.start()
     # Attach shared state to app.state
     app.state.conversation_states = {}
     app.state.job_id_to_call_id = {}
+    app.state.incoming_call_semaphore = asyncio.Semaphore(INCOMING_CALL_CONCURRENCY)
+    app.state.processed_event_cache = ProcessedEventCache(
+        max_entries=PROCESSED_EVENT_CACHE_SIZE,
+        ttl_seconds=PROCESSED_EVENT_TTL_SECONDS
+    )
+    # Build the SDK clients here rather than at import time
+    with startup_timer.phase("clients_init"):
+        init_clients()
+    caller_contexts.configure(clients.read_caller_profile if clients.caller_profile_container is not None else None)
     # Initialize the Job Router state (queues, policies, workers, etc.)
-    await init_job_router_state(app)
+    with startup_timer.phase("job_router_init"):
+        await init_job_router_state(app)
+    trace_recorder.start()
+    transcript_archive.start()
+    call_recorder.start()
+    register_metrics_collectors(app)
+    drain_controller.configure(lambda: int(ACTIVE_CALLS.value), lambda: release_calls(app))
+    admission_controller.configure(lambda: int(ACTIVE_CALLS.value), job_capacity=job_capacity(app))
+    call_watchdog.configure(lambda call_id, reason: release_stalled_call(app, call_id, reason))
+    call_watchdog.start()
+    loop_monitor.spawn(warm_up(), None, "warmup")
+    startup_timer.mark("lifespan")
+    startup_timer.ready()
     yield
+    # ドレイン済みでなければここでドレインする (通話はサーバー停止時に切断済みのため、すぐに片付けに進む)
+    await drain_controller.run()
+    await call_watchdog.stop()
+    await close_clients()
+    call_recorder.stop()
+    transcript_archive.stop()
+    trace_recorder.stop()
+    await loop_monitor.stop()
+    stop_logging()
+
+async def warm_up():
+    """
+    着信の受け付けに不要なモジュールを読み込み、定型文の音声を用意します。
+    """
+    await startup_timer.warm(WARMUP_MODULES)
+    from conversation_manager import synthesize_prompt
+    prompt_audio.configure(synthesize_prompt)
+    await prompt_audio.warm(role_profiles.prompts())
+
+async def release_calls(app: FastAPI):
+    """
+    残っている GPT クライアントを並行して閉じ、通話のタスクを止め、未完了のジョブを片付けてからワーカーを外します。
+    """
+    conversation_states = list(app.state.conversation_states.values())
+    gpt_clients = [state.pop('gpt_client') for state in conversation_states if state.get('gpt_client')]
+    await asyncio.gather(*(gpt_client.close() for gpt_client in gpt_clients), return_exceptions=True)
+    tasks_cancelled = await loop_monitor.cancel_call_tasks()
+    jobs = [(state['job_id'], state.get('assignment_id')) for state in conversation_states if state.get('job_id')]
+    results = await asyncio.gather(*(
+        close_outstanding_job(job_id, assignment_id, disposition_code="Drained") for job_id, assignment_id in jobs
+    ), return_exceptions=True)
+    jobs_failed = 0
+    for (job_id, _), result in zip(jobs, results):
+        if isinstance(result, BaseException):
+            jobs_failed += 1
+            print_debug(f"Error releasing job {job_id} during drain: {result}", log_level="error")
+        app.state.job_id_to_call_id.pop(job_id, None)
+    try:
+        await set_workers_available(app, False)
+    except Exception as e:
+        print_debug(f"Failed to mark the workers unavailable: {e}", log_level="error")
+    return {
+        "realtime_closed": len(gpt_clients),
+        "tasks_cancelled": tasks_cancelled,
+        "jobs_finished": len(jobs) - jobs_failed,
+        "jobs_failed": jobs_failed,
+    }
+
+def register_metrics_collectors(app: FastAPI):
+    metrics_registry.add_collector(
+        stats_collector("callcenter_processed_event_cache", app.state.processed_event_cache.stats)
+    )
+    metrics_registry.add_collector(stats_collector("callcenter_logger", log_config.stats))
+    metrics_registry.add_collector(callback_latency_metrics_lines)
+    metrics_registry.add_collector(stats_collector("callcenter_trace_recorder", trace_recorder.stats))
+    metrics_registry.add_collector(stats_collector("callcenter_event_loop", loop_monitor.stats))
+    metrics_registry.add_collector(stats_collector("callcenter_role_profiles", role_profiles.stats))
+    metrics_registry.add_collector(stats_collector("callcenter_transcript_archive", transcript_archive.stats))
+    metrics_registry.add_collector(stats_collector("callcenter_call_recorder", call_recorder.stats))
+    metrics_registry.add_collector(stats_collector("callcenter_drain", drain_controller.stats))
+    metrics_registry.add_collector(stats_collector("callcenter_admission", admission_controller.stats))
+    metrics_registry.add_collector(stats_collector("callcenter_dtmf", dtmf_collectors.stats))
+    metrics_registry.add_collector(stats_collector("callcenter_startup", startup_timer.stats))
+    metrics_registry.add_collector(stats_collector("callcenter_watchdog", call_watchdog.stats))
+    metrics_registry.add_collector(stats_collector("callcenter_caller_context", caller_contexts.stats))
+    metrics_registry.add_collector(stats_collector("callcenter_prompt_audio", prompt_audio.stats))
 
 app = FastAPI(lifespan=lifespan)
 
@@ -27,4 +144,11 @@ async def websocket_endpoint(websocket: WebSocket, call_id: str):
     await ws_handler(websocket, call_id)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    # Uvicorn pings the ACS WebSocket and closes it when the pong does not arrive
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8080,
+        ws_ping_interval=WEBSOCKET_PING_INTERVAL_SECONDS,
+        ws_ping_timeout=WEBSOCKET_PING_TIMEOUT_SECONDS
+    )
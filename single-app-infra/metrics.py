@@ -0,0 +1,220 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# 秒単位のレイテンシ用バケット
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+def _format_labels(labels: Optional[Dict[str, str]], extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in (labels or {}).items()]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Optional[Dict[str, str]] = None) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def samples(self) -> Iterable[str]:
+        yield f"{self.name}{_format_labels(self.labels)} {self.value}"
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: Optional[Dict[str, str]] = None) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def samples(self) -> Iterable[str]:
+        yield f"{self.name}{_format_labels(self.labels)} {self.value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+        labels: Optional[Dict[str, str]] = None
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._buckets = buckets
+        # 最後の要素は +Inf
+        self._counts: List[int] = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect_left(self._buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def observe_since(self, started_at: float) -> None:
+        self.observe(time.monotonic() - started_at)
+
+    def samples(self) -> Iterable[str]:
+        cumulative = 0
+        for upper_bound, count in zip(self._buckets, self._counts):
+            cumulative += count
+            labels = _format_labels(self.labels, 'le="' + str(upper_bound) + '"')
+            yield f"{self.name}_bucket{labels} {cumulative}"
+        cumulative += self._counts[-1]
+        labels = _format_labels(self.labels, 'le="+Inf"')
+        yield f"{self.name}_bucket{labels} {cumulative}"
+        yield f"{self.name}_sum{_format_labels(self.labels)} {self.sum}"
+        yield f"{self.name}_count{_format_labels(self.labels)} {self.count}"
+
+
+class RateGauge:
+    # スクレイプ間隔での Counter の増加量を 1 秒あたりの値として出力する
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, counter: Counter) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = None
+        self._counter = counter
+        self._last_value = counter.value
+        self._last_time = time.monotonic()
+
+    def samples(self) -> Iterable[str]:
+        now = time.monotonic()
+        value = self._counter.value
+        elapsed = now - self._last_time
+        rate = (value - self._last_value) / elapsed if elapsed > 0 else 0.0
+        self._last_value = value
+        self._last_time = now
+        yield f"{self.name} {rate}"
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, list] = {}
+        self._collectors: List[Callable[[], Iterable[str]]] = []
+
+    def register(self, metric):
+        self._metrics.setdefault(metric.name, []).append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Optional[Dict[str, str]] = None) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Optional[Dict[str, str]] = None) -> Gauge:
+        return self.register(Gauge(name, help_text, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+        labels: Optional[Dict[str, str]] = None
+    ) -> Histogram:
+        return self.register(Histogram(name, help_text, buckets, labels))
+
+    def rate(self, name: str, help_text: str, counter: Counter) -> RateGauge:
+        return self.register(RateGauge(name, help_text, counter))
+
+    def add_collector(self, collector: Callable[[], Iterable[str]]) -> None:
+        # 他のコンポーネントが持つ統計値を Prometheus テキスト形式の行として追加する
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name, metrics in self._metrics.items():
+            lines.append(f"# HELP {name} {metrics[0].help_text}")
+            lines.append(f"# TYPE {name} {metrics[0].kind}")
+            for metric in metrics:
+                lines.extend(metric.samples())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+INCOMING_CALL_TO_ANSWER_SECONDS = registry.histogram(
+    "callcenter_incoming_call_to_answer_seconds",
+    "Time from receiving the IncomingCall event to the answer_call response"
+)
+CALL_CONNECTED_TO_FIRST_AUDIO_SECONDS = registry.histogram(
+    "callcenter_call_connected_to_first_audio_seconds",
+    "Time from the CallConnected event to the first model audio sent to ACS"
+)
+DTMF_TO_ROLE_AUDIO_SECONDS = registry.histogram(
+    "callcenter_dtmf_to_role_audio_seconds",
+    "Time from a DTMF tone to the first audio of the new role"
+)
+JOB_SUBMIT_TO_OFFER_ACCEPTED_SECONDS = registry.histogram(
+    "callcenter_job_submit_to_offer_accepted_seconds",
+    "Time from submitting a Job Router job to accepting its offer"
+)
+REALTIME_CONNECT_SECONDS = registry.histogram(
+    "callcenter_realtime_connect_seconds",
+    "Time to connect to the realtime API"
+)
+INBOUND_FRAMES = registry.counter("callcenter_inbound_frames_total", "Audio frames received from ACS")
+INBOUND_BYTES = registry.counter("callcenter_inbound_bytes_total", "Audio bytes received from ACS")
+OUTBOUND_FRAMES = registry.counter("callcenter_outbound_frames_total", "Audio frames sent to ACS")
+OUTBOUND_BYTES = registry.counter("callcenter_outbound_bytes_total", "Audio bytes sent to ACS")
+registry.rate("callcenter_inbound_frames_per_second", "Inbound frames per second since the last scrape", INBOUND_FRAMES)
+registry.rate("callcenter_inbound_bytes_per_second", "Inbound bytes per second since the last scrape", INBOUND_BYTES)
+registry.rate("callcenter_outbound_frames_per_second", "Outbound frames per second since the last scrape", OUTBOUND_FRAMES)
+registry.rate("callcenter_outbound_bytes_per_second", "Outbound bytes per second since the last scrape", OUTBOUND_BYTES)
+ACTIVE_CALLS = registry.gauge("callcenter_active_calls", "Calls with an open ACS media WebSocket")
+REALTIME_SPEECH_OPENS = registry.counter(
+    "callcenter_realtime_speech_opens_total",
+    "Realtime API sessions opened because the caller spoke while a cached prompt was playing"
+)
+ROLE_SWITCH_ROUTING_SECONDS = registry.histogram(
+    "callcenter_role_switch_routing_seconds",
+    "Time to finish the previous job and submit the new job during a role switch"
+)
+ROLE_SWITCHES_COMPLETED = registry.counter(
+    "callcenter_role_switches_total",
+    "Role switches by result",
+    {"result": "completed"}
+)
+ROLE_SWITCHES_ROLLED_BACK = registry.counter(
+    "callcenter_role_switches_total",
+    "Role switches by result",
+    {"result": "rolled_back"}
+)
+
+def stats_collector(prefix: str, stats: Callable[[], Dict[str, float]]) -> Callable[[], Iterable[str]]:
+    # {"hits": 1, ...} 形式の統計値を untyped のメトリクス行に変換する
+    def collect() -> Iterable[str]:
+        for key, value in stats().items():
+            if isinstance(value, (int, float)):
+                yield f"{prefix}_{key} {value}"
+    return collect
+
+def base64_decoded_length(data_base64: str) -> int:
+    # デコードせずに Base64 文字列からバイト数を求める
+    return len(data_base64) * 3 // 4 - data_base64.count("=", -2)
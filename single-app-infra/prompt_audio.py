@@ -0,0 +1,185 @@
+import asyncio
+import base64
+import hashlib
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+from config import (
+    PROMPT_AUDIO_ENABLED,
+    PROMPT_AUDIO_DIRECTORY,
+    PROMPT_AUDIO_CHUNK_SECONDS,
+    PROMPT_AUDIO_LEAD_SECONDS,
+    PROMPT_AUDIO_SYNTHESIS_TIMEOUT_SECONDS
+)
+from logger import get_logger
+from loop_monitor import loop_monitor
+from role_profiles import RoleProfile
+
+logger = get_logger(__name__)
+
+# 定型文 (メニューの案内や終話の案内) の音声キャッシュ。声とロールごとに一度だけ realtime API で合成し、
+# PCM をディスクとメモリに置いて、以降の通話では realtime に接続せずに ACS へ直接流す
+
+# PCM 24kHz 16bit mono
+AUDIO_BYTES_PER_SECOND = 48000
+
+PromptSynthesizer = Callable[[RoleProfile], Awaitable[bytes]]
+
+class PromptAudio:
+    # ACS にそのまま送れるよう、Base64 に変換したフレームに分けて持つ
+    def __init__(self, frames: List[str], seconds: float) -> None:
+        self.frames = frames
+        self.seconds = seconds
+
+
+class PromptAudioCache:
+    def __init__(
+        self,
+        enabled: bool,
+        directory: str,
+        chunk_seconds: float = 0.1,
+        lead_seconds: float = 0.5,
+        synthesis_timeout: float = 30.0
+    ) -> None:
+        self._enabled = enabled
+        self._directory = directory
+        self._chunk_seconds = chunk_seconds
+        self._lead_seconds = lead_seconds
+        self._synthesis_timeout = synthesis_timeout
+        self._synthesize: Optional[PromptSynthesizer] = None
+        self._audio: Dict[str, PromptAudio] = {}
+        # 読み込み中 (ディスクまたは合成) のキー。同じ定型文を重ねて合成しない
+        self._pending: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.disk_loads = 0
+        self.syntheses = 0
+        self.synthesis_errors = 0
+        self.plays = 0
+        self.plays_cancelled = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled and self._synthesize is not None
+
+    def configure(self, synthesize: PromptSynthesizer) -> None:
+        # rtclient を読み込んでから設定する (着信の受け付けには不要なため)
+        self._synthesize = synthesize
+
+    @staticmethod
+    def key(profile: RoleProfile) -> Optional[str]:
+        # 文面・声・形式が変われば別の音声になる。ACS に流せるのは pcm16 だけ
+        if not profile.prompt or profile.output_audio_format != "pcm16":
+            return None
+        digest = hashlib.sha256(f"{profile.voice}\n{profile.output_audio_format}\n{profile.prompt}".encode()).hexdigest()[:16]
+        return f"{profile.name or 'menu'}-{profile.voice}-{digest}"
+
+    def get(self, profile: RoleProfile) -> Optional[PromptAudio]:
+        # メモリにあれば返す。なければ用意をバックグラウンドで始めて None を返す (今回はモデルに読ませる)
+        if not self.enabled:
+            return None
+        key = self.key(profile)
+        if key is None:
+            return None
+        audio = self._audio.get(key)
+        if audio is not None:
+            self.hits += 1
+            return audio
+        self.misses += 1
+        self.prefetch(profile)
+        return None
+
+    def prefetch(self, profile: RoleProfile) -> Optional[asyncio.Task]:
+        key = self.key(profile)
+        if not self.enabled or key is None or key in self._audio:
+            return None
+        task = self._pending.get(key)
+        if task is None:
+            task = loop_monitor.spawn(self._load(key, profile), None, "prompt-audio")
+            self._pending[key] = task
+        return task
+
+    async def warm(self, profiles: Iterable[RoleProfile]) -> None:
+        # 起動後に全ロールの定型文を用意しておく (ディスクにあれば合成しない)
+        tasks = [task for task in (self.prefetch(profile) for profile in profiles) if task is not None]
+        await asyncio.gather(*tasks, return_exceptions = True)
+
+    async def _load(self, key: str, profile: RoleProfile) -> None:
+        path = os.path.join(self._directory, f"{key}.pcm")
+        try:
+            pcm = await asyncio.to_thread(self._read, path)
+            if pcm is not None:
+                self.disk_loads += 1
+            else:
+                pcm = await asyncio.wait_for(self._synthesize(profile), timeout = self._synthesis_timeout)
+                if not pcm:
+                    raise ValueError("The realtime API returned no audio")
+                self.syntheses += 1
+                await asyncio.to_thread(self._write, path, pcm)
+            self._audio[key] = self._split(pcm)
+            logger.info(f"Prompt audio {key} ready ({len(pcm) / AUDIO_BYTES_PER_SECOND:.1f}s)")
+        except Exception as e:
+            self.synthesis_errors += 1
+            logger.error(f"Failed to prepare prompt audio {key}: {e}")
+        finally:
+            self._pending.pop(key, None)
+
+    @staticmethod
+    def _read(path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path: str, pcm: bytes) -> None:
+        # 複数のプロセスが同じディレクトリを使っても、書きかけのファイルを読ませない
+        os.makedirs(self._directory, exist_ok = True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(pcm)
+        os.replace(temporary_path, path)
+
+    def _split(self, pcm: bytes) -> PromptAudio:
+        # 16bit のサンプル境界で区切る
+        chunk = max(2, int(self._chunk_seconds * AUDIO_BYTES_PER_SECOND) // 2 * 2)
+        frames = [base64.b64encode(pcm[offset:offset + chunk]).decode("ascii") for offset in range(0, len(pcm), chunk)]
+        return PromptAudio(frames, len(pcm) / AUDIO_BYTES_PER_SECOND)
+
+    async def play(self, audio: PromptAudio, send: Callable[[str], Awaitable[None]]) -> None:
+        # 実時間より lead_seconds だけ先行して送る。ロールが選ばれてタスクを止めれば、送った分の再生で終わる
+        self.plays += 1
+        started_at = time.monotonic()
+        sent_seconds = 0.0
+        try:
+            for frame in audio.frames:
+                delay = started_at + sent_seconds - self._lead_seconds - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await send(frame)
+                sent_seconds += self._chunk_seconds
+        except asyncio.CancelledError:
+            self.plays_cancelled += 1
+            raise
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "prompts": len(self._audio),
+            "pending": len(self._pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_loads": self.disk_loads,
+            "syntheses": self.syntheses,
+            "synthesis_errors": self.synthesis_errors,
+            "plays": self.plays,
+            "plays_cancelled": self.plays_cancelled,
+        }
+
+
+prompt_audio = PromptAudioCache(
+    enabled = PROMPT_AUDIO_ENABLED,
+    directory = PROMPT_AUDIO_DIRECTORY,
+    chunk_seconds = PROMPT_AUDIO_CHUNK_SECONDS,
+    lead_seconds = PROMPT_AUDIO_LEAD_SECONDS,
+    synthesis_timeout = PROMPT_AUDIO_SYNTHESIS_TIMEOUT_SECONDS
+)
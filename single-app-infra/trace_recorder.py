@@ -0,0 +1,215 @@
+import gzip
+import json
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from config import (
+    TRACE_ENABLED,
+    TRACE_DIRECTORY,
+    TRACE_REDACT_AUDIO,
+    TRACE_SAMPLE_RATE,
+    TRACE_MAX_ACTIVE_CALLS,
+    TRACE_QUEUE_SIZE,
+)
+from metrics import base64_decoded_length
+
+TRACE_VERSION = 1
+
+class CallTrace:
+    """
+    記録中の通話 1 件分の状態。
+    """
+    def __init__(self, call_id: str, path: str):
+        self.call_id = call_id
+        self.path = path
+        self.started_at = time.monotonic()
+        self.records = 0
+        # メディア切断と CallDisconnected の両方を受け取ったら記録を終える
+        self.media_closed = False
+        self.call_disconnected = False
+
+
+class TraceRecorder:
+    """
+    通話ごとの Webhook / ACS 音声 / realtime メッセージを時刻付きで gzip JSONL に記録します。
+    記録したトレースは loadtest/replay.py で再生し、ビルド間の性能比較に使います。
+    圧縮とファイル書き込みは専用スレッドで行い、イベントループではキューに積むだけにします。
+    """
+    def __init__(self, directory, enabled=False, redact_audio=True, sample_rate=1.0, max_active_calls=100, queue_size=100000):
+        self._directory = directory
+        self.enabled = enabled
+        self._redact_audio = redact_audio
+        self._sample_rate = sample_rate
+        self._max_active_calls = max_active_calls
+        self._traces = {}
+        # (path, entry) を積む。entry が None ならファイルを閉じ、None そのものはスレッド停止の合図
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        # キューが満杯で終了の合図を積めなかったトレースのパス。キューが空になった時点で書き込みスレッドが閉じる
+        self._ended = set()
+        self._ended_lock = threading.Lock()
+        self.dropped = 0
+        self.traces_started = 0
+        self.traces_finished = 0
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        os.makedirs(self._directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._write_loop, name="trace-recorder", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        記録中のトレースを閉じ、キューに残った記録を書き出してからスレッドを止めます。
+        """
+        if self._thread is None:
+            return
+        for call_id in list(self._traces):
+            self.end(call_id)
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def begin(self, call_id: str, **fields) -> bool:
+        """
+        通話の記録を開始します。無効時、サンプリング対象外、同時記録数の上限に達している場合は False を返します。
+        """
+        if self._thread is None or call_id in self._traces:
+            return False
+        if len(self._traces) >= self._max_active_calls or random.random() >= self._sample_rate:
+            return False
+        started = datetime.now(timezone.utc)
+        filename = f"{started.strftime('%Y%m%dT%H%M%S')}_{call_id}.jsonl.gz"
+        trace = CallTrace(call_id, os.path.join(self._directory, filename))
+        self._traces[call_id] = trace
+        self.traces_started += 1
+        self._enqueue(trace, {
+            "t": 0.0,
+            "kind": "trace",
+            "version": TRACE_VERSION,
+            "call_id": call_id,
+            "started_at": started.isoformat(),
+            "redacted": self._redact_audio,
+            **fields,
+        })
+        return True
+
+    def record(self, call_id, kind: str, **fields):
+        """
+        記録中の通話に 1 件追記します。記録対象外の通話ではすぐに戻ります。
+        """
+        trace = self._traces.get(call_id) if self._traces else None
+        if trace is None:
+            return
+        fields["t"] = round(time.monotonic() - trace.started_at, 6)
+        fields["kind"] = kind
+        self._enqueue(trace, fields)
+
+    def record_audio(self, call_id, kind: str, audio_base64: str):
+        """
+        音声フレームを記録します。redact_audio が有効な場合はバイト数だけを残します。
+        """
+        trace = self._traces.get(call_id) if self._traces else None
+        if trace is None:
+            return
+        if self._redact_audio:
+            self.record(call_id, kind, bytes=base64_decoded_length(audio_base64))
+        else:
+            self.record(call_id, kind, audio=audio_base64)
+
+    def media_closed(self, call_id: str):
+        trace = self._traces.get(call_id)
+        if trace is None:
+            return
+        self.record(call_id, "media_closed")
+        trace.media_closed = True
+        if trace.call_disconnected:
+            self.end(call_id)
+
+    def call_disconnected(self, call_id: str):
+        trace = self._traces.get(call_id)
+        if trace is None:
+            return
+        trace.call_disconnected = True
+        if trace.media_closed:
+            self.end(call_id)
+
+    def end(self, call_id: str):
+        trace = self._traces.pop(call_id, None)
+        if trace is None:
+            return
+        self.traces_finished += 1
+        # イベントループを止めないよう待たずに積む。満杯なら取りこぼさないよう別に記録しておく
+        try:
+            self._queue.put_nowait((trace.path, None))
+        except queue.Full:
+            with self._ended_lock:
+                self._ended.add(trace.path)
+
+    def stats(self):
+        return {
+            "active": len(self._traces),
+            "started": self.traces_started,
+            "finished": self.traces_finished,
+            "queued": self._queue.qsize(),
+            "dropped": self.dropped,
+        }
+
+    def _enqueue(self, trace: CallTrace, entry: dict):
+        try:
+            self._queue.put_nowait((trace.path, entry))
+            trace.records += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        files = {}
+        while True:
+            # キューが空なら、終了済みのトレースの記録はすべて書き終えている
+            if self._ended and self._queue.empty():
+                self._close_ended(files)
+            item = self._queue.get()
+            if item is None:
+                break
+            path, entry = item
+            try:
+                if entry is None:
+                    trace_file = files.pop(path, None)
+                    if trace_file is not None:
+                        trace_file.close()
+                    continue
+                trace_file = files.get(path)
+                if trace_file is None:
+                    trace_file = gzip.open(path, "ab")
+                    files[path] = trace_file
+                trace_file.write(json.dumps(entry, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+            except OSError:
+                self.dropped += 1
+        for trace_file in files.values():
+            trace_file.close()
+
+    def _close_ended(self, files: dict):
+        """
+        キューが満杯で終了の合図を積めなかったトレースのファイルを閉じます。
+        """
+        with self._ended_lock:
+            ended, self._ended = self._ended, set()
+        for path in ended:
+            trace_file = files.pop(path, None)
+            if trace_file is not None:
+                trace_file.close()
+
+
+recorder = TraceRecorder(
+    directory=TRACE_DIRECTORY,
+    enabled=TRACE_ENABLED,
+    redact_audio=TRACE_REDACT_AUDIO,
+    sample_rate=TRACE_SAMPLE_RATE,
+    max_active_calls=TRACE_MAX_ACTIVE_CALLS,
+    queue_size=TRACE_QUEUE_SIZE
+)
@@ -0,0 +1,292 @@
+import json
+import os
+import queue
+import shutil
+import socket
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Protocol, Tuple
+from config import (
+    TRANSCRIPT_ARCHIVE_ENABLED,
+    TRANSCRIPT_ARCHIVE_DIRECTORY,
+    TRANSCRIPT_ARCHIVE_SEGMENT_MAX_BYTES,
+    TRANSCRIPT_ARCHIVE_SEGMENT_MAX_SECONDS,
+    TRANSCRIPT_ARCHIVE_FLUSH_INTERVAL_SECONDS,
+    TRANSCRIPT_ARCHIVE_QUEUE_SIZE,
+    TRANSCRIPT_ARCHIVE_UPLOAD_DIRECTORY,
+)
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 通話の文字起こしを追記専用のセグメントファイルに保存する。
+# 書き込みスレッドが一定間隔で通話ごとのレコードを 1 ブロックにまとめ、zlib で圧縮して追記する。
+# ブロックは 4 バイトの長さ (ビッグエンディアン) + 圧縮データで、.idx に call_id とオフセットを記録する。
+BLOCK_HEADER = struct.Struct(">I")
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+
+class SegmentUploaderInterface(Protocol):
+    def upload(self, segment_path: str, index_path: str) -> None:
+        ...
+
+class DirectorySegmentUploader(SegmentUploaderInterface):
+    # 封印済みセグメントを別のディレクトリ (Azure Files などのマウント先) にコピーする
+    def __init__(self, directory: str) -> None:
+        self._directory = os.path.join(directory, socket.gethostname())
+
+    def upload(self, segment_path: str, index_path: str) -> None:
+        os.makedirs(self._directory, exist_ok = True)
+        for path in (index_path, segment_path):
+            destination = os.path.join(self._directory, os.path.basename(path))
+            # コピー途中のファイルを読まれないよう、別名で書いてから置き換える
+            shutil.copyfile(path, destination + ".tmp")
+            os.replace(destination + ".tmp", destination)
+
+
+class Segment:
+    def __init__(self, directory: str, sequence: int) -> None:
+        self.sequence = sequence
+        self.path = os.path.join(directory, f"{sequence:08d}{SEGMENT_SUFFIX}")
+        self.index_path = os.path.join(directory, f"{sequence:08d}{INDEX_SUFFIX}")
+        self.file = open(self.path, "ab")
+        self.index_file = open(self.index_path, "a", encoding = "utf-8")
+        self.size = self.file.tell()
+        self.opened_at = time.monotonic()
+
+    def close(self) -> None:
+        self.file.close()
+        self.index_file.close()
+
+
+class TranscriptArchive:
+    def __init__(
+        self,
+        directory: str,
+        enabled: bool = False,
+        segment_max_bytes: int = 64 * 1024 * 1024,
+        segment_max_seconds: float = 3600.0,
+        flush_interval: float = 1.0,
+        queue_size: int = 100000,
+        uploader: Optional[SegmentUploaderInterface] = None
+    ) -> None:
+        self._directory = directory
+        self.enabled = enabled
+        self._segment_max_bytes = segment_max_bytes
+        self._segment_max_seconds = segment_max_seconds
+        self._flush_interval = flush_interval
+        self._uploader = uploader
+        # None はスレッド停止の合図
+        self._queue: "queue.Queue[Optional[Tuple[str, dict]]]" = queue.Queue(maxsize = queue_size)
+        self._upload_queue: "queue.Queue[Optional[Tuple[str, str]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._upload_thread: Optional[threading.Thread] = None
+        # call_id -> [(セグメント番号, オフセット, ブロック長)]。書き込みスレッドと読み出しで共有する
+        self._index: Dict[str, List[Tuple[int, int, int]]] = {}
+        self._index_lock = threading.Lock()
+        self._next_sequence = 0
+        self.records = 0
+        self.blocks = 0
+        self.dropped = 0
+        self.write_errors = 0
+        self.segments_sealed = 0
+        self.segments_uploaded = 0
+        self.upload_errors = 0
+
+    def start(self) -> None:
+        if not self.enabled or self._thread is not None:
+            return
+        os.makedirs(self._directory, exist_ok = True)
+        self._load_index()
+        self._thread = threading.Thread(target = self._write_loop, name = "transcript-archive", daemon = True)
+        self._thread.start()
+        if self._uploader is not None:
+            self._upload_thread = threading.Thread(target = self._upload_loop, name = "transcript-upload", daemon = True)
+            self._upload_thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self._upload_thread is not None:
+            self._upload_queue.put(None)
+            self._upload_thread.join()
+            self._upload_thread = None
+
+    def append(self, call_id: Optional[str], speaker: str, text: str, **fields: Any) -> None:
+        if self._thread is None or not call_id or not text:
+            return
+        entry = {
+            "call_id": call_id,
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "speaker": speaker,
+            "text": text,
+            **fields,
+        }
+        try:
+            self._queue.put_nowait((call_id, entry))
+            self.records += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def read(self, call_id: str) -> List[dict]:
+        # インデックスのブロックだけを読むため、セグメント全体を走査しない。
+        # ファイルを読むので、イベントループからは asyncio.to_thread で呼び出すこと
+        with self._index_lock:
+            locations = list(self._index.get(call_id, ()))
+        entries: List[dict] = []
+        for sequence, offset, length in locations:
+            path = os.path.join(self._directory, f"{sequence:08d}{SEGMENT_SUFFIX}")
+            with open(path, "rb") as segment_file:
+                segment_file.seek(offset)
+                block = segment_file.read(length)
+            (compressed_length,) = BLOCK_HEADER.unpack_from(block)
+            data = zlib.decompress(block[BLOCK_HEADER.size:BLOCK_HEADER.size + compressed_length])
+            for line in data.splitlines():
+                entry = json.loads(line)
+                if entry.get("call_id") == call_id:
+                    entries.append(entry)
+        return entries
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "records": self.records,
+            "blocks": self.blocks,
+            "queued": self._queue.qsize(),
+            "dropped": self.dropped,
+            "write_errors": self.write_errors,
+            "indexed_calls": len(self._index),
+            "segments_sealed": self.segments_sealed,
+            "segments_uploaded": self.segments_uploaded,
+            "upload_errors": self.upload_errors,
+        }
+
+    def _load_index(self) -> None:
+        # 再起動前のセグメントも読み出せるよう、.idx からインデックスを作り直す。新しい書き込みは次の番号から始める
+        for name in sorted(os.listdir(self._directory)):
+            if not name.endswith(INDEX_SUFFIX):
+                continue
+            try:
+                sequence = int(name[:-len(INDEX_SUFFIX)])
+            except ValueError:
+                continue
+            self._next_sequence = max(self._next_sequence, sequence + 1)
+            with open(os.path.join(self._directory, name), encoding = "utf-8") as index_file:
+                for line in index_file:
+                    try:
+                        location = json.loads(line)
+                    except ValueError:
+                        # 書き込み途中で停止した最終行は読み飛ばす
+                        continue
+                    self._index.setdefault(location["call_id"], []).append(
+                        (sequence, location["offset"], location["length"])
+                    )
+
+    def _open_segment(self) -> Segment:
+        segment = Segment(self._directory, self._next_sequence)
+        self._next_sequence += 1
+        return segment
+
+    def _write_loop(self) -> None:
+        segment = self._open_segment()
+        pending: Dict[str, List[dict]] = {}
+        flush_at = time.monotonic() + self._flush_interval
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout = max(0.0, flush_at - time.monotonic()))
+                if item is None:
+                    stopping = True
+                else:
+                    call_id, entry = item
+                    pending.setdefault(call_id, []).append(entry)
+            except queue.Empty:
+                pass
+            if not stopping and time.monotonic() < flush_at:
+                continue
+            if pending:
+                self._flush(segment, pending)
+                pending = {}
+            flush_at = time.monotonic() + self._flush_interval
+            if segment.size >= self._segment_max_bytes or time.monotonic() - segment.opened_at >= self._segment_max_seconds:
+                if segment.size > 0:
+                    self._seal(segment)
+                    segment = self._open_segment()
+                else:
+                    # 空のセグメントは封印せず、最初の書き込みから時間を数え直す
+                    segment.opened_at = time.monotonic()
+        if segment.size > 0:
+            self._seal(segment)
+        else:
+            segment.close()
+            os.remove(segment.path)
+            os.remove(segment.index_path)
+
+    def _flush(self, segment: Segment, pending: Dict[str, List[dict]]) -> None:
+        # 通話ごとに 1 ブロックにまとめ、読み出し時はその通話のブロックだけを展開する
+        locations: List[Tuple[str, int, int]] = []
+        try:
+            for call_id, entries in pending.items():
+                data = b"".join(
+                    json.dumps(entry, ensure_ascii = False, default = str).encode("utf-8") + b"\n" for entry in entries
+                )
+                compressed = zlib.compress(data)
+                block = BLOCK_HEADER.pack(len(compressed)) + compressed
+                offset = segment.size
+                segment.file.write(block)
+                segment.size += len(block)
+                locations.append((call_id, offset, len(block)))
+            segment.file.flush()
+            # ブロックを書き終えてからインデックスを書くため、.idx が未書き込みのブロックを指すことはない
+            for call_id, offset, length in locations:
+                segment.index_file.write(json.dumps({"call_id": call_id, "offset": offset, "length": length}) + "\n")
+            segment.index_file.flush()
+        except OSError as e:
+            self.write_errors += 1
+            logger.error(f"Failed to write transcript block: {e}")
+            return
+        with self._index_lock:
+            for call_id, offset, length in locations:
+                self._index.setdefault(call_id, []).append((segment.sequence, offset, length))
+        self.blocks += len(locations)
+
+    def _seal(self, segment: Segment) -> None:
+        segment.close()
+        self.segments_sealed += 1
+        if self._uploader is not None:
+            self._upload_queue.put((segment.path, segment.index_path))
+
+    def _upload_loop(self) -> None:
+        while True:
+            item = self._upload_queue.get()
+            if item is None:
+                break
+            segment_path, index_path = item
+            try:
+                self._uploader.upload(segment_path, index_path)
+                self.segments_uploaded += 1
+            except Exception as e:
+                self.upload_errors += 1
+                logger.error(f"Failed to upload transcript segment {segment_path}: {e}")
+
+
+def create_segment_uploader() -> Optional[SegmentUploaderInterface]:
+    if not TRANSCRIPT_ARCHIVE_UPLOAD_DIRECTORY:
+        return None
+    return DirectorySegmentUploader(TRANSCRIPT_ARCHIVE_UPLOAD_DIRECTORY)
+
+
+transcript_archive = TranscriptArchive(
+    directory = TRANSCRIPT_ARCHIVE_DIRECTORY,
+    enabled = TRANSCRIPT_ARCHIVE_ENABLED,
+    segment_max_bytes = TRANSCRIPT_ARCHIVE_SEGMENT_MAX_BYTES,
+    segment_max_seconds = TRANSCRIPT_ARCHIVE_SEGMENT_MAX_SECONDS,
+    flush_interval = TRANSCRIPT_ARCHIVE_FLUSH_INTERVAL_SECONDS,
+    queue_size = TRANSCRIPT_ARCHIVE_QUEUE_SIZE,
+    uploader = create_segment_uploader()
+)
@@ -1,4 +1,5 @@
 import base64
+import logging
 from datetime import datetime
 
 from azure.communication.callautomation import (
@@ -6,14 +7,32 @@ from azure.communication.callautomation import (
     PhoneNumberIdentifier,
     MicrosoftTeamsUserIdentifier
 )
+from logger import get_logger, set_level
 
-# ログレベル設定（必要に応じて変更してください）
-print_log_level = "info"  # Options: None, "info", "debug"
-log_levels = {None: 0, "info": 1, "debug": 2}
+_logger = get_logger("app")
+_log_levels = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
 
-def print_debug(*msg, log_level="info"):
-    if log_levels.get(log_level, -1) <= log_levels.get(print_log_level, -1):
-        print(*msg, flush=True)
+def print_debug(*msg, log_level="info", **fields):
+    """
+    ログをキュー経由で非同期に出力します。
+    category を指定するとカテゴリ単位でレート制限し、sample (0.0 - 1.0) を指定すると確率的に間引きます。
+    call_id / job_id はキーワード引数または logger.bind_call で設定したコンテキストから付与されます。
+    """
+    level = _log_levels.get(log_level, logging.INFO)
+    if not _logger.is_enabled_for(level):
+        return
+    _logger.log(level, " ".join(str(m) for m in msg), **fields)
+
+def set_log_level(log_level: str):
+    """
+    実行中にログレベルを変更します。
+    """
+    set_level(log_level)
 
 def parse_communication_identifier(data):
     """
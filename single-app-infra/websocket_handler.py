@@ -1,10 +1,24 @@
+import asyncio
+import time
 from fastapi import WebSocket
 from utils import print_debug
-from conversation_manager import process_websocket_message_async, start_conversation
+from logger import bind_call
+from metrics import ACTIVE_CALLS
+from trace_recorder import recorder as trace_recorder
+from loop_monitor import loop_monitor
+from call_recorder import call_recorder
+from admission import admission_controller
+from call_watchdog import call_watchdog
+from conversation_manager import process_websocket_message_async, start_conversation, update_conversation, stop_prompt, cancel_open
 
 async def websocket_endpoint(websocket: WebSocket, call_id: str):
+    bind_call(call_id)
     print_debug("WebSocket connection established")
     await websocket.accept()
+    trace_recorder.record(call_id, "media_connected")
+    # 以降は中継中の通話 (ACTIVE_CALLS) として数える
+    admission_controller.release(call_id)
+    call_recorder.begin(call_id)
 
     # FastAPI アプリで共有されるグローバル状態から conversation_states を取得
     conversation_states = websocket.app.state.conversation_states
@@ -26,9 +40,19 @@ async def websocket_endpoint(websocket: WebSocket, call_id: str):
     await start_conversation(call_id, conversation_state)
 
     # ACS からのメッセージを待機
+    loop_monitor.tag(asyncio.current_task(), call_id, "relay-in")
+    # ACS からの受信が途絶えたらウォッチドッグがこのタスクを止め、realtime の停止は会話を始め直す
+    activity = call_watchdog.watch(
+        call_id,
+        asyncio.current_task().cancel,
+        lambda: update_conversation(call_id, conversation_state),
+        lambda: ping_gpt_client(conversation_state)
+    )
+    ACTIVE_CALLS.inc()
     try:
         while True:
             message = await websocket.receive()
+            activity.inbound_at = time.monotonic()
             msg_type = message.get('type')
             if msg_type == 'websocket.receive':
                 if 'text' in message:
@@ -40,11 +64,29 @@ async def websocket_endpoint(websocket: WebSocket, call_id: str):
             elif msg_type == 'websocket.disconnect':
                 print_debug("WebSocket disconnected")
                 break
+    except asyncio.CancelledError:
+        if not activity.closing:
+            raise
+        print_debug("WebSocket relay stopped by the watchdog")
     except Exception as e:
         print_debug(f"Exception in websocket_endpoint: {e}")
     finally:
+        call_watchdog.unwatch(call_id, activity)
+        ACTIVE_CALLS.dec()
+        trace_recorder.media_closed(call_id)
+        call_recorder.end(call_id)
+        stop_prompt(conversation_state)
+        cancel_open(conversation_state)
         if conversation_state.get('gpt_client'):
             await conversation_state['gpt_client'].close()
             conversation_state['gpt_client'] = None
-        conversation_states.pop(call_id, None)
+        # 会話状態 (ジョブなど) は CallDisconnected で片付ける
         print_debug(f"Connection closed for call_id: {call_id}")
+
+async def ping_gpt_client(conversation_state: dict):
+    """
+    GPT クライアントの WebSocket に ping を送ります (閉じた接続は送信が失敗するため検知できる)。
+    """
+    gpt_client = conversation_state.get('gpt_client')
+    if gpt_client:
+        await gpt_client.ws.ping()